@@ -0,0 +1,249 @@
+"""
+Benchmarks of in-process backends against whitebox tools on the same tiles.
+    * Run manually on sample tiles, f.e.
+        from src.benchmarks import benchmark_outlier_removal
+        benchmark_outlier_removal("/kaggle/working/laz_files/tile.laz", {"radius" : 4, "elev_diff" : 15, "use_median" : True})
+"""
+import datetime
+import os
+import tempfile
+import time
+
+def benchmark_outlier_removal(input_file=None, filter_outliers_params=None, exclude_cls=None):
+    """Compares throughput (points/sec) of outlier removal backends on one tile
+
+        * `whitebox` - `wbt.lidar_remove_outliers` (+ streaming class filter, as in `filter_lidar_files`)
+        * `numpy` - `src.point_filters.filter_lidar_file`, one read and one write
+
+        Returns a dict with points, seconds, points/sec and kept points per backend
+
+    Parameters
+    ----------
+    input_file : str
+        path to .las or .laz tile
+    filter_outliers_params : dict
+        params of `wbt.lidar_remove_outliers`
+    exclude_cls : str or None
+        comma separated classes to remove in the same run
+    """
+    import laspy
+    import numpy as np
+    import whitebox
+    from src.lidar_io import stream_filter_lidar_file
+    from src.point_filters import filter_lidar_file
+
+    with laspy.open(input_file) as reader:
+        n_points = reader.header.point_count
+    extension = os.path.splitext(input_file)[1]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as temp_dir:
+        wbt = whitebox.WhiteboxTools()
+        wbt.verbose = False
+        start = time.perf_counter()
+        output_file = os.path.join(temp_dir, 'whitebox' + extension)
+        wbt.lidar_remove_outliers(i=input_file, output=output_file, **filter_outliers_params)
+        if exclude_cls:
+            exclude_cls_list = [int(cls) for cls in exclude_cls.split(',')]
+            stream_filter_lidar_file(output_file, output_file.replace('whitebox', 'whitebox_cls'),
+                                     keep_mask=lambda points: ~np.isin(points.classification, exclude_cls_list))
+            output_file = output_file.replace('whitebox', 'whitebox_cls')
+        results["whitebox"] = {"seconds" : time.perf_counter() - start}
+        with laspy.open(output_file) as reader:
+            results["whitebox"]["kept"] = reader.header.point_count
+
+        start = time.perf_counter()
+        _, n_kept = filter_lidar_file(input_file, os.path.join(temp_dir, 'numpy' + extension),
+                                      filter_outliers_params=filter_outliers_params, exclude_cls=exclude_cls)
+        results["numpy"] = {"seconds" : time.perf_counter() - start, "kept" : n_kept}
+
+    print(f"\t{datetime.datetime.now()} Benchmark outlier removal : {input_file}, {n_points} points")
+    for backend, result in results.items():
+        result.update(points=n_points, points_per_sec=n_points / result["seconds"])
+        print(f"\t\t{backend:<10} {result['seconds']:8.1f} s, {result['points_per_sec']:12,.0f} points/sec, "
+              f"kept {result['kept']} points")
+    print(f"\t\tspeedup : {results['whitebox']['seconds'] / results['numpy']['seconds']:.2f}x")
+    return results
+
+def benchmark_gridding(input_files=None, whitebox_params=None, numpy_params=None, raster_method='surface'):
+    """Compares speed and RMSE of `numpy` gridding against a whitebox gridding tool on the same tiles
+
+        * Both outputs are snapped to the same global grid (`src.tile_rasterizer.rasterize_tile`),
+            RMSE is computed over cells valid in both rasters
+
+        Returns a dict per tile with seconds of both backends, RMSE and number of compared cells
+
+    Parameters
+    ----------
+    input_files : list
+        paths to .las or .laz tiles
+    whitebox_params : dict
+        params of a whitebox tool, f.e. {"resolution" : 1, "radius" : 0.8}
+    numpy_params : dict
+        params of `src.gridding.grid_lidar_points`, f.e. {"resolution" : 1, "statistic" : "max"}
+    raster_method : str
+        whitebox method to compare with, `surface` or `delaunay`
+    """
+    import numpy as np
+    import rasterio
+    from src.gridding import NODATA
+    from src.tile_index import build_tile_index
+    from src.tile_rasterizer import rasterize_tile
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as temp_dir:
+        for tile in build_tile_index(input_files):
+            tile_results = {}
+            for backend, method, params in (('whitebox', raster_method, whitebox_params), ('numpy', 'numpy', numpy_params)):
+                output_path = os.path.join(temp_dir, f'{backend}.tif')
+                result = rasterize_tile(tile, [tile], output_path, raster_method=method, gridding_params=params, halo=0.)
+                if not result["success"]:
+                    raise RuntimeError(f"{backend} gridding failed : {result['error']}")
+                with rasterio.open(output_path) as src:
+                    tile_results[backend] = {"seconds" : result["wall_time"], "grid" : src.read(1, masked=True)}
+
+            whitebox_grid, numpy_grid = tile_results["whitebox"]["grid"], tile_results["numpy"]["grid"]
+            both = ~np.ma.getmaskarray(whitebox_grid) & ~np.ma.getmaskarray(numpy_grid) & (numpy_grid.data != NODATA)
+            rmse = float(np.sqrt(np.mean((whitebox_grid.data[both] - numpy_grid.data[both]) ** 2))) if both.any() else None
+            results[tile["path"]] = {"whitebox_seconds" : tile_results["whitebox"]["seconds"],
+                                     "numpy_seconds" : tile_results["numpy"]["seconds"],
+                                     "rmse" : rmse, "cells" : int(both.sum()), "points" : tile["point_count"]}
+
+    print(f"\t{datetime.datetime.now()} Benchmark gridding : whitebox `{raster_method}` {whitebox_params} vs numpy {numpy_params}")
+    for path, result in results.items():
+        print(f"\t\t{os.path.basename(path)} whitebox {result['whitebox_seconds']:.1f} s, numpy {result['numpy_seconds']:.1f} s "
+              f"({result['whitebox_seconds'] / result['numpy_seconds']:.2f}x), RMSE {result['rmse']} over {result['cells']} cells")
+    return results
+
+def benchmark_raster_filters(input_file=None, methods_params=None, block_size=512, n_workers=None):
+    """Compares whitebox image filters with the block-parallel `numpy` backend on one raster
+
+        * `numpy` runs twice, as one block and as blocks over a process pool, outputs must be bit-identical
+        * RMSE against whitebox is computed over cells valid in both rasters
+
+        Returns a dict per method with seconds of all runs, RMSE and if block outputs are identical
+
+    Parameters
+    ----------
+    input_file : str
+        path to a raster mosaic (.tif)
+    methods_params : dict or None
+        params per method, f.e. {"median" : {"filterx" : 9, "filtery" : 9, "sig_digits" : 2}},
+        defaults of whitebox tools if None
+    block_size : int
+        side of a block of the parallel run
+    n_workers : int or None
+        number of worker processes of the parallel run, all CPUs if None
+    """
+    import numpy as np
+    import rasterio
+    import whitebox
+    from src.raster_filters import filter_raster
+
+    methods_params = methods_params or {"median" : {"filterx" : 9, "filtery" : 9, "sig_digits" : 2},
+                                        "conservative_smoothing" : {"filterx" : 3, "filtery" : 3},
+                                        "bilateral" : {"sigma_dist" : 0.75, "sigma_int" : 1.}}
+    n_workers = n_workers or os.cpu_count()
+    wbt = whitebox.WhiteboxTools()
+    wbt.verbose = False
+    tools = {"median" : wbt.median_filter, "conservative_smoothing" : wbt.conservative_smoothing_filter,
+             "bilateral" : wbt.bilateral_filter}
+    with rasterio.open(input_file) as src:
+        single_block = max(src.width, src.height)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as temp_dir:
+        for method, params in methods_params.items():
+            runs, grids = {}, {}
+            for run, run_filter in (('whitebox', lambda path: tools[method](i=input_file, output=path, **params)),
+                                    ('numpy_single', lambda path: filter_raster(input_file, path, method, params,
+                                                                                block_size=single_block, n_workers=1)),
+                                    ('numpy_blocks', lambda path: filter_raster(input_file, path, method, params,
+                                                                                block_size=block_size, n_workers=n_workers))):
+                output_path = os.path.join(temp_dir, f'{method}_{run}.tif')
+                start = time.perf_counter()
+                run_filter(output_path)
+                runs[run] = time.perf_counter() - start
+                with rasterio.open(output_path) as src:
+                    grids[run] = src.read(1, masked=True)
+
+            both = ~np.ma.getmaskarray(grids["whitebox"]) & ~np.ma.getmaskarray(grids["numpy_blocks"])
+            difference = grids["whitebox"].data[both].astype(np.float64) - grids["numpy_blocks"].data[both]
+            results[method] = {"seconds" : runs, "cells" : int(both.sum()),
+                               "rmse" : float(np.sqrt(np.mean(difference ** 2))) if both.any() else None,
+                               "identical" : bool(np.array_equal(grids["numpy_single"].filled(np.nan),
+                                                                 grids["numpy_blocks"].filled(np.nan), equal_nan=True))}
+
+    print(f"\t{datetime.datetime.now()} Benchmark raster filters : {input_file}, blocks {block_size} px, {n_workers} workers")
+    for method, result in results.items():
+        seconds = result["seconds"]
+        print(f"\t\t{method:<24} whitebox {seconds['whitebox']:.1f} s, numpy single block {seconds['numpy_single']:.1f} s, "
+              f"numpy blocks {seconds['numpy_blocks']:.1f} s ({seconds['whitebox'] / seconds['numpy_blocks']:.2f}x), "
+              f"RMSE {result['rmse']}, identical blocks {result['identical']}")
+    return results
+
+def _legacy_xarray_mesh(raster_path=None):
+    """Former `CUSTOM_READ` of `get_data._read_processed_rasterized_file` (xarray, meshgrid, float64 copies)"""
+    import numpy as np
+    import pyvista as pv
+    import xarray as xr
+
+    data = xr.open_rasterio(raster_path)
+    values = np.asarray(data)
+    nans = values == data.nodatavals
+    if np.any(nans):
+        values[nans] = np.nan
+    xx, yy = np.meshgrid(data['x'], data['y'])
+    zz = values.reshape(xx.shape)
+    mesh = pv.StructuredGrid(xx, yy, zz)
+    mesh['data'] = values.ravel(order='F')
+    return mesh
+
+def _peak_rss_of_reader(reader=None, raster_path=None, memmap_path=None):
+    """Runs one raster reader in a fresh process, returns peak RSS (MB) above the baseline after imports"""
+    import resource
+    import pyvista # noqa: F401, imported before the baseline, as in a notebook session
+    import rasterio # noqa: F401
+    from src.raster_mesh import read_raster_mesh
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if reader == 'xarray':
+        mesh = _legacy_xarray_mesh(raster_path)
+    else:
+        mesh = read_raster_mesh(raster_path, memmap_path=memmap_path if reader == 'memmap' else None,
+                                scalars_name='data', warp=True)
+    seconds = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on Linux
+    return {"peak_mb" : (peak - baseline) / 1024., "seconds" : seconds, "points" : int(mesh.n_points)}
+
+def benchmark_raster_mesh_memory(raster_path=None, readers=('xarray', 'float32', 'memmap')):
+    """Compares peak memory of raster to mesh readers, every reader runs in its own (spawned) process
+
+        * `xarray` - former `CUSTOM_READ`, `float32` - `src.raster_mesh.read_raster_mesh` in memory,
+            `memmap` - the same with heights in a memory-mapped .npy (page cache isn't counted in RSS)
+
+        Returns a dict per reader with peak RSS above baseline (MB), seconds and number of points
+
+    Parameters
+    ----------
+    raster_path : str
+        path to a raster mosaic, f.e. one of the sample city mosaics
+    readers : tuple
+        readers to compare
+    """
+    import multiprocessing
+    import rasterio
+
+    with rasterio.open(raster_path) as src:
+        raster_mb = src.width * src.height * 4 / 1024 ** 2
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark_') as temp_dir:
+        for reader in readers:
+            with multiprocessing.get_context('spawn').Pool(1) as pool:
+                results[reader] = pool.apply(_peak_rss_of_reader, (reader, raster_path, os.path.join(temp_dir, 'heights.npy')))
+
+    print(f"\t{datetime.datetime.now()} Benchmark raster mesh memory : {raster_path}, one float32 copy {raster_mb:.0f} MB")
+    for reader, result in results.items():
+        print(f"\t\t{reader:<10} peak {result['peak_mb']:10.0f} MB ({result['peak_mb'] / raster_mb:.1f} float32 copies), "
+              f"{result['seconds']:.1f} s, {result['points']} points")
+    return results
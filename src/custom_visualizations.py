@@ -21,23 +21,58 @@ display(pv.Report())
 pv.start_xvfb()
 pv.rcParams["transparent_background"] = True
 
-def visually_validate_mosaic(None):
-    """
-
-    """
-    mosaic_files = glob.glob('/kaggle/working/*.tif')
+def visually_validate_mosaic(mosaic_files=None, n_columns=4, subplot_size=4, dpi=150, n_workers=8, output_path=None):
+    """Plots mosaics side by side (contact sheet) to validate them visually
 
-    fig, axes = plt.subplots(1, len(mosaic_files), figsize=(8, 10), dpi=150)
+        * Every mosaic is read decimated to the pixel size of its subplot (overviews if there are any),
+            handles are closed right after the read, reads run in parallel threads (GDAL releases the GIL)
 
-    titles = [mosaic_file.split('/')[-1][:-4] for mosaic_file in mosaic_files]
-    for indx, file in enumerate(mosaic_files):
-        axes[indx].set_title(titles[indx - 1])
-        _plot_raster_rasterio(raster_path=file, ax=axes[indx])
+        Takes mosaics (all .tif in /kaggle/working/ by default)
+        Returns the figure, saves it to `output_path` if given
 
+    Parameters
+    ----------
+    mosaic_files : list or None
+        paths to mosaics, `/kaggle/working/*.tif` if None
+    n_columns : int
+        subplots per row
+    subplot_size : float
+        size of a subplot in inches
+    dpi : int
+        figure resolution, with `subplot_size` gives pixels per subplot (and thumbnail size)
+    n_workers : int
+        number of reading threads
+    output_path : str or None
+        path to save the contact sheet (.png)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from src.raster_mosaic import read_thumbnail
+
+    mosaic_files = sorted(mosaic_files if mosaic_files is not None else glob.glob('/kaggle/working/*.tif'))
+    if not mosaic_files:
+        return print('\tNo mosaics to validate')
+    n_columns = min(n_columns, len(mosaic_files))
+    n_rows = -(-len(mosaic_files) // n_columns)
+    thumbnail_px = int(subplot_size * dpi)
+    print(f"\t{datetime.datetime.now()} Validate {len(mosaic_files)} mosaics, thumbnails up to {thumbnail_px} px")
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        thumbnails = list(pool.map(lambda file: read_thumbnail(file, thumbnail_px), mosaic_files))
+
+    fig, axes = plt.subplots(n_rows, n_columns, figsize=(subplot_size * n_columns, subplot_size * n_rows),
+                             dpi=dpi, squeeze=False)
+    for ax in axes.ravel()[len(mosaic_files):]:
+        ax.axis('off')
+    for ax, file, (values, extent) in zip(axes.ravel(), mosaic_files, thumbnails):
+        ax.set_title(os.path.basename(file)[:-4], fontsize=8)
+        ax.imshow(values, extent=extent, cmap='viridis')
     fig.tight_layout()
+    if output_path:
+        fig.savefig(output_path, dpi=dpi)
+    del thumbnails
     gc.collect()
+    return fig
 
-def _plot_raster_rasterio(raster_path=None, ax=None):
+def _plot_raster_rasterio(raster_path=None, ax=None, max_size=1024):
     """Auxilary plot of raster with matplotlib backend
         description
 
@@ -50,23 +85,22 @@ def _plot_raster_rasterio(raster_path=None, ax=None):
         file path to raster (.tif)
     axis : matplotlib.pyplot.axis
         axis object, where to plot
+    max_size : int
+        raster is read decimated to at most `max_size` pixels per side
     """
-    try:
-        import rasterio
-        from rasterio.plot import show as rasterio_show
-    except ModuleNotFoundError:
-        !pip install rasterio
-        import rasterio
-        from rasterio.plot import show as rasterio_show
-
-    src = rasterio.open(raster_path)
-    rasterio_show(src, transform=src.transform, ax=ax)
-
-def _custom_save_rendered_plot(image_np_array=None, save_np_array=True, plot_filename="plot_temp_name.png"):
+    from src.raster_mosaic import read_thumbnail
+
+    values, extent = read_thumbnail(raster_path, max_size)
+    ax.imshow(values, extent=extent)
+
+def _custom_save_rendered_plot(image_np_array=None, save_np_array=False, plot_filename="plot_temp_name.png",
+                               array_format='npz', compress_level=6, optimize=False, background=True):
     """Saves an array of the rendered 3D chart in custom way
 
         * `pyvista` returns an error when one is trying to save a screenshot above of 4Kx4K window"s size
             so, let's approach a workaround using `PIL` package and an array representations of the plot
+        * Encoding runs on a background writer thread (`src.rendering.image_writer`),
+            so the next render starts while the previous image is still being encoded
 
         Takes array representation of a chart
         Returns saved renders
@@ -79,21 +113,24 @@ def _custom_save_rendered_plot(image_np_array=None, save_np_array=True, plot_fil
         if save `img_np_array` in auxilary file
     plot_filename : str
         file name and extension of an output file (.png, .jpg, .gif)
+    array_format : str
+        `npz` (compressed) or `npy` (memory-mapped), with `save_np_array` only
+    compress_level : int
+        PNG zlib level, 0 (fastest) - 9 (smallest)
+    optimize : bool
+        if search for the smallest encoding (much slower)
+    background : bool
+        if encode on the background writer thread, `src.rendering.image_writer().wait()` waits for it
     """
-    try:
-        from PIL import Image
-    except ModuleNotFoundError:
-        !pip install PIL
-        from PIL import Image
-
-    print(f"\t\t\t{datetime.datetime.now()} Saving high quality plot array")
-    # https://numpy.org/doc/stable/reference/generated/numpy.save.html#numpy.save
-    np.save(plot_filename + ".array", image_np_array)
+    from src.rendering import image_writer, save_rendered_image
+
     print(f"\t\t\t{datetime.datetime.now()} Saving high quality plot screenshot")
     # https://stackoverflow.com/questions/902761/saving-a-numpy-array-as-an-image
-    im = Image.fromarray(image_np_array)
-    im.save(plot_filename, optimize=True, quality=1.0, bbox_inches="tight")
-    del(im, image_np_array)
+    save_params = dict(save_np_array=save_np_array, array_format=array_format,
+                       compress_level=compress_level, optimize=optimize)
+    if background:
+        return image_writer().submit(image_np_array, plot_filename, **save_params)
+    save_rendered_image(image_np_array, plot_filename, **save_params)
 
 def plot_3D(mesh=None, plotter_params=None, plot_actor_params=None, plot_isometric=True,
             enable_shades=False, enable_eye_dome_lighting=False,
@@ -126,7 +163,8 @@ def plot_3D(mesh=None, plotter_params=None, plot_actor_params=None, plot_isometr
 
     save_plot_mode : str
         - `save render orbiting` for orbiting (.gif, from many screenshots, imageio-ffmpeg backend)
-        - `save render orbiting video` for orbiting video (.mp4, from many screenshots). NOT IMPLEMENTED YET.
+        - `save render orbiting video` for orbiting video (.mp4, from many screenshots, imageio-ffmpeg backend)
+        * Orbits are rendered in this process, `src.rendering.render_orbit` splits frames over processes
         - `save render` for static render (.png)
         - `just show` for no save, show render only
     plot_filename : str
@@ -134,53 +172,16 @@ def plot_3D(mesh=None, plotter_params=None, plot_actor_params=None, plot_isometr
         file name and extension of an output file (.png, .jpg, .gif)
     """
 
-    p = pv.Plotter(**plotter_params)
-    # p.enable_lightkit()
-
-    print(f'\t{datetime.datetime.now()} Add mesh')
-    actor_1 = p.add_mesh(mesh, **plot_actor_params)
-    # actor2 = p.add_mesh(topo_clipped_water, clim=[-10, 2.5], cmap=['lightblue']) # "add water" the hard way
-    # p.add_mesh(mesh_rgb, scalars='RGB', rgb=True)
-
-    if not plot_isometric:
-        p.view_xy()
-        p.camera.zoom(1.25)
-        print(f'\t\tUse orthographic view angle for plotter')
-    else:
-        print(f'\t\tUse default (isometric) view angle for plotter')
-
-    print(f'\t{datetime.datetime.now()} Add custom light source')
-    light = pv.Light(intensity=0.7)
-    light.set_direction_angle(300, -20)
-    p.add_light(light)
+    from src.rendering import build_plotter
 
     ### check `light_kit`, `pv.Light` custom lights, or some other params to avoid VTK errors
     ### (vtkShaderProgram.cxx:452 / vtkOpenGLState errors)
-    if enable_shades:
-        print(f'\t\t{datetime.datetime.now()} Enable shadows')
-        p.enable_shadows() # or disable
-
-    print(f'\t\t{datetime.datetime.now()} Enable anti_aliasing')
-    p.enable_anti_aliasing(aa_type='msaa')
-    # p.enable_depth_peeling() # ?
-    # p.enable_depth_of_field()
-
-    #p.camera.tight()
-    #p.camera.zoom(1.2)
-    #p.camera_position = 'xy'
-    #p.camera.elevation = -45
-
-    if enable_eye_dome_lighting:
-        print(f'\t\t{datetime.datetime.now()} Enable shadows')
-        p.enable_eye_dome_lighting() # or disable
-
-    print(f'\t\t{datetime.datetime.now()} Add grid')
-    ### check coordinates and projection https://github.com/pyvista/pyvista-support/issues/394
-    p.show_grid(color='lightgrey', font_size=36)
-    print(f'\t\t{datetime.datetime.now()} Add bounding_box')
-    p.add_bounding_box(opacity=0.75, color='lightgrey')
-
+    print(f'\t{datetime.datetime.now()} Add mesh, lights, shadows {enable_shades}, eye dome lighting {enable_eye_dome_lighting}')
+    p = build_plotter(mesh, plotter_params, plot_actor_params, plot_isometric=plot_isometric,
+                      enable_shades=enable_shades, enable_eye_dome_lighting=enable_eye_dome_lighting,
+                      off_screen=save_plot_mode != 'just show')
 
+    write = None # future of the screenshot encoding on the background writer
     if save_plot_mode == 'save render orbiting':
         !pip install imageio-ffmpeg
         print(f'\t{datetime.datetime.now()} Save orbiting')
@@ -188,85 +189,94 @@ def plot_3D(mesh=None, plotter_params=None, plot_actor_params=None, plot_isometr
         path = p.generate_orbital_path(n_points=72, shift=mesh.length)
         p.open_gif(plot_filename) # , fps=24
         p.orbit_on_path(path, write_frames=True, progress_bar=True)
+    elif save_plot_mode == 'save render orbiting video':
+        !pip install imageio-ffmpeg
+        print(f'\t{datetime.datetime.now()} Save orbiting video')
+        p.camera.zoom(1.5)
+        path = p.generate_orbital_path(n_points=72, shift=mesh.length)
+        p.open_movie(plot_filename, framerate=24)
+        p.orbit_on_path(path, write_frames=True, progress_bar=True)
     elif save_plot_mode == 'save render':
         print(f'\t{datetime.datetime.now()} Save plot screenshot in high quality')
         image_np_array = p.screenshot(filename=None, return_img=True)
-        _custom_save_rendered_plot(image_np_array=image_np_array, save_np_array=True,
-                                   plot_filename=plot_filename)
+        write = _custom_save_rendered_plot(image_np_array=image_np_array, save_np_array=False,
+                                           plot_filename=plot_filename)
+        del image_np_array
     elif save_plot_mode == 'just show':
         p.show()
 
     print(f'\t{datetime.datetime.now()} Garbage collection and memory cleaning')
     p.deep_clean()
     p.clear()
-    del(p, actor_1) # actor_2, etc
+    del p
     gc.collect()
+    if write is not None: # encoded while the plotter was cleaned, the file exists (or the error raises) on return
+        write.result()
 
-def _main_visualisation():
+def _main_visualisation(raster_path=None):
     """Runs through cities list
         renders charts, saves rendered charts
-    """
-    mesh = _read_processed_rasterized_file(file_path="/kaggle/working/riga_center.tif", CUSTOM_READ=True)
-    display(mesh)
 
+        * All views are render jobs, rendered in parallel processes (`src.rendering.render_jobs`),
+            every worker maps heights from a shared .npy and builds its mesh once
+
+    Parameters
+    ----------
+    raster_path : str or None
+        mosaic to render, the latest filtered mosaic of `get_data._main_get_data` if None
+    """
+    from src.profiling import Profiler, configure_logging, set_profiler, span
+    from src.raster_mosaic import overview_factor
+    from src.rendering import render_jobs, render_workers
+
+    if raster_path is None:
+        filtered_mosaics = glob.glob("/kaggle/working/*_filtered.tif")
+        if not filtered_mosaics:
+            return print(f"\t{datetime.datetime.now()} No filtered mosaics to render, run `_main_get_data` first")
+        raster_path = max(filtered_mosaics, key=os.path.getmtime)
     KEY = "CityName CityState CityCountry" # Prefix name example
+    profile_dir = "/kaggle/working/profile/" # spans as JSON lines and Chrome trace
+
+    configure_logging('INFO')
+    profiler = set_profiler(Profiler(os.path.join(profile_dir, 'visualisation.jsonl')))
 
     #mesh.rotate_z(-180, inplace=True)
     plot_actor_params = {"cmap" : "blues", "log_scale" : False, "show_scalar_bar" : False} # cmap='Blues' # "color" : "tan"
-    plotter_params = {'window_size' : [3200, 3200], 'lighting' : 'light_kit', 'line_smoothing' : True, 'multi_samples' : 16}
-    print(f"\t{datetime.datetime.now()} Visualisation. Orbiting.")
-    plot_filename = f"{KEY}_orbiting_{plotter_params['window_size'][0]}_72points.gif"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=True,
-            enable_eye_dome_lighting=False, enable_shades=False,
-            save_plot_mode='save render orbiting', plot_filename=plot_filename) # save_plot_mode = 'save render'
-    gc.collect()
-
+    tan_actor_params = {"color" : "tan", "log_scale" : False, "show_scalar_bar" : False}
+    orbit_plotter_params = {'window_size' : [3200, 3200], 'lighting' : 'light_kit', 'line_smoothing' : True, 'multi_samples' : 16}
     plotter_params = {'window_size' : [6000, 6000]}
-    plot_filename = f"{KEY}_isometric_{plotter_params['window_size'][0]}.png"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=True,
-            enable_eye_dome_lighting=False, enable_shades=False,
-            save_plot_mode='save render', plot_filename=plot_filename) # save_plot_mode = 'save render'
-    gc.collect()
-
-    plot_filename = f"{KEY}_ortho_{plotter_params['window_size'][0]}.png"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=False,
-            enable_eye_dome_lighting=False, enable_shades=False,
-            save_plot_mode='save render', plot_filename=plot_filename) # save_plot_mode = 'save render'
-    gc.collect()
-
-    plot_filename = f"{KEY}_ortho_{plotter_params['window_size'][0]}_shades.png"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=False,
-            enable_eye_dome_lighting=False, enable_shades=True,
-            save_plot_mode='save render', plot_filename=plot_filename) # save_plot_mode = 'save render'
-    gc.collect()
-
-    plot_actor_params = {"color" : "tan", "log_scale" : False, "show_scalar_bar" : False}
-    plot_filename = f"{KEY}_isometric_{plotter_params['window_size'][0]}_tan.png"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=True,
-            enable_eye_dome_lighting=False, enable_shades=False,
-            save_plot_mode='save render', plot_filename=plot_filename) # save_plot_mode = 'save render'
-    gc.collect()
-
-    plot_filename = f"{KEY}_isometric_{plotter_params['window_size'][0]}_tan_eyedom.png"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=True,
-            enable_eye_dome_lighting=True, enable_shades=True,
-            save_plot_mode='save render', plot_filename=plot_filename) # save_plot_mode = 'save render'
-    gc.collect()
-
-    plot_filename = f"{KEY}_ortho_{plotter_params['window_size'][0]}_tan.png"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=False,
-            enable_eye_dome_lighting=False, enable_shades=False,
-            save_plot_mode='save render', plot_filename=plot_filename) # save_plot_mode = 'save render'
-    gc.collect()
-
-    plot_filename = f"{KEY}_ortho_{plotter_params['window_size'][0]}_tan_shades.png"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=False,
-            enable_eye_dome_lighting=False, enable_shades=True,
-            save_plot_mode='save render', plot_filename=plot_filename) # save_plot_mode = 'save render'
-    gc.collect()
-
-    plot_filename = f"{KEY}_ortho_{plotter_params['window_size'][0]}_tan_eyedom.png"
-    plot_3D(mesh=mesh, plotter_params=plotter_params, plot_actor_params=plot_actor_params, plot_isometric=False,
-            enable_eye_dome_lighting=True, enable_shades=True,
-            save_plot_mode='save render', plot_filename=plot_filename) # save_plot_mode = 'save render'
+    size = plotter_params['window_size'][0]
+
+    # orbit frames don't need more cells than window pixels, render them from the matching overview level (orbit zooms 1.5x)
+    jobs = [dict(plotter_params=orbit_plotter_params, plot_actor_params=plot_actor_params, plot_isometric=True,
+                 save_plot_mode='save render orbiting', factor=overview_factor(raster_path, orbit_plotter_params['window_size'], 1.5),
+                 plot_filename=f"{KEY}_orbiting_{orbit_plotter_params['window_size'][0]}_72points.gif")]
+    # full resolution for the biggest stills only, rendered in 2000x2000 tiles (no 6000x6000 framebuffer),
+    # .tif file names stream tiles into a tiled TIFF, f.e. for 12K+ prints
+    # (suffix, actor params, isometric, shades, eye dome lighting)
+    for suffix, actor_params, plot_isometric, enable_shades, enable_eye_dome_lighting in (
+            ("isometric", plot_actor_params, True, False, False),
+            ("ortho", plot_actor_params, False, False, False),
+            ("ortho_shades", plot_actor_params, False, True, False),
+            ("isometric_tan", tan_actor_params, True, False, False),
+            ("isometric_tan_eyedom", tan_actor_params, True, True, True),
+            ("ortho_tan", tan_actor_params, False, False, False),
+            ("ortho_tan_shades", tan_actor_params, False, True, False),
+            ("ortho_tan_eyedom", tan_actor_params, False, True, True)):
+        view, _, style = suffix.partition('_')
+        jobs.append(dict(plotter_params=plotter_params, plot_actor_params=actor_params, plot_isometric=plot_isometric,
+                         enable_shades=enable_shades, enable_eye_dome_lighting=enable_eye_dome_lighting,
+                         save_plot_mode='save render', factor=1, tile_size=2000,
+                         plot_filename=f"{KEY}_{view}_{size}{'_' + style if style else ''}.png"))
+
+    # orbit frames are split over the workers, an encoder process writes them in order
+    # (save_plot_mode='save render orbiting video' and a .mp4 file name for a video)
+    print(f"\t{datetime.datetime.now()} Visualisation. {len(jobs)} render jobs.")
+    # stills render in 2000x2000 tiles, so framebuffers are small, full resolution meshes of workers bound their number
+    with span('render jobs', n_jobs=len(jobs)) as counters:
+        results = render_jobs(jobs, raster_path=raster_path, memmap_folder="/kaggle/working/heights/",
+                              n_workers=render_workers(raster_path, factor=1))
+        counters.update(succeeded=sum(result['success'] for result in results))
+    profiler.add_task_records('render job', results)
+    profiler.write_chrome_trace(os.path.join(profile_dir, 'visualisation_trace.json'))
     gc.collect()
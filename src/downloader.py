@@ -0,0 +1,194 @@
+"""
+Concurrent, resumable downloader of data files (LiDAR tiles, archives).
+    * Bounded number of parallel downloads (thread pool, downloads are I/O bound)
+    * Interrupted downloads are resumed with HTTP range requests from `<file>.part`
+    * Content is hashed (sha256) on the fly, and verified against expected checksums if given
+    * Archives are unzipped in a separate thread, while next files are still downloading
+
+Only the standard library is used, so it works against any HTTP server, f.e. a local stand-in
+    python -m http.server 8000 --directory data/external/
+"""
+import datetime
+import hashlib
+import http.client
+import os
+import time
+import urllib.error
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DOWNLOAD_BLOCK_SIZE = 1024 ** 2
+
+def link_file_name(link=None):
+    """Returns the name a link is saved under, the last part of its path (f.e. ID2007_118754_e.zip)"""
+    return link.split('/')[-1]
+
+def download_file(link=None, output_folder='./', expected_sha256=None, n_retries=2, timeout=60):
+    """Downloads one file, resuming from a partial `.part` file if there is one
+
+        Takes a link
+        Returns a result record (path, bytes of the last attempt, sha256, latency to first byte, wall time)
+
+        Logic:
+        - 1. IF FILE EXISTS (AND CHECKSUM MATCHES) THEN SKIP
+        - 2. IF `.part` EXISTS THEN REQUEST REMAINING BYTES (HTTP RANGE), HASH EXISTING BYTES
+        - 3. STREAM BLOCKS TO `.part`, UPDATE HASH ON THE FLY, A BODY SHORTER THAN `Content-Length` IS RETRIED
+        - 4. VERIFY CHECKSUM, RENAME `.part` TO FILE
+
+    Parameters
+    ----------
+    link : str
+        link to download a file from
+    output_folder : str
+        folder to save a file to
+    expected_sha256 : str or None
+        expected sha256 (hex) of a file, not verified if None
+    n_retries : int
+        how many times to retry (resume) after a network error
+    timeout : float
+        socket timeout in seconds
+    """
+    path = os.path.join(output_folder, link_file_name(link))
+    result = {"link" : link, "path" : path, "success" : False, "skipped" : False, "resumed_from" : 0,
+              "bytes" : 0, "sha256" : None, "latency" : None, "wall_time" : 0., "error" : None}
+    start = time.perf_counter()
+
+    if os.path.exists(path):
+        sha256 = _file_sha256(path)
+        if expected_sha256 is None or sha256 == expected_sha256:
+            result.update(success=True, skipped=True, sha256=sha256)
+            return result
+
+    for attempt in range(n_retries + 1):
+        try:
+            digest, offset, result["bytes"] = hashlib.sha256(), 0, 0
+            if os.path.exists(path + '.part'):
+                offset = os.path.getsize(path + '.part')
+                digest = _file_sha256(path + '.part', return_digest=True)
+            headers = {"Range" : f"bytes={offset}-"} if offset else {}
+            try:
+                response = urllib.request.urlopen(urllib.request.Request(link, headers=headers), timeout=timeout)
+            except urllib.error.HTTPError as error:
+                if error.code != 416 or not offset: # 416 - nothing left to download, `.part` is complete
+                    raise
+                response = None
+
+            if response is not None:
+                with response:
+                    if offset and response.status != 206: # server ignores ranges, start over
+                        digest, offset = hashlib.sha256(), 0
+                    if result["latency"] is None:
+                        result["latency"] = time.perf_counter() - start
+                    result["resumed_from"] = offset
+                    length = response.headers.get('Content-Length')
+                    with open(path + '.part', 'ab' if offset else 'wb') as file:
+                        for block in iter(lambda: response.read(DOWNLOAD_BLOCK_SIZE), b''):
+                            file.write(block)
+                            digest.update(block)
+                            result["bytes"] += len(block)
+                    if length is not None and result["bytes"] < int(length): # connection dropped, resume `.part`
+                        raise http.client.IncompleteRead(b'', int(length) - result["bytes"])
+
+            result["sha256"] = digest.hexdigest()
+            if expected_sha256 is not None and result["sha256"] != expected_sha256:
+                os.remove(path + '.part') # corrupted, don't resume from it
+                raise ValueError(f"checksum mismatch, expected {expected_sha256}, got {result['sha256']}")
+            os.replace(path + '.part', path)
+            result.update(success=True, error=None)
+            break
+        # network errors are OSError (URLError, timeouts, resets), broken responses HTTPException (IncompleteRead)
+        except (OSError, ValueError, http.client.HTTPException) as error:
+            result["error"] = f"{type(error).__name__}: {error}"
+            if isinstance(error, urllib.error.HTTPError) and 400 <= error.code < 500:
+                break # f.e. 404, retrying won't help
+
+    result["wall_time"] = time.perf_counter() - start
+    return result
+
+def unzip_file(path=None, unzip_folder=None):
+    """Unzips an archive into `unzip_folder`, returns names of extracted files"""
+    with zipfile.ZipFile(path) as archive:
+        archive.extractall(unzip_folder)
+        return archive.namelist()
+
+def download_files(links=None, output_folder='./', max_workers=4, checksums=None,
+                   unzip_folder=None, n_retries=2, timeout=60):
+    """Downloads many files concurrently, unzips archives while other files are still downloading
+
+        Takes a list of links
+        Returns result records of links and prints a report (per-link latency, aggregate throughput)
+
+        * A repeated link is downloaded once, different links saved under the same name raise ValueError
+            (their downloads would write into one `.part` at once)
+
+    Parameters
+    ----------
+    links : list
+        links to download files from
+    output_folder : str
+        folder to save files to
+    max_workers : int
+        maximum number of parallel downloads
+    checksums : dict or None
+        expected sha256 by link, not verified for missing links
+    unzip_folder : str or None
+        folder to unzip .zip archives to, archives aren't unzipped if None
+    n_retries : int
+        see `download_file`
+    timeout : float
+        see `download_file`
+    """
+    checksums = checksums or {}
+    links = list(dict.fromkeys(links))
+    names = {}
+    for link in links:
+        names.setdefault(link_file_name(link), []).append(link)
+    duplicates = {name : same_name for name, same_name in names.items() if len(same_name) > 1}
+    if duplicates:
+        raise ValueError(f"Links saved under the same name : {duplicates}")
+    start = time.perf_counter()
+    results, extractions = [], {}
+    with ThreadPoolExecutor(max_workers=max_workers) as download_pool, \
+         ThreadPoolExecutor(max_workers=1) as unzip_pool:
+        futures = [download_pool.submit(download_file, link, output_folder, checksums.get(link), n_retries, timeout)
+                   for link in links]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"\t{datetime.datetime.now()} {'downloaded' if result['success'] else 'FAILED'} {result['link']}")
+            if result["success"] and unzip_folder is not None and result["path"].lower().endswith('.zip'):
+                extractions[result["link"]] = unzip_pool.submit(unzip_file, result["path"], unzip_folder)
+
+        for result in results:
+            if result["link"] in extractions:
+                try:
+                    result["extracted"] = extractions[result["link"]].result()
+                except (OSError, zipfile.BadZipFile) as error:
+                    result.update(success=False, error=f"unzip {type(error).__name__}: {error}")
+
+    print_download_report(results, wall_time=time.perf_counter() - start)
+    return results
+
+def print_download_report(results=None, wall_time=None):
+    """Prints per-link latency and throughput, and aggregate throughput of downloads"""
+    print(f"\t{datetime.datetime.now()} Summary download : {len(results)} links")
+    for result in results:
+        status = "SKIP" if result["skipped"] else "OK  " if result["success"] else "FAIL"
+        latency = f"{result['latency']:.2f} s" if result["latency"] is not None else "-"
+        speed = result["bytes"] / result["wall_time"] / 1024 ** 2 if result["wall_time"] else 0.
+        print(f"\t\t{status} {link_file_name(result['link'])} latency : {latency}, "
+              f"{result['bytes'] / 1024 ** 2:.1f} MB in {result['wall_time']:.1f} s ({speed:.1f} MB/s)"
+              + (f", resumed from {result['resumed_from']} B" if result["resumed_from"] else "")
+              + (f" ({result['error']})" if result["error"] else ""))
+    total_bytes = sum(result["bytes"] for result in results)
+    print(f"\t\ttotal : {total_bytes / 1024 ** 2:.1f} MB in {wall_time:.1f} s, "
+          f"throughput : {total_bytes / wall_time / 1024 ** 2 if wall_time else 0.:.1f} MB/s")
+
+def _file_sha256(path=None, return_digest=False):
+    """Returns sha256 of a file (hex), or the hash object to continue hashing"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(DOWNLOAD_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest if return_digest else digest.hexdigest()
@@ -1,6 +1,7 @@
 import logging
 #   https://docs.python.org/3/howto/logging.html
 #   https://docs.python.org/3/howto/logging-cookbook.html#logging-cookbook
+import contextlib
 import datetime
 import glob
 import gc
@@ -12,13 +13,29 @@ except ModuleNotFoundError:
     !pip install whitebox
     import whitebox
 
+LAS_FALLBACK = False # if decompress LAZ into LAS before all stages, only for tools which can't read LAZ
+STAGE_CACHE_DIR = '/kaggle/working/stage_cache/' # None to disable the stage cache
+PROFILE_DIR = '/kaggle/working/profile/' # spans as JSON lines and Chrome trace, None to keep them in memory only
+LOG_LEVEL = 'INFO' # `DEBUG` for more, `WARNING` for less
+TILE_INDEX_PATH = '/kaggle/working/tile_index.json' # extents of tiles of all stages, updated incrementally
+# per city, tiles intersecting a bbox and/or polygon only, all tiles if a city is missing
+# f.e. {"Riga" : {"bounds" : (504000, 310000, 508000, 314000)},
+#       "Miami" : {"polygon" : "/kaggle/working/downtown.geojson", "polygon_crs" : "EPSG:4326"}}
+REGIONS_OF_INTEREST = {}
+# per city, points outside footprints are clipped before rasterization, all points if a city is missing
+# f.e. {"Miami" : {"polygons" : "/kaggle/working/parks.geojson", "polygon_crs" : "EPSG:4326"}}
+CLIP_FOOTPRINTS = {}
+AUTO_GRIDDING_PARAMS = False # if take `resolution` and `radius` suggested by point density of a city
+PIPELINED = False # if filter, rasterize and mosaic tiles in one pipeline (stages overlap), instead of stage by stage
+POINT_STORE = False # if convert tiles into memory-mapped columns once, summarize and filter read them instead of LAZ
+
 def _create_folders_structure():
     """Creates project structure (adds folders for data stages)
 
         Logic:
         - 1. CREATE FOLDER FOR [RAW] LAZ
         - 2. CREATE FOLDER FOR [RAW] LAS
-        - 3. CREATE FOLDER FOR [INTERIM] TIFF
+        - 3. CREATE FOLDER FOR [INTERIM] FILTERED (AND CLIPPED) LAS/LAZ AND TIFF
         - 4. CREATE FOLDER FOR [PROCESSED] MOSAIC OUTPUT AND FILTERED MOSAIC OUTPUT
 
     Parameters
@@ -29,55 +46,86 @@ def _create_folders_structure():
 
     pathlib.Path('laz_files').mkdir(parents=True, exist_ok=True)
     pathlib.Path('las_files').mkdir(parents=True, exist_ok=True)
+    pathlib.Path('filtered_files').mkdir(parents=True, exist_ok=True)
+    pathlib.Path('clipped_files').mkdir(parents=True, exist_ok=True)
     pathlib.Path('tif_files').mkdir(parents=True, exist_ok=True)
     pathlib.Path('mosaic_files').mkdir(parents=True, exist_ok=True)
 
-def download_lidar_files(links=None, unzip=True, run=True):
+def download_lidar_files(links=None, unzip=True, output_folder='./', max_workers=4,
+                         checksums=None, run=True):
     """Downloads (collects) selected files in LiDAR point cloud format to local storage.
 
         Takes data structure with links
-        Returns downloaded raw data files
+        Returns downloaded raw data files, and result records of links
 
         * Sometimes data is provided in compressed archive formats (f.e. ZIP format), so decompress them.
+        * Links are downloaded concurrently, interrupted downloads are resumed on a re-run,
+            archives are unzipped while next links are still downloading. See `src.downloader`
 
         Logic:
         - 1. DOWNLOAD
+        -    1.1 RESUME PARTIAL DOWNLOAD, VERIFY CHECKSUM (IF GIVEN)
         -    1.2 IF .ZIP THEN UNZIP (DECOMPRESS ARCHIVE)
 
     Parameters
     ----------
-    links : str
+    links : list
         list of links to download files from
     unzip : bool
         if unzip (unarchive) link output
+    output_folder : str
+        folder to download files to
+    max_workers : int
+        maximum number of parallel downloads
+    checksums : dict or None
+        expected sha256 by link
     run : bool
         if run function code
     """
     if not run:
         return print('\tDownload LiDAR files manually (& unzip, if needed)')
-    for indx, link in enumerate(links):
-        !wget "$link"
-        file_name = links.split('/')[-1] # f.e. ID2007_118754_e.zip
-        if unzip:
-            !unzip "$file_name" -d las_files
+    from src.downloader import download_files
+
+    return download_files(links=links, output_folder=output_folder, max_workers=max_workers,
+                          checksums=checksums, unzip_folder='las_files' if unzip else None)
 
-def decompress_laz_files(input_folder=None, run=False):
+def decompress_laz_files(input_folder=None, output_folder="/kaggle/working/las_files/", n_workers=1, chunk_size=1_000_000,
+                         max_memory_mb=None, n_retries=1, input_files=None, run=False):
     """Decompresses (unlaz) selected files in LiDAR compressed point cloud format.
 
         Takes raw data files in LAZ format
-        Returns (creates) unarchived files in LAS format
+        Returns (creates) unarchived files in LAS format, and result records of tiles
 
         * Sometimes data is provided in compressed LiDAR point clouds format (usually, .LAZ).
             Some packages/wrappers/APIs doesn't support .LAZ file format out of a box, so let's standardize file formats
+        * Tiles are independent, so they are decompressed in a pool of processes (`n_workers`).
+            Every worker streams `chunk_size` points at a time instead of the whole point cloud
 
         Logic:
         - 1. IF .LAZ THEN DECOMPRESS .LAZ ('UNZIP' LAZ, UNLAZ .LAZ -> .LAS)
+        -    1.1 RETRY FAILED TILES, KEEP .LAZ OF TILES FAILED AFTER ALL RETRIES
+        -    1.2 IF A WORKER DIED (F.E. KILLED OVER `max_memory_mb`) THEN RECORD ITS TILES AS FAILED, OTHERS GO ON
+        - 2. PRINT SUMMARY (SUCCESS, BYTES IN AND OUT, WALL TIME PER TILE)
 
     Parameters
     ----------
     input_folder : str
         description
         example format : "/kaggle/working/laz_files/"
+    output_folder : str
+        folder of .las files, named as .laz files
+    n_workers : int
+        number of worker processes, `1` to decompress in the current process
+    chunk_size : int
+        number of points held in memory by a worker at once
+    max_memory_mb : int or None
+        memory (address space) limit of every worker process, no limit if None
+        applied in worker processes only, so a pool is used even if `n_workers` is 1
+    n_retries : int
+        how many times to retry a failed tile
+    input_files : list or None
+        files to process instead of all files of `input_folder`, f.e. tiles of a region of interest
+        (`src.tile_index.TileIndex.query`)
     run : bool
         if run function code
     """
@@ -90,111 +138,435 @@ def decompress_laz_files(input_folder=None, run=False):
     except ModuleNotFoundError:
         !pip install laspy[lazrs,laszip]
         import laspy
+    from concurrent.futures import ProcessPoolExecutor
+    from src.lidar_io import decompress_laz_file, failed_tile_result, print_tiles_summary, _set_memory_limit
 
-    for indx, file in enumerate(glob.glob(f'{input_folder}*.laz')):
+    files = input_files if input_files is not None else glob.glob(f'{input_folder}*.laz')
+    print(f"\t{datetime.datetime.now()} run decompression. {len(files)} files, {n_workers} workers")
+    os.makedirs(output_folder, exist_ok=True)
+    jobs = [dict(input_path=file, output_path=os.path.join(output_folder, os.path.splitext(os.path.basename(file))[0] + '.las'),
+                 chunk_size=chunk_size, n_retries=n_retries) for file in files]
 
-        print(f"\t{datetime.datetime.now()} {indx} \t{file} - reading .LAZ ")
-        las = laspy.read(file)
-        #print('\t', las.header, )
+    if n_workers == 1 and not max_memory_mb:
+        results = [decompress_laz_file(**job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_set_memory_limit,
+                                 initargs=(max_memory_mb,)) as pool:
+            futures = [pool.submit(decompress_laz_file, **job) for job in jobs]
+            results = []
+            for job, future in zip(jobs, futures):
+                try:
+                    results.append(future.result())
+                except Exception as error: # f.e. BrokenProcessPool, a worker was killed, its tile has no record
+                    results.append(failed_tile_result(job["input_path"], job["output_path"], error))
+
+    print_tiles_summary(results, stage='decompress')
+    gc.collect()
+    return results
 
-        print(f'\t\t{datetime.datetime.now()} Converting .LAZ to .LAS')
-        las = laspy.convert(las)
+def summarize_lidar_files(input_folder=None, output_path="/kaggle/working/lidar_info.json", cell_size=10.,
+                          n_workers=1, input_files=None, run=True):
+    """Summarizes LiDAR point clouds (per tile and whole dataset), in-process replacement of `wbt.lidar_info`
 
-        print(f'\t\t{datetime.datetime.now()} Saving .LAS')
-        las.write(file.replace('laz', 'las'))
+        Takes files in LAS or LAZ format (point clouds)
+        Returns dataset statistics (tile statistics under `tile_statistics`), writes them to JSON (and Parquet)
 
-        print(f"\t\tdelete: {file}")
-        !rm "$file"
-        #if indx == 5: break
+        * One streamed pass per tile, tiles in a pool of processes: counts, density grid, class histogram,
+            z percentiles, and gridding params suggested by point density. See `src.lidar_stats`
 
-    !rm /kaggle/working/laz_files/*.laz
-    del las
-    gc.collect()
+    Parameters
+    ----------
+    input_folder : str
+        description
+        example format : "/kaggle/working/laz_files/"
+    output_path : str
+        path to a .json with statistics, a .parquet table of tiles and a folder of density grids (.npy per tile)
+        are written next to it
+    cell_size : float
+        cell size of density grids (CRS units)
+    n_workers : int
+        number of worker processes, `1` to summarize in the current process
+    input_files : list or None
+        files to process instead of all files of `input_folder`, f.e. tiles of a region of interest
+        (`src.tile_index.TileIndex.query`)
+    run : bool
+        if run function code
+    """
+    if not run:
+        return print('\tSummarize LiDAR files manually')
 
-def filter_lidar_files(input_folder=None,
+    from src.lidar_io import glob_lidar_files
+    from src.lidar_stats import lidar_statistics
+
+    input_files = input_files if input_files is not None else glob_lidar_files(input_folder)
+    return lidar_statistics(input_files, output_path=output_path, cell_size=cell_size, n_workers=n_workers)
+
+def filter_lidar_files(input_folder=None, output_folder=None,
                        filter_classes=True, exclude_cls=None,
                        filter_outliers=True, filter_outliers_params=None,
-                       run=True):
+                       filter_chain=None, filter_backend='whitebox', las_fallback=False, cache=None,
+                       input_files=None, run=True):
     """Filters LiDAR point cloud.
 
-        Takes raw data files in LAS format (point clouds)
+        Takes raw data files in LAS or LAZ format (point clouds)
+        Creates filtered files in the same format (LAZ stays LAZ)
+
+        * LAZ is read directly, classes are filtered in a streaming pass over chunks of points,
+            so decompressed points never touch disk
+        * With `cache`, filtered tiles are restored from the stage cache if the tile and parameters are unchanged
+        * `numpy` backend compiles all filters (outliers, classes, z range) into one streaming pass per tile,
+            no intermediate files, see `src.point_filters.apply_filter_chain`. It takes point stores too
+            (`store_lidar_files`), filtered points are written to LAZ
+        * Filtered files are named by their filters, f.e. `tile_rmv_out_rmv_cls.laz`, for both backends and
+            whether `filter_chain` is given or built from flags, see `src.point_filters.filter_chain_suffix`
+
+        Logic (per tile):
+        - 1. IF CACHED THEN RESTORE FILTERED TILE
+        - 2. REMOVE OUTLIERS
+        - 3. REMOVE CLASSES
+        - 4. STORE FILTERED TILE IN CACHE
 
     Parameters
     ----------
     input_folder : str
         description
         example format : "/kaggle/working/laz_files/"
+    output_folder : str or None
+        folder of filtered files, inputs are kept
+        if None, filtered files are created in `input_folder` and inputs are deleted
+    filter_classes : bool
+        if filter (remove) points of classes `exclude_cls` from a point cloud
+    exclude_cls : str
+        comma separated classes to remove, f.e. "0,7,18"
     filter_outliers : bool
         if filter (remove) outliers from a point cloud, uses `wbt.lidar_remove_outliers`
+    filter_outliers_params : dict
+        params of `wbt.lidar_remove_outliers`, f.e. {"radius" : 4, "elev_diff" : 15, "use_median" : True, "classify" : False}
+    filter_chain : list or None
+        declarative filter steps for `numpy` backend, see `src.point_filters.compile_filter_chain`
+        f.e. [{"filter" : "outliers", "radius" : 4, "elev_diff" : 15}, {"filter" : "z_range", "minz" : 0, "maxz" : 80}]
+        if None, built from `filter_outliers`, `filter_classes` and their params
+    filter_backend : str
+        - `whitebox` for `wbt.lidar_remove_outliers`, then a streaming class filter
+        - `numpy` for in-process filter chain (KD-tree outliers, classes, z range) in one pass
+    las_fallback : bool
+        if decompress LAZ into a temporary LAS for whitebox tools (only if whitebox build can't read LAZ)
+    cache : src.stage_cache.StageCache or None
+        stage cache, no caching if None
+    input_files : list or None
+        files to process instead of all files of `input_folder`, f.e. tiles of a region of interest
+        (`src.tile_index.TileIndex.query`)
     run : bool
         if run function code
     """
     if not run:
         return print('\tFilter LiDAR files manually')
 
+    import numpy as np
+    import shutil
+    from src.lidar_io import glob_lidar_files, las_fallback as las_fallback_path, stream_filter_lidar_file
+    from src.point_filters import apply_filter_chain, filter_chain_from_params, filter_chain_suffix
+    from src.point_store import lidar_output_path
+    from src.profiling import span
+
     wbt = whitebox.WhiteboxTools()
     print(wbt.version())
 
     wbt.verbose = False # True to see progress
-    print(f"\t{datetime.datetime.now()} run filtering. {len(glob.glob('/kaggle/working/las_files/*'))} files")
-    if filter_outliers:
-        for indx, file in enumerate(glob.glob(f'{input_folder}*.las')):
+    input_files = input_files if input_files is not None else glob_lidar_files(input_folder)
+    delete_inputs = output_folder is None
+    output_folder = input_folder if output_folder is None else output_folder
+    if filter_backend != 'numpy' or filter_chain is None: # whitebox backend takes the flags only
+        filter_chain = filter_chain_from_params(filter_outliers_params=filter_outliers_params if filter_outliers else None,
+                                                exclude_cls=exclude_cls if filter_classes else None)
+    if not filter_chain:
+        return print('\tNo filters to apply')
+    # names and cache keys follow the filters, the same whether the chain is given or built from flags
+    suffix = filter_chain_suffix(filter_chain)
+    cache_params = {"filter_chain" : filter_chain, "filter_backend" : filter_backend}
+    print(f"\t{datetime.datetime.now()} run filtering. {len(input_files)} files")
+    for indx, file in enumerate(input_files):
+        file_stem, file_extension = os.path.splitext(lidar_output_path(file, output_folder))
+        output_file = file_stem + suffix + file_extension
+        if cache is not None and cache.restore('filter', [file], cache_params, output_paths=[output_file])[0]:
+            if delete_inputs and output_file != file:
+                print(f"\t\tdelete: {file}")
+                if os.path.isdir(file): # a store is a folder
+                    shutil.rmtree(file)
+                else:
+                    os.remove(file)
+            continue
+
+        active_file = file
+        if filter_backend == 'numpy':
+            print(f"\t{datetime.datetime.now()} {indx} \t{file} - filter chain {[step['filter'] for step in filter_chain]}")
+            with span(os.path.basename(file), 'filter tile') as counters:
+                n_points, n_kept = apply_filter_chain(file, output_file, filter_chain)
+                counters.update(points=n_points, kept=n_kept)
+            active_file = output_file
+            print(f"\t\tcreate: {active_file}, kept {n_kept} of {n_points} points")
+
+        if filter_outliers and filter_backend == 'whitebox':
             print(f"\t{datetime.datetime.now()} {indx} \t{file} - remove outliers")
-            active_file = file
-            active_file = active_file.replace('.las', '_rmv_out.las')
-            wbt.lidar_remove_outliers(i=file, output=active_file, **filter_outliers_params)
+            file_stem = f'{file_stem}_rmv_out'
+            with las_fallback_path(active_file, enabled=las_fallback) as input_file:
+                wbt.lidar_remove_outliers(i=input_file, output=file_stem + file_extension, **filter_outliers_params)
+            active_file = file_stem + file_extension
+            print(f"\t\tcreate: {active_file}")
+
+        if filter_classes and filter_backend == 'whitebox':
+            print(f"\t{datetime.datetime.now()} {indx} \t{active_file} - filter classes")
+            exclude_cls_list = [int(cls) for cls in exclude_cls.split(',')]
+            file_stem = f'{file_stem}_rmv_cls'
+            stream_filter_lidar_file(active_file, file_stem + file_extension,
+                                     keep_mask=lambda points: ~np.isin(points.classification, exclude_cls_list))
+            if active_file != file:
+                print(f"\t\tdelete: {active_file}")
+                os.remove(active_file)
+            active_file = file_stem + file_extension
             print(f"\t\tcreate: {active_file}")
+
+        if cache is not None:
+            cache.store('filter', [file], cache_params, [active_file])
+        if delete_inputs and active_file != file:
             print(f"\t\tdelete: {file}")
-            !rm "$file"
+            if os.path.isdir(file): # a store is a folder
+                shutil.rmtree(file)
+            else:
+                os.remove(file)
+    if cache is not None:
+        cache.flush()
     gc.collect()
 
-    if filter_classes:
-        for indx, file in enumerate(glob.glob(f'{input_folder}*.las')):
-            print(f"\t{datetime.datetime.now()} {indx} \t{file} - filter classes")
+def clip_lidar_files(input_folder=None, output_folder="/kaggle/working/clipped_files/", polygons=None,
+                     polygon_crs=None, grid_size=32, n_workers=1, chunk_size=1_000_000, cache=None,
+                     input_files=None, run=True):
+    """Clips LiDAR point clouds to footprints (f.e. OSM parks, parkings), between filtering and rasterization
 
-            active_file = file
-            active_file = active_file.replace('.las', '_rmv_cls.las')
-            wbt.filter_lidar_classes(i=file, output=active_file, exclude_cls=exclude_cls)
-            print(f"\t\tcreate: {active_file}")
-            print(f"\t\tdelete: {file}")
-            !rm "$file"
-        gc.collect()
+        Takes filtered files in LAS or LAZ format (point clouds)
+        Creates files with points inside footprints only, in the same format, and returns result records of tiles
+
+        * Points are streamed chunk by chunk through a vectorized point-in-polygon test with bounding box
+            prefiltering and a grid of inside/boundary cells per polygon, see `src.point_clip`
+        * Tiles outside all footprints get no output (they don't reach rasterization and mosaic),
+            tiles inside a footprint are copied. Tiles are clipped in a pool of processes (`n_workers`)
+        * Point stores (`store_lidar_files`) are clipped from their `x`, `y` columns, outputs are LAZ
+
+        Logic:
+        - 1. BUILD FOOTPRINTS IN CRS OF TILES (ONCE)
+        - 2. FOR EVERY TILE: IF CACHED THEN RESTORE, ELSE SKIP / COPY / CLIP, STORE IN CACHE
 
-def rasterize_lidar_files(input_folder=None, raster_method='surface',
-                          gridding_params=None, run=True):
+    Parameters
+    ----------
+    input_folder : str
+        description
+        example format : "/kaggle/working/filtered_files/"
+    output_folder : str
+        folder of clipped files
+    polygons : str, dict, list or shapely geometry
+        footprints, f.e. path to a GeoJSON, see `src.tile_index.load_polygon`
+    polygon_crs : str or None
+        CRS of polygons, f.e. `EPSG:4326` for OSM, reprojected to CRS of tiles
+    grid_size : int
+        cells per side of a polygon acceleration grid
+    n_workers : int
+        number of worker processes, `1` to clip in the current process
+    chunk_size : int
+        number of points held in memory by a worker at once
+    cache : src.stage_cache.StageCache or None
+        stage cache, no caching if None
+    input_files : list or None
+        files to process instead of all files of `input_folder`, f.e. tiles of a region of interest
+        (`src.tile_index.TileIndex.query`)
+    run : bool
+        if run function code
+    """
+    if not run:
+        return print('\tClip LiDAR files manually')
+
+    from concurrent.futures import ProcessPoolExecutor
+    from src.lidar_io import glob_lidar_files
+    from src.point_clip import build_footprints, clip_lidar_file
+    from src.point_store import lidar_output_path
+    from src.tile_index import tile_crs
+
+    input_files = input_files if input_files is not None else glob_lidar_files(input_folder)
+    if not input_files:
+        return []
+    os.makedirs(output_folder, exist_ok=True)
+    footprints = build_footprints(polygons, polygon_crs=polygon_crs, target_crs=tile_crs(input_files[0]),
+                                  grid_size=grid_size)
+    print(f"\t{datetime.datetime.now()} run clipping. {len(input_files)} files, {len(footprints)} polygons, {n_workers} workers")
+
+    cache_params = {"polygons" : polygons, "polygon_crs" : polygon_crs, "grid_size" : grid_size}
+    results, jobs = [], []
+    for file in input_files:
+        output_file = lidar_output_path(file, output_folder)
+        if cache is not None:
+            hit, restored = cache.restore('clip', [file], cache_params, output_folder=output_folder) # no paths if skipped
+            if hit:
+                results.append({"file" : file, "output" : restored[0] if restored else None, "mode" : "cached"})
+                continue
+        jobs.append(dict(input_path=file, output_path=output_file, footprints=footprints, chunk_size=chunk_size))
+
+    if n_workers == 1:
+        clipped = [clip_lidar_file(**job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(clip_lidar_file, **job) for job in jobs]
+            clipped = [future.result() for future in futures]
+    for result in clipped:
+        if cache is not None:
+            cache.store('clip', [result["file"]], cache_params, [result["output"]] if result["output"] else [])
+        print(f"\t\t{os.path.basename(result['file'])} : {result['mode']}, kept {result['kept']} of {result['points']} points")
+    if cache is not None:
+        cache.flush()
+    gc.collect()
+    return results + clipped
+
+def store_lidar_files(input_folder=None, output_folder="/kaggle/working/point_store/", dimensions=None,
+                      n_workers=1, input_files=None, run=False):
+    """Converts LiDAR point clouds into columnar point stores (memory-mapped .npy per dimension)
+
+        Takes files in LAS or LAZ format (point clouds)
+        Returns paths to stores, one per tile (`<tile>.points/`)
+
+        * Stores are an optional interchange format of in-process stages (statistics, `numpy` filtering,
+            clipping, `numpy` gridding), a stage maps only the columns it needs, zero-copy. `src.point_store.export_point_store`
+            writes a store back to LAS/LAZ. See `src.point_store`
+        * Stores newer than their tiles are reused, tiles are converted in a pool of processes (`n_workers`)
+
+    Parameters
+    ----------
+    input_folder : str
+        description
+        example format : "/kaggle/working/filtered_files/"
+    output_folder : str
+        folder of stores
+    dimensions : tuple or None
+        dimensions to store, `src.point_store.STORE_DIMENSIONS` if None
+    n_workers : int
+        number of worker processes, `1` to convert in the current process
+    input_files : list or None
+        files to process instead of all files of `input_folder`, f.e. tiles of a region of interest
+        (`src.tile_index.TileIndex.query`)
+    run : bool
+        if run function code
+    """
+    if not run:
+        return print('\tStore LiDAR files manually')
+
+    from concurrent.futures import ProcessPoolExecutor
+    from src.lidar_io import glob_lidar_files
+    from src.point_store import STORE_DIMENSIONS, write_point_store
+
+    input_files = input_files if input_files is not None else glob_lidar_files(input_folder)
+    dimensions = dimensions or STORE_DIMENSIONS
+    os.makedirs(output_folder, exist_ok=True)
+    print(f"\t{datetime.datetime.now()} run point store conversion. {len(input_files)} files, {n_workers} workers")
+    if n_workers == 1:
+        store_paths = [write_point_store(file, output_folder, dimensions) for file in input_files]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(write_point_store, file, output_folder, dimensions) for file in input_files]
+            store_paths = [future.result() for future in futures]
+    gc.collect()
+    return store_paths
+
+def rasterize_lidar_files(input_folder=None, output_folder="/kaggle/working/tif_files/", raster_method='surface',
+                          gridding_params=None, processing_mode='batch', halo=10., n_workers=1,
+                          las_fallback=False, cache=None, input_files=None, run=True):
     """Creates a mesh (rasterizes) LiDAR point cloud.
 
-        Takes LPC data files in LAS format (point clouds)
+        Takes LPC data files in LAS or LAZ format (point clouds)
         Creates mesh (rasters) in tif/tiff format (Tagged Image File Format)
 
         We use `whitebox geo` API to handle it.
             Methods selected are
                 `Delaunay triangulation` (Delaunay triangular irregular network (TIN))
                 `lidar_digital_surface_model` (Delaunay triangular with additional params)
+        Or native NumPy gridding (`numpy` method): highest return, mean or IDW within radius per cell,
+            optional TIN gap filling, points are binned chunk by chunk. See `src.gridding`
+
+        * `tiles` processing mode rasterizes every tile independently in a pool of processes,
+            with a halo of points borrowed from neighbouring tiles (found by tile bounding boxes),
+            and snaps tiles to a global grid. See `src.tile_rasterizer`
 
         For additional information, check
             # https://www.whiteboxgeo.com/manual/wbt_book/available_tools/lidar_tools.html#lidartingridding
             # https://docs.qgis.org/3.4/en/docs/user_manual/working_with_mesh/mesh_properties.html
 
         Logic:
-        - 1. TRANSFORM [POINT CLOUD] .LAS -> [MESH/RASTER/GRID] .TIFF
+        - 1. IF CACHED THEN RESTORE RASTERS
+        - 2. TRANSFORM [POINT CLOUD] .LAS -> [MESH/RASTER/GRID] .TIFF
+        - 3. STORE RASTERS IN CACHE
 
     Parameters
     ----------
     input_folder : str
         description
         example format : "/kaggle/working/laz_files/"
+    output_folder : str
+        folder of rasters
     raster_method : str
         `delaunay` - uses `wbt.lidar_tin_gridding`
         `surface` uses `wbt.lidar_digital_surface_model`
+        `numpy` uses `src.gridding.grid_lidar_points`, always processed per tile
+    gridding_params : dict
+        params of a whitebox gridding tool, f.e. {"resolution" : 1, "radius" : 0.8}
+        or of `numpy` gridding, f.e. {"resolution" : 1, "statistic" : "max", "fill_gaps" : True}
+    processing_mode : str
+        - `batch` for one whitebox call over the whole folder
+        - `tiles` for tile-parallel rasterization with halo buffers
+    halo : float
+        `tiles` mode, width of the halo (CRS units) borrowed from neighbouring tiles
+    n_workers : int
+        `tiles` mode, number of worker processes
+    las_fallback : bool
+        if decompress LAZ into a temporary folder of LAS for whitebox tools (only if whitebox build can't read LAZ)
+    cache : src.stage_cache.StageCache or None
+        stage cache, no caching if None (per tile in `tiles` mode)
+    input_files : list or None
+        files to process instead of all files of `input_folder`, f.e. tiles of a region of interest
+        (`src.tile_index.TileIndex.query`)
     run : bool
         if run function code
     """
     if not run:
         return print('\tRasterize LiDAR files manually')
 
+    from src.lidar_io import glob_lidar_files, decompress_laz_file
+
+    input_files = input_files if input_files is not None else glob_lidar_files(input_folder)
+    if processing_mode == 'tiles' or raster_method == 'numpy':
+        from src.lidar_io import print_tiles_summary
+        from src.tile_rasterizer import rasterize_tiles
+
+        results = rasterize_tiles(files=input_files, output_folder=output_folder, raster_method=raster_method,
+                                  gridding_params=gridding_params, halo=halo, las_fallback=las_fallback,
+                                  n_workers=n_workers, cache=cache)
+        print_tiles_summary(results, stage='rasterize')
+        return results
+
+    cache_params = {"raster_method" : raster_method, "gridding_params" : gridding_params}
+    if cache is not None:
+        hit, _ = cache.restore('rasterize', input_files, cache_params, output_folder=output_folder)
+        cache.flush() # only inputs are hashed
+        if hit:
+            return
+
     wbt = whitebox.WhiteboxTools()
-    wbt.set_working_dir(input_folder)
+    working_dir = input_folder
+    if las_fallback and any(file.endswith('.laz') for file in input_files) or len(input_files) < len(glob_lidar_files(input_folder)):
+        # whitebox batch tools take a whole folder, so LAS copies or a subset of tiles go to a temporary one
+        import tempfile
+        working_dir = tempfile.mkdtemp(prefix='las_fallback_') + '/'
+        for file in input_files:
+            if las_fallback and file.endswith('.laz'):
+                decompress_laz_file(file, working_dir + os.path.basename(file)[:-4] + '.las', delete_input=False)
+            else:
+                os.symlink(os.path.abspath(file), working_dir + os.path.basename(file))
+    wbt.set_working_dir(working_dir)
 
     # batch processing (whole folder) vs kinda stream (rasterizes every file)
     ## `batch` should note files around each other
@@ -204,12 +576,18 @@ def rasterize_lidar_files(input_folder=None, raster_method='surface',
     if raster_method == "delaunay":
         wbt.lidar_tin_gridding(**gridding_params) #2,3,4,5
     else:
-        wbt.lidar_digital_surface_model(resolution=1., radius=0.8)
-    !mv "$input_folder"*.tif /kaggle/working/tif_files/
-    ""
+        wbt.lidar_digital_surface_model(**gridding_params)
+    output_files = [output_folder + os.path.basename(file) for file in glob.glob(f'{working_dir}*.tif')]
+    !mv "$working_dir"*.tif "$output_folder"
+    if working_dir != input_folder:
+        !rm -r "$working_dir"
+    if cache is not None:
+        cache.store('rasterize', input_files, cache_params, output_files)
+        cache.flush()
 
 def mosaic_rastersized_lidar_files(input_folder=None, output_mosaic_path=None,
-                                   mosaic_backend='whitebox', mosaic_method="bilinear", run=True):
+                                   mosaic_backend='whitebox', mosaic_method="bilinear", block_budget_mb=256,
+                                   cache=None, input_files=None, run=True):
     """Merges (mosaics, appends) many selected raster files into one big raster mosaic
 
         Takes raster files from `input_folder`
@@ -227,25 +605,56 @@ def mosaic_rastersized_lidar_files(input_folder=None, output_mosaic_path=None,
         description
     mosaic_backend : str
         - `whitebox.wbt.mosaic` for whitebox
-        - `rasterio.merge.merge` for rasterio
+        - `rasterio.merge.merge` for rasterio (whole mosaic in memory)
+        - `windowed` for block by block mosaic, see `src.raster_mosaic.mosaic_windowed`
+        - `vrt` for a virtual mosaic (`output_mosaic_path` ends with .vrt), no pixels are written,
+            downstream stages read windows lazily, `src.raster_mosaic.export_mosaic` materializes it
         - manually for manual/custom/other package merge
+    mosaic_method : str
+        resampling method, `nn`, `bilinear` or `cc`
+    block_budget_mb : float
+        `windowed` only, memory budget of one output block (peak memory doesn't grow with city size)
+    cache : src.stage_cache.StageCache or None
+        stage cache, no caching if None
+    input_files : list or None
+        files to process instead of all files of `input_folder`, f.e. tiles of a region of interest
+        (`src.tile_index.TileIndex.query`)
     run : bool
         if run function code
     """
     if not run:
         return print('\tMosaic rastersized LiDAR files manually')
 
-    wbt = whitebox.WhiteboxTools()
-    print(wbt.version())
+    input_files = sorted(input_files if input_files is not None else glob.glob(f'{input_folder}*.tif'))
+    cache_params = {"mosaic_backend" : mosaic_backend, "mosaic_method" : mosaic_method}
+    if cache is not None:
+        hit, _ = cache.restore('mosaic', input_files, cache_params, output_paths=[output_mosaic_path])
+        cache.flush() # only inputs are hashed
+        if hit:
+            return
+
+    ### WINDOWED MOSAIC merge
+    if mosaic_backend == 'windowed':
+        from src.raster_mosaic import mosaic_windowed
+
+        mosaic_windowed(input_files, output_mosaic_path, mosaic_method=mosaic_method, block_budget_mb=block_budget_mb)
+
+    ### VRT (VIRTUAL) MOSAIC
+    elif mosaic_backend == 'vrt':
+        from src.raster_mosaic import build_vrt
+
+        build_vrt(input_files, output_mosaic_path, mosaic_method=mosaic_method)
 
     ### WHITEBOX MOSAIC merge
-    if mosaic_backend == 'whitebox':
+    elif mosaic_backend == 'whitebox':
+        wbt = whitebox.WhiteboxTools()
+        print(wbt.version())
         ### DOCUMENTATION APPROACH, WITH TEST
         ### https://www.whiteboxgeo.com/manual/wbt_book/tutorials/mosaic.html
         wbt.verbose = False
         wbt.set_working_dir(input_folder) # ('/kaggle/working/tif_files/')
         if wbt.mosaic(output=output_mosaic_path, # '/kaggle/working/mosaic_whitebox.tif'
-                      method=mosaic_method) != 0:
+                      inputs=';'.join(input_files), method=mosaic_method) != 0:
             # Non-zero returns indicate an error.
             print('\t ERROR running mosaic')
         wbt.verbose = False
@@ -261,18 +670,18 @@ def mosaic_rastersized_lidar_files(input_folder=None, output_mosaic_path=None,
             !pip install rasterio
             import rasterio as rio
             from rasterio.merge import merge as rasterio_merge
-        # merge/append rasters (mosaic)
-        rasters_to_mosiac = []
-        for indx, file in enumerate(glob.glob(f'{input_folder}*.tif')):
-            print(indx, '\t', file)
-            raster = rio.open(file)
-            rasters_to_mosiac.append(raster)
-            print("The CRS of this data is:", rasters_to_mosiac[0].crs, rasters_to_mosiac[0].nodatavals)
-        ## check https://gis.stackexchange.com/questions/443652/rasterio-merge-creates-white-stripes-when-rasters-overlap-and-one-of-them-has-nu
-        mosaic, output = rasterio_merge(rasters_to_mosiac)
-
-        # save mosaic, double check metadata or rewrite it if needed
-        output_meta = raster.meta.copy()
+        # merge/append rasters (mosaic), handles are closed on exit
+        with contextlib.ExitStack() as stack:
+            rasters_to_mosiac = []
+            for indx, file in enumerate(input_files):
+                print(indx, '\t', file)
+                raster = stack.enter_context(rio.open(file))
+                rasters_to_mosiac.append(raster)
+                print("The CRS of this data is:", rasters_to_mosiac[0].crs, rasters_to_mosiac[0].nodatavals)
+            ## check https://gis.stackexchange.com/questions/443652/rasterio-merge-creates-white-stripes-when-rasters-overlap-and-one-of-them-has-nu
+            mosaic, output = rasterio_merge(rasters_to_mosiac)
+            # save mosaic, double check metadata or rewrite it if needed
+            output_meta = raster.meta.copy()
         output_meta.update({"driver": "GTiff",
                             "height": mosaic.shape[1],
                             "width": mosaic.shape[2],
@@ -292,8 +701,80 @@ def mosaic_rastersized_lidar_files(input_folder=None, output_mosaic_path=None,
         # del(mesh1, mesh2, mesh3, mesh4)
         # flip `x` and `y` axis if needed
 
+    if cache is not None and os.path.exists(output_mosaic_path):
+        cache.store('mosaic', input_files, cache_params, [output_mosaic_path])
+        cache.flush()
+
+def pipeline_lidar_files(input_folder=None, filtered_folder="/kaggle/working/filtered_files/",
+                         raster_folder="/kaggle/working/tif_files/", output_mosaic_path=None, filter_chain=None,
+                         raster_method='surface', gridding_params=None, halo=10., mosaic_method='nn',
+                         block_budget_mb=256, n_workers=1, max_tiles_in_flight=None, keep_filtered=True,
+                         input_files=None, run=False):
+    """Filters, rasterizes and mosaics LiDAR tiles in one pipeline, instead of stage after stage
+
+        Takes files in LAS or LAZ format (point clouds)
+        Creates filtered tiles, raster tiles and a mosaic (tiled GeoTIFF), returns result records of tiles
+
+        * Tiles flow through the stages on their own: a tile is rasterized once it and its halo neighbours
+            are filtered, a mosaic block is written once its tiles are rasterized, so stages overlap (CPU and I/O)
+            and intermediate files are bounded by `max_tiles_in_flight`. See `src.tile_pipeline`
+        * Same outputs as `filter_lidar_files` (numpy backend), `rasterize_lidar_files` (tiles mode) and
+            `mosaic_rastersized_lidar_files` (windowed backend), without the stage cache. The mosaic grid covers
+            input tiles, so it may have a margin of nodata where edge tiles were filtered away
+
+    Parameters
+    ----------
+    input_folder : str
+        description
+        example format : "/kaggle/working/laz_files/"
+    filtered_folder, raster_folder : str
+        folders of filtered tiles and of raster tiles
+    output_mosaic_path : str
+        path to output mosaic (.tif)
+    filter_chain : list
+        filter steps, see `src.point_filters.compile_filter_chain`
+    raster_method : str
+        `delaunay`, `surface` or `numpy`
+    gridding_params : dict
+        gridding params, f.e. {"resolution" : 1, "radius" : 0.8}
+    halo : float
+        width of the halo (CRS units) borrowed from neighbouring tiles
+    mosaic_method : str
+        resampling method, `nn`, `bilinear` or `cc`
+    block_budget_mb : float
+        memory budget of one output block
+    n_workers : int
+        number of worker processes, shared by all stages
+    max_tiles_in_flight : int or None
+        tiles being processed at once (filtered points kept on disk), `2 * n_workers` if None, raised to what
+        the tile grid needs to keep workers busy (`src.tile_pipeline.tiles_window`)
+    keep_filtered : bool
+        if keep filtered tiles after their neighbours are rasterized
+    input_files : list or None
+        files to process instead of all files of `input_folder`, f.e. tiles of a region of interest
+        (`src.tile_index.TileIndex.query`)
+    run : bool
+        if run function code
+    """
+    if not run:
+        return print('\tPipeline LiDAR files manually')
+
+    from src.lidar_io import glob_lidar_files, print_tiles_summary
+    from src.tile_pipeline import run_tile_pipeline
+
+    input_files = input_files if input_files is not None else glob_lidar_files(input_folder)
+    pipeline = run_tile_pipeline(input_files, filtered_folder, raster_folder, output_mosaic_path,
+                                 filter_chain=filter_chain, raster_method=raster_method, gridding_params=gridding_params,
+                                 halo=halo, mosaic_method=mosaic_method, block_budget_mb=block_budget_mb,
+                                 n_workers=n_workers, max_tiles_in_flight=max_tiles_in_flight, keep_filtered=keep_filtered)
+    print_tiles_summary(pipeline["filter"], stage='filter')
+    print_tiles_summary(pipeline["rasterize"], stage='rasterize')
+    gc.collect()
+    return pipeline
+
 def filter_mosaiced_raster_file(input_file=None, output_mosaic_path=None,
-                                method='median', filter_params=None, run=True):
+                                method='median', filter_params=None, filter_backend='whitebox',
+                                n_workers=1, block_size=1024, cache=None, run=True):
     """Filters rasters
         Selected method is `wbt.median_filter`. Feel free to experiment.
 
@@ -304,6 +785,10 @@ def filter_mosaiced_raster_file(input_file=None, output_mosaic_path=None,
             # https://www.whiteboxgeo.com/manual/wbt_book/available_tools/image_processing_tools_filters.html
             # https://www.whiteboxgeo.com/manual/wbt_book/available_tools/image_processing_tools_filters.html?highlight=Median#medianfilter
 
+        * .vrt mosaics are exported to a temporary GeoTIFF first, whitebox tools can't read VRT
+        * `numpy` backend filters blocks (with kernel halos) in parallel and reads .vrt lazily,
+            output doesn't depend on `block_size` or `n_workers`, see `src.raster_filters.filter_raster`
+
     Parameters
     ----------
     input_file : str
@@ -311,13 +796,47 @@ def filter_mosaiced_raster_file(input_file=None, output_mosaic_path=None,
     output_mosaic_path : str
         description
     method : str
-        description
+        `median`, `conservative_smoothing` or `bilateral`
+    filter_params : dict
+        params of the whitebox tool, the `numpy` backend takes the same ones
+    filter_backend : str
+        `whitebox` or `numpy`
+    n_workers : int
+        `numpy` only, number of worker processes
+    block_size : int
+        `numpy` only, side of a block in pixels
+    cache : src.stage_cache.StageCache or None
+        stage cache, no caching if None
     run : bool
         if run function code
     """
     if not run:
         return print('\tFilter moasaic file(s) manually (if needed)')
 
+    from src.raster_mosaic import materialized, vrt_sources
+
+    # a VRT is only a reference, its tiles are the real inputs
+    input_files = [input_file] + vrt_sources(input_file)
+    cache_params = {"method" : method, "filter_params" : filter_params, "filter_backend" : filter_backend}
+    if cache is not None:
+        hit, _ = cache.restore('filter_raster', input_files, cache_params, output_paths=[output_mosaic_path])
+        cache.flush() # only inputs are hashed
+        if hit:
+            return
+
+    if method not in ('median', 'conservative_smoothing', 'bilateral'):
+        return print('Method not avaliable.')
+
+    if filter_backend == 'numpy':
+        from src.raster_filters import filter_raster
+
+        filter_raster(input_file, output_mosaic_path, method=method, filter_params=filter_params,
+                      block_size=block_size, n_workers=n_workers)
+        if cache is not None:
+            cache.store('filter_raster', input_files, cache_params, [output_mosaic_path])
+            cache.flush()
+        return
+
     wbt = whitebox.WhiteboxTools()
     wbt.verbose = False
     print(wbt.version())
@@ -331,21 +850,32 @@ def filter_mosaiced_raster_file(input_file=None, output_mosaic_path=None,
     # # wbt.breach_depressions("smoothed.tif", "breached.tif")
     # # wbt.d_inf_flow_accumulation("breached.tif", "flow_accum.tif")
 
-    if method == 'median':
-        wbt.median_filter(i=input_file, output=output_mosaic_path, **filter_params) # 9,9,2 or 7,7,3 ?
-    elif method == 'conservative_smoothing':
-        wbt.conservative_smoothing_filter(i=input_file, output=output_mosaic_path, **filter_params)
-    elif method == 'bilateral':
-        wbt.bilateral_filter(i=input_file, output=output_mosaic_path, **filter_params)
-    else:
-        return print('Method not avaliable.')
+    with materialized(input_file) as raster_file:
+        if method == 'median':
+            wbt.median_filter(i=raster_file, output=output_mosaic_path, **filter_params) # 9,9,2 or 7,7,3 ?
+        elif method == 'conservative_smoothing':
+            wbt.conservative_smoothing_filter(i=raster_file, output=output_mosaic_path, **filter_params)
+        elif method == 'bilateral':
+            wbt.bilateral_filter(i=raster_file, output=output_mosaic_path, **filter_params)
+
+    if cache is not None:
+        cache.store('filter_raster', input_files, cache_params, [output_mosaic_path])
+        cache.flush()
 
-def _read_processed_rasterized_file(file_path=None, CUSTOM_READ=False):
+def _read_processed_rasterized_file(file_path=None, CUSTOM_READ=False, window_size=None, zoom=1., warp=False,
+                                    memmap_path=None):
     """Reads the raster file into a data structure needed for futher plots
 
         Takes path to raster mosaic
         Returns an object in `pyvista` format
 
+        * .vrt mosaics are read via rasterio into a uniform grid (`Tiff Scalars`, NaN for nodata),
+            VTK's GDAL reader isn't used for them
+        * With `window_size`, the coarsest overview level still matching the render window is read
+            (see `src.raster_mosaic.build_overviews`), previews and orbits load a fraction of cells
+        * `CUSTOM_READ` and rasterio reads hold about one float32 copy of the raster (plus warped points),
+            see `src.raster_mesh`, `src.benchmarks.benchmark_raster_mesh_memory` compares it with the xarray read
+
         * In theory, it should preserve coordinates, but it doesn't work as intended somewhy
             Maybe the reason is test's CRS - Florida's own CRS (Florida East State Plane)
             which we need to reproject
@@ -359,6 +889,14 @@ def _read_processed_rasterized_file(file_path=None, CUSTOM_READ=False):
         description
     CUSTOM_READ : bool
         description
+    window_size : list or None
+        render window size (f.e. [800, 800]) to pick an overview level for, full resolution if None
+    zoom : float
+        camera zoom relative to the view fitting the whole raster, with `window_size` only
+    warp : bool
+        if displace the grid by its values (3D surface, like `CUSTOM_READ`), rasterio reads only
+    memmap_path : str or None
+        .npy to read heights into (memory-mapped, reused while newer than the raster), in memory if None
     """
     ### CUSTOM APPROACH APPROACH TO READ A RASTER
     if CUSTOM_READ:
@@ -366,27 +904,20 @@ def _read_processed_rasterized_file(file_path=None, CUSTOM_READ=False):
         # https://banesullivan.com/pyvista/examples/geological-map.html
         # https://github.com/pyvista/pyvista-support/issues/205
 
-        import pyvista as pv
-        import xarray as xr
-        import numpy as np
-
-        """
-        Helpful: http://xarray.pydata.org/en/stable/auto_gallery/plot_rasterio.html
-        """
-        # Read in the data
-        data = xr.open_rasterio(file_path)
-        values = np.asarray(data)
-        nans = values == data.nodatavals
-        if np.any(nans):
-            # values = np.ma.masked_where(nans, values)
-            values[nans] = np.nan
-        # Make a mesh
-        xx, yy = np.meshgrid(data['x'], data['y'])
-        zz = values.reshape(xx.shape) # will make z-comp the values in the file
-        # zz = np.zeros_like(xx) # or this will make it flat
-        mesh = pv.StructuredGrid(xx, yy, zz)
-        mesh['data'] = values.ravel(order='F')
-        return mesh
+        from src.raster_mesh import read_raster_mesh
+
+        # float32 heights in one (optionally memory-mapped) buffer, grid from origin and spacing,
+        # no meshgrid coordinates, 3D surface by warping the grid with heights
+        return read_raster_mesh(file_path, memmap_path=memmap_path, scalars_name='data', warp=True)
+
+    ### LEVEL OF DETAIL (OVERVIEW) OR VIRTUAL MOSAIC (VRT), READ VIA RASTERIO
+    elif window_size is not None or file_path.lower().endswith('.vrt'):
+        from src.raster_mesh import read_raster_mesh
+        from src.raster_mosaic import overview_factor
+
+        factor = overview_factor(file_path, window_size, zoom) if window_size is not None else 1
+        print(f"\t{datetime.datetime.now()} Read {file_path}, overview factor {factor}")
+        return read_raster_mesh(file_path, factor=factor, memmap_path=memmap_path, warp=warp)
 
     ### DEFAULT PYVISTA APPROACH TO READ A RASTER
     else:
@@ -406,60 +937,144 @@ def _main_get_data():
     """Run through cities list
         create, filter, and mosaic rasters from point clouds
     """
+    from src.lidar_io import glob_lidar_files
+    from src.point_filters import filter_chain_from_params
+    from src.profiling import Profiler, configure_logging, set_profiler, span
+    from src.stage_cache import StageCache
+    from src.tile_index import TileIndex, tile_crs
+
+    configure_logging(LOG_LEVEL)
+    profiler = set_profiler(Profiler(os.path.join(PROFILE_DIR, 'get_data.jsonl') if PROFILE_DIR else None))
     print('Create folders')
     _create_folders_structure()
+    # re-runs restore unchanged tiles and stages, keyed by input hashes and stage params
+    cache = StageCache(cache_dir=STAGE_CACHE_DIR, max_size_gb=50.) if STAGE_CACHE_DIR else None
+    tile_index = TileIndex(TILE_INDEX_PATH)
 
     for key in DATA_LINKS.keys():
         print(f'CITY : {key}')
+        region = REGIONS_OF_INTEREST.get(key)
+        # stages take tiles of the region only, headers of new tiles are indexed on the way
+        select_tiles = lambda files: tile_index.query(files, **region) if region else files
 
         print('Download')
-        download_lidar_files(links=DATA_LINKS[key], run=False)
+        with span(f'{key} download'):
+            download_lidar_files(links=DATA_LINKS[key], run=False)
         gc.collect()
 
         print('Decompress LAZ')
-        decompress_laz_files(input_folder="/kaggle/working/laz_files/", run=False)
+        # stages read LAZ directly, LAS round-trip is an opt-in fallback only
+        with span(f'{key} decompress'):
+            results = decompress_laz_files(input_folder="/kaggle/working/laz_files/", output_folder="/kaggle/working/las_files/",
+                                           n_workers=os.cpu_count(), max_memory_mb=4096, n_retries=1,
+                                           input_files=select_tiles(glob.glob("/kaggle/working/laz_files/*.laz")),
+                                           run=LAS_FALLBACK)
+        profiler.add_task_records('decompress tile', results or [])
+        lidar_folder = "/kaggle/working/las_files/" if LAS_FALLBACK else "/kaggle/working/laz_files/"
         gc.collect()
 
-        print('Show LiDAR file information summary')
-        wbt = whitebox.WhiteboxTools()
-        # for lidar_file_fp in glob.glob("/kaggle/working/las_files/*"):
-        #     print(lidar_file_fp)
-        wbt.lidar_info(i=glob.glob("/kaggle/working/las_files/*")[1],
-                       output="/kaggle/working/info.html",
-                       density=True, vlr=True, geokeys=True)
+        print('Store points as columns')
+        # one decompression per tile, summarize and filter (two passes with outliers) map columns they need
+        lidar_files = select_tiles(glob_lidar_files(lidar_folder))
+        with span(f'{key} point store'):
+            store_paths = store_lidar_files(output_folder="/kaggle/working/point_store/", n_workers=os.cpu_count(),
+                                            input_files=lidar_files, run=POINT_STORE)
+        lidar_files = store_paths or lidar_files
+        gc.collect()
 
-        del wbt
+        print('Show LiDAR file information summary')
+        # all tiles, machine-readable, instead of `wbt.lidar_info(i=..., output="info.html", density=True)` of one tile
+        with span(f'{key} summarize'):
+            lidar_info = summarize_lidar_files(output_path=f"/kaggle/working/{key}_lidar_info.json",
+                                               n_workers=os.cpu_count(), input_files=lidar_files, run=True)
+        profiler.add_task_records('summarize tile', lidar_info["tile_statistics"])
 
         print('Filter outliers in point clouds)')
         filter_outliers_params = {"radius" : 4, "elev_diff" : 15, "use_median" : True, "classify" : False}
-        filter_lidar_files(input_folder="/kaggle/working/las_files/",
-                   filter_classes=False, exclude_cls="0,7,18", # 3,4,5 Low/Medium/High Vegetation # try 1 - ""3,5,7,14", try 2 - add 1, 18
-                   filter_outliers=True, filter_outliers_params=filter_outliers_params,
-                   run=True)
+        with span(f'{key} filter points'):
+            filter_lidar_files(input_folder=lidar_folder, output_folder="/kaggle/working/filtered_files/",
+                       filter_classes=False, exclude_cls="0,7,18", # 3,4,5 Low/Medium/High Vegetation # try 1 - ""3,5,7,14", try 2 - add 1, 18
+                       filter_outliers=True, filter_outliers_params=filter_outliers_params,
+                       # one streaming pass per tile, z range could join it, f.e. filter_chain=[..., {"filter" : "z_range", "minz" : 0, "maxz" : 80}]
+                       filter_backend='numpy', cache=cache, input_files=lidar_files, run=not PIPELINED)
         gc.collect()
 
+        points_folder = "/kaggle/working/filtered_files/"
+        point_files = select_tiles(glob_lidar_files(points_folder))
+        if key in CLIP_FOOTPRINTS and not PIPELINED:
+            print('Clip point clouds to footprints')
+            with span(f'{key} clip points'):
+                results = clip_lidar_files(input_folder=points_folder, output_folder="/kaggle/working/clipped_files/",
+                                           **CLIP_FOOTPRINTS[key], n_workers=os.cpu_count(), cache=cache,
+                                           input_files=point_files, run=True)
+            profiler.add_task_records('clip tile', results)
+            # tiles outside footprints have no output, they aren't rasterized
+            points_folder = "/kaggle/working/clipped_files/"
+            point_files = [result["output"] for result in results if result["output"]]
+            gc.collect()
+
         print('Rasterize point clouds)')
         gridding_params = {"resolution" : 1, "exclude_cls" : "18,19"} # exclude_cls='3,4,5,7,8,9,13,14,15,16,18,19'
         gridding_params = {"resolution" : 1, "radius" : 0.8} #, minz=0, maxz=80
-        rasterize_lidar_files(input_folder="/kaggle/working/las_files/", raster_method="surface",
-                              gridding_params=gridding_params, run=True) # method="surface" or "delaunay"
+        if AUTO_GRIDDING_PARAMS and lidar_info["suggested_gridding_params"]:
+            gridding_params = {**gridding_params, **lidar_info["suggested_gridding_params"]}
+        with span(f'{key} rasterize'):
+            results = rasterize_lidar_files(input_folder=points_folder, raster_method="surface",
+                                            gridding_params=gridding_params, processing_mode='tiles', halo=10.,
+                                            n_workers=os.cpu_count(), cache=cache,
+                                            input_files=point_files, run=not PIPELINED) # method="surface" or "delaunay"
+        profiler.add_task_records('rasterize tile', results or [])
         gc.collect()
 
         print('Mosaic')
-        mosaic_backend = 'whitebox'
+        mosaic_backend = 'windowed' # tiled GeoTIFF written block by block, 'whitebox' or 'rasterio' hold the whole mosaic
         output_mosaic_path = f'/kaggle/working/{key}_mosaic_{mosaic_backend}_bilinear.tif'
         # Uses the nearest-neighbour resampling method (i.e. nn). Cubic convolution (i.e. cc) and bilinear interpolation (i.e. bilinear) are other options.
-        mosaic_rastersized_lidar_files(input_folder="/kaggle/working/tif_files/",
-                               output_mosaic_path=output_mosaic_path,
-                               mosaic_backend=mosaic_backend,
-                               mosaic_method="nn",
-                               run=True)
+        with span(f'{key} mosaic', backend=mosaic_backend):
+            mosaic_rastersized_lidar_files(input_folder="/kaggle/working/tif_files/",
+                                   output_mosaic_path=output_mosaic_path,
+                                   mosaic_backend=mosaic_backend,
+                                   mosaic_method="nn",
+                                   # rasters of this run only, tif_files/ may keep tiles clipped away since
+                                   input_files=[result["output"] for result in results or [] if result["success"]],
+                                   cache=cache, run=not PIPELINED)
         gc.collect()
 
+        print('Filter, clip, rasterize and mosaic in a pipeline')
+        # replaces the stages above (which skip themselves), tiles flow through stages as soon as they're ready
+        filter_chain = filter_chain_from_params(filter_outliers_params=filter_outliers_params)
+        pipeline_files = select_tiles(glob_lidar_files(lidar_folder))
+        if key in CLIP_FOOTPRINTS and PIPELINED and pipeline_files: # no tiles of the region, nothing to clip
+            filter_chain.append({"filter" : "clip_polygons", **CLIP_FOOTPRINTS[key], "crs" : tile_crs(pipeline_files[0])})
+        with span(f'{key} pipeline'):
+            pipeline = pipeline_lidar_files(output_mosaic_path=output_mosaic_path, filter_chain=filter_chain,
+                                            raster_method="surface", gridding_params=gridding_params, halo=10.,
+                                            mosaic_method="nn", n_workers=os.cpu_count(),
+                                            max_tiles_in_flight=None, input_files=pipeline_files, run=PIPELINED)
+        if pipeline:
+            profiler.add_task_records('filter tile', pipeline["filter"])
+            profiler.add_task_records('rasterize tile', pipeline["rasterize"])
+
         print('Filter raster')
         output_filtered_mosaic_path = f'/kaggle/working/{key}_{mosaic_backend}_bilinear_filtered.tif'
         filter_params = {"filterx" : 9, "filtery" : 9, "sig_digits" : 2}
-        filter_mosaiced_raster_file(input_file="/kaggle/working/riga_center.tif",
-                            output_mosaic_path=output_filtered_mosaic_path,
-                            method="median", filter_params=filter_params, run=True)
+        with span(f'{key} filter raster'):
+            filter_mosaiced_raster_file(input_file=output_mosaic_path,
+                                output_mosaic_path=output_filtered_mosaic_path,
+                                method="median", filter_params=filter_params,
+                                filter_backend='numpy', n_workers=os.cpu_count(), cache=cache, run=True)
+        gc.collect()
+
+        print('Build raster overviews')
+        # previews and orbits read a coarser level, full resolution is kept for the biggest stills
+        from src.raster_mosaic import build_overviews
+
+        with span(f'{key} overviews'):
+            build_overviews(output_filtered_mosaic_path, factors=(2, 4, 8, 16, 32))
         gc.collect()
+
+        if cache is not None:
+            cache.print_stats()
+
+    if PROFILE_DIR:
+        profiler.write_chrome_trace(os.path.join(PROFILE_DIR, 'get_data_trace.json'))
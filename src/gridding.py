@@ -0,0 +1,196 @@
+"""
+Native NumPy gridding of LiDAR points into DSM rasters, alternative to whitebox gridding tools.
+    * Points are consumed in chunks and binned into accumulator grids, memory is bounded by grid size
+    * Statistics : `max` (highest return), `mean`, `idw` (inverse distance weighting within `radius`)
+    * Optional gap filling with a Delaunay TIN (scipy) over valid cells bordering gaps
+"""
+import math
+
+import numpy as np
+
+NODATA = -32768.
+GRIDDING_PARAMS = ('resolution', 'statistic', 'radius', 'idw_power', 'fill_gaps', 'chunk_size')
+
+def grid_lidar_points(point_sources=None, bounds=None, resolution=1., statistic='max', radius=None,
+                      idw_power=2., fill_gaps=False, chunk_size=None):
+    """Bins points of LAS/LAZ files into a grid
+
+        Takes files (with optional clip bounds) and grid bounds
+        Returns a float32 grid (rows from north to south), NODATA for empty cells
+
+        Logic:
+        - 1. FOR EVERY CHUNK OF POINTS: CELL INDEX = FLOOR((X - MINX) / RES), FLOOR((MAXY - Y) / RES)
+        - 2. ACCUMULATE INTO PREALLOCATED GRIDS `max` (np.maximum.at), `mean` (np.add.at of sums and counts)
+             OR `idw` (for every cell offset within `radius`, np.add.at of weights and weighted z)
+        - 3. IF `fill_gaps` THEN INTERPOLATE EMPTY CELLS LINEARLY OVER DELAUNAY TIN OF VALID CELLS BORDERING THEM
+
+    Parameters
+    ----------
+    point_sources : list
+        tuples (path to .las/.laz or a point store, bounds to keep points within or None)
+    bounds : tuple
+        grid bounds (minx, miny, maxx, maxy), multiples of `resolution`
+    resolution : float
+        cell size
+    statistic : str
+        `max`, `mean` or `idw`
+    radius : float or None
+        `idw` search radius, `resolution` if None
+    idw_power : float
+        `idw` power of inverse distance
+    fill_gaps : bool
+        if fill empty cells by TIN interpolation
+    chunk_size : int or None
+        number of points per chunk
+    """
+    from src.lidar_io import DEFAULT_CHUNK_SIZE, iter_lidar_chunks
+
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    minx, miny, maxx, maxy = bounds
+    width, height = int(round((maxx - minx) / resolution)), int(round((maxy - miny) / resolution))
+    size = width * height
+    radius = resolution if radius is None else radius
+    if statistic == 'max':
+        grid = np.full(size, -np.inf)
+    else:
+        sums, weights = np.zeros(size), np.zeros(size)
+
+    for path, clip_bounds in point_sources:
+        for points in iter_lidar_chunks(path, chunk_size, columns=('x', 'y', 'z')):
+            x, y, z = np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+            if clip_bounds is not None:
+                inside = (x >= clip_bounds[0]) & (x <= clip_bounds[2]) & (y >= clip_bounds[1]) & (y <= clip_bounds[3])
+                x, y, z = x[inside], y[inside], z[inside]
+            cols = np.floor((x - minx) / resolution).astype(np.int64)
+            rows = np.floor((maxy - y) / resolution).astype(np.int64)
+
+            if statistic in ('max', 'mean'):
+                valid = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+                cells = rows[valid] * width + cols[valid]
+                if statistic == 'max':
+                    np.maximum.at(grid, cells, z[valid])
+                else:
+                    np.add.at(sums, cells, z[valid])
+                    np.add.at(weights, cells, 1.)
+            elif statistic == 'idw':
+                reach = int(math.ceil(radius / resolution))
+                for row_offset in range(-reach, reach + 1):
+                    for col_offset in range(-reach, reach + 1):
+                        cell_rows, cell_cols = rows + row_offset, cols + col_offset
+                        centre_x = minx + (cell_cols + 0.5) * resolution
+                        centre_y = maxy - (cell_rows + 0.5) * resolution
+                        distance = np.hypot(x - centre_x, y - centre_y)
+                        valid = ((distance <= radius) & (cell_cols >= 0) & (cell_cols < width) &
+                                 (cell_rows >= 0) & (cell_rows < height))
+                        cells = cell_rows[valid] * width + cell_cols[valid]
+                        weight = 1. / np.maximum(distance[valid], 1e-6) ** idw_power
+                        np.add.at(sums, cells, weight * z[valid])
+                        np.add.at(weights, cells, weight)
+            else:
+                raise ValueError(f"Unknown gridding statistic : {statistic}")
+
+    if statistic == 'max':
+        grid[np.isinf(grid)] = NODATA
+    else:
+        grid = np.where(weights > 0, sums / np.maximum(weights, 1e-12), NODATA)
+        del sums, weights
+    grid = grid.reshape(height, width).astype(np.float32)
+
+    if fill_gaps:
+        grid = fill_gaps_tin(grid)
+    return grid
+
+def fill_gaps_tin(grid=None):
+    """Fills NODATA cells enclosed by valid cells, linearly over a Delaunay TIN (scipy)
+
+        * Only valid cells bordering gaps (8-connected) are triangulated, not the whole grid
+    """
+    from scipy.interpolate import LinearNDInterpolator
+    from scipy.ndimage import binary_dilation
+
+    empty = grid == NODATA
+    if not empty.any() or empty.all():
+        return grid
+    border = binary_dilation(empty, structure=np.ones((3, 3), dtype=bool)) & ~empty
+    valid_rows, valid_cols = np.nonzero(border)
+    interpolator = LinearNDInterpolator(np.column_stack((valid_rows, valid_cols)), grid[border],
+                                        fill_value=NODATA)
+    empty_rows, empty_cols = np.nonzero(empty)
+    grid[empty_rows, empty_cols] = interpolator(np.column_stack((empty_rows, empty_cols)))
+    return grid
+
+def lidar_crs(file_path=None):
+    """Returns CRS of a LAS/LAZ file (or a point store) as `rasterio.crs.CRS`, None if it isn't stored or can't be parsed"""
+    import laspy
+    from rasterio.crs import CRS
+    from src.point_store import is_point_store, read_store_meta
+
+    if is_point_store(file_path):
+        wkt = read_store_meta(file_path)["crs"]
+        return CRS.from_wkt(wkt) if wkt else None
+    with laspy.open(file_path) as reader:
+        try:
+            crs = reader.header.parse_crs()
+        except Exception: # pyproj isn't installed, or broken VLRs
+            return None
+    return CRS.from_wkt(crs.to_wkt()) if crs is not None else None
+
+def write_geotiff(output_path=None, grid=None, bounds=None, resolution=1., crs=None):
+    """Writes a float32 grid into a tiled, compressed GeoTIFF"""
+    import rasterio
+    from rasterio.transform import from_origin
+
+    profile = {"driver" : "GTiff", "width" : grid.shape[1], "height" : grid.shape[0], "count" : 1,
+               "dtype" : "float32", "nodata" : NODATA, "crs" : crs,
+               "transform" : from_origin(bounds[0], bounds[3], resolution, resolution),
+               "tiled" : True, "blockxsize" : 256, "blockysize" : 256, "compress" : "deflate"}
+    with rasterio.open(output_path, "w", **profile) as dst:
+        dst.write(grid, 1)
+
+def check_gridding_params(gridding_params=None):
+    """Raises ValueError if `gridding_params` have keys `grid_lidar_points` doesn't take (f.e. whitebox `exclude_cls`)"""
+    unsupported = sorted(set(gridding_params) - set(GRIDDING_PARAMS))
+    if unsupported:
+        raise ValueError(f"gridding params {unsupported} aren't supported by `numpy` gridding, it takes {list(GRIDDING_PARAMS)}"
+                         " (filter classes or z range with `src.point_filters` before gridding)")
+
+def rasterize_tile_numpy(tile=None, neighbours=None, output_path=None, gridding_params=None, halo=0.):
+    """Grids a tile (plus halo points of its neighbours) onto the global grid cropped to the tile extent
+
+        * No temporary point files, neighbours' points are streamed and clipped to the halo on the fly
+        * With `fill_gaps`, the grid covers the halo too and is cropped after filling, so gaps near tile edges
+            are interpolated from points of neighbours as well
+
+    Parameters
+    ----------
+    tile : dict
+        tile to rasterize, record of `src.tile_index.build_tile_index`
+    neighbours : list
+        tiles overlapping the tile extent grown by `halo`
+    output_path : str
+        path to output .tif
+    gridding_params : dict
+        params of `grid_lidar_points`, f.e. {"resolution" : 1, "statistic" : "idw", "radius" : 1.5, "fill_gaps" : True}
+    halo : float
+        halo width in CRS units
+    """
+    from src.tile_index import expand_bounds
+    from src.tile_rasterizer import halo_grid_bounds, snap_bounds
+
+    check_gridding_params(gridding_params)
+    resolution = gridding_params.get("resolution", 1.)
+    fill_gaps = gridding_params.get("fill_gaps", False)
+    bounds = snap_bounds(tile["bounds"], resolution)
+    halo_bounds = expand_bounds(tile["bounds"], halo)
+    point_sources = [(tile["path"], None)] + [(neighbour["path"], halo_bounds)
+                                             for neighbour in sorted(neighbours, key=lambda neighbour: neighbour["path"])
+                                             if neighbour["path"] != tile["path"]]
+    grid_bounds = halo_grid_bounds(bounds, halo, resolution) if fill_gaps else bounds
+    grid = grid_lidar_points(point_sources, grid_bounds, **{**gridding_params, "fill_gaps" : False})
+    if fill_gaps: # fill with halo cells, then crop to the tile
+        grid = fill_gaps_tin(grid)
+        row, col = int(round((grid_bounds[3] - bounds[3]) / resolution)), int(round((bounds[0] - grid_bounds[0]) / resolution))
+        grid = grid[row:row + int(round((bounds[3] - bounds[1]) / resolution)),
+                    col:col + int(round((bounds[2] - bounds[0]) / resolution))]
+    write_geotiff(output_path, grid, bounds, resolution, crs=lidar_crs(tile["path"]))
+    return int((grid != NODATA).sum())
@@ -0,0 +1,237 @@
+"""
+Streaming helpers to read and write LiDAR point clouds (LAS/LAZ) chunk by chunk.
+    * Memory is bounded by `chunk_size`, not by the number of points in a tile
+    * Functions are kept at module level, so they can be sent to worker processes
+"""
+import contextlib
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+DEFAULT_CHUNK_SIZE = 1_000_000 # points per chunk, ~ 30-40 MB for common point formats
+
+def _set_memory_limit(max_memory_mb=None):
+    """Limits address space of the current (worker) process
+
+        * Used as `initializer` of process pools, so one huge tile can't take the whole machine down.
+            The tile fails with `MemoryError` instead, and may be retried.
+
+    Parameters
+    ----------
+    max_memory_mb : int or None
+        limit in megabytes, no limit if None
+    """
+    if not max_memory_mb:
+        return
+    import resource
+
+    limit = int(max_memory_mb * 1024 ** 2)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def decompress_laz_file(input_path=None, output_path=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                        n_retries=1, delete_input=True):
+    """Decompresses (unlaz) one LAZ file into LAS, streaming a fixed-size chunk at a time
+
+        Takes a path to a file in LAZ format
+        Returns a result record of the tile (never raises, errors are reported in the record)
+
+        Logic:
+        - 1. OPEN .LAZ READER AND .LAS WRITER WITH THE SAME HEADER
+        - 2. COPY POINTS CHUNK BY CHUNK (`chunk_size` POINTS IN MEMORY AT MOST)
+        - 3. IF FAILED THEN REMOVE PARTIAL OUTPUT AND RETRY (`n_retries` TIMES)
+        - 4. IF SUCCEEDED THEN DELETE INPUT (IF `delete_input`)
+
+    Parameters
+    ----------
+    input_path : str
+        path to .laz file
+    output_path : str
+        path to .las file
+    chunk_size : int
+        number of points read and written per iteration
+    n_retries : int
+        how many times to retry the tile after a failure
+    delete_input : bool
+        if delete the .laz file after successful decompression
+    """
+    import laspy
+
+    result = {"file" : input_path, "output" : output_path, "success" : False, "bytes_in" : 0, "bytes_out" : 0,
+              "wall_time" : 0., "attempts" : 0, "error" : None, "started_at" : time.time(), "pid" : os.getpid()}
+    start = time.perf_counter()
+    for attempt in range(1, n_retries + 2):
+        result["attempts"] = attempt
+        try:
+            result["bytes_in"] = os.path.getsize(input_path) # a missing tile is a failed tile
+            with laspy.open(input_path, laz_backend=detect_laz_backend()) as reader:
+                with laspy.open(output_path, mode="w", header=reader.header, do_compress=False) as writer:
+                    for points in reader.chunk_iterator(chunk_size):
+                        writer.write_points(points)
+            result["success"], result["error"] = True, None
+            break
+        except Exception as error: # f.e. MemoryError when worker memory limit is hit, corrupted chunk
+            result["error"] = f"{type(error).__name__}: {error}"
+            if os.path.exists(output_path):
+                os.remove(output_path)
+
+    result["wall_time"] = time.perf_counter() - start
+    if result["success"]:
+        result["bytes_out"] = os.path.getsize(output_path)
+        if delete_input:
+            os.remove(input_path)
+    return result
+
+def failed_tile_result(file_path=None, output_path=None, error=None):
+    """Returns a result record of a tile whose worker didn't return one (f.e. `BrokenProcessPool`, the worker was killed)"""
+    return {"file" : file_path, "output" : output_path, "success" : False, "bytes_in" : 0, "bytes_out" : 0,
+            "wall_time" : 0., "error" : f"{type(error).__name__}: {error}"}
+
+def print_tiles_summary(results=None, stage=''):
+    """Prints per-tile results of a stage and totals
+
+        Takes result records (dicts with `file`, `success`, `bytes_in`, `bytes_out`, `wall_time`)
+
+    Parameters
+    ----------
+    results : list
+        result records of tiles
+    stage : str
+        name of a stage, used in a header of the summary
+    """
+    print(f"\t{datetime.datetime.now()} Summary {stage} : {len(results)} tiles")
+    for result in sorted(results, key=lambda result: result["file"]):
+        status = "OK  " if result["success"] else "FAIL"
+        print(f"\t\t{status} {os.path.basename(result['file'])} "
+              f"{result['bytes_in'] / 1024 ** 2:.1f} MB -> {result['bytes_out'] / 1024 ** 2:.1f} MB "
+              f"{result['wall_time']:.1f} s" + (f" ({result['error']})" if result.get("error") else ""))
+
+    succeeded = [result for result in results if result["success"]]
+    bytes_in = sum(result["bytes_in"] for result in succeeded)
+    bytes_out = sum(result["bytes_out"] for result in succeeded)
+    print(f"\t\tsucceeded : {len(succeeded)}, failed : {len(results) - len(succeeded)}")
+    print(f"\t\tbytes in : {bytes_in / 1024 ** 2:.1f} MB, bytes out : {bytes_out / 1024 ** 2:.1f} MB, "
+          f"tiles time : {sum(result['wall_time'] for result in results):.1f} s")
+
+def glob_lidar_files(input_folder=None):
+    """Lists LiDAR point cloud files (both .las and .laz) of a folder
+
+    Parameters
+    ----------
+    input_folder : str
+        example format : "/kaggle/working/laz_files/"
+    """
+    import glob
+
+    return sorted(glob.glob(f'{input_folder}*.las') + glob.glob(f'{input_folder}*.laz'))
+
+def detect_laz_backend():
+    """Returns the preferred available `laspy.LazBackend` (parallel `lazrs` first), None if there is no backend
+
+        * Parallel `lazrs` is taken in the main process only. Its thread pool doesn't survive a fork, a forked worker
+            waiting on it hangs, and workers process tiles in parallel anyway, so they take a single-threaded backend
+    """
+    import multiprocessing
+    import laspy
+
+    available = laspy.LazBackend.detect_available()
+    if multiprocessing.parent_process() is not None:
+        available = [backend for backend in available if backend != laspy.LazBackend.LazrsParallel]
+    return available[0] if available else None
+
+def iter_lidar_chunks(file_path=None, chunk_size=DEFAULT_CHUNK_SIZE, laz_backend=None, columns=None):
+    """Iterates over points of a LAS or LAZ file, `chunk_size` points at a time
+
+        * LAZ is decompressed in memory by `laspy.LazBackend`, decompressed points never touch disk
+        * Point stores (`src.point_store`) are read from their memory-mapped columns, only `columns` of them
+
+    Parameters
+    ----------
+    file_path : str
+        path to .las or .laz file, or to a point store
+    chunk_size : int
+        number of points per chunk
+    laz_backend : laspy.LazBackend or None
+        backend to decompress LAZ, `detect_laz_backend()` if None
+    columns : tuple or None
+        attributes a stage reads, f.e. ('x', 'y', 'z'), all if None. LAS/LAZ chunks always have all of them
+    """
+    import laspy
+    from src.point_store import is_point_store, iter_point_store
+
+    if is_point_store(file_path):
+        yield from iter_point_store(file_path, columns=columns, chunk_size=chunk_size)
+        return
+    with laspy.open(file_path, laz_backend=laz_backend or detect_laz_backend()) as reader:
+        for points in reader.chunk_iterator(chunk_size):
+            yield points
+
+def read_lidar_header(file_path=None):
+    """Returns `laspy.LasHeader` of a LAS/LAZ file, or of the source tile of a point store (see `src.point_store.store_header`)"""
+    import laspy
+    from src.point_store import is_point_store, read_store_meta, store_header
+
+    if is_point_store(file_path):
+        return store_header(read_store_meta(file_path))
+    with laspy.open(file_path) as reader:
+        return reader.header
+
+def stream_filter_lidar_file(input_path=None, output_path=None, keep_mask=None,
+                             chunk_size=DEFAULT_CHUNK_SIZE, laz_backend=None):
+    """Writes points of `input_path` selected by `keep_mask` into `output_path`, chunk by chunk
+
+        * Output is compressed if `output_path` ends with .laz
+
+    Parameters
+    ----------
+    input_path : str
+        path to .las or .laz file
+    output_path : str
+        path to output .las or .laz file
+    keep_mask : callable
+        takes a chunk of points, returns a boolean array, True for points to keep
+    chunk_size : int
+        number of points per chunk
+    laz_backend : laspy.LazBackend or None
+        backend to (de)compress LAZ, `detect_laz_backend()` if None
+    """
+    import laspy
+
+    laz_backend = laz_backend or detect_laz_backend()
+    n_kept = 0
+    with laspy.open(input_path, laz_backend=laz_backend) as reader:
+        with laspy.open(output_path, mode="w", header=reader.header, laz_backend=laz_backend) as writer:
+            for points in reader.chunk_iterator(chunk_size):
+                mask = keep_mask(points)
+                writer.write_points(points[mask])
+                n_kept += int(mask.sum())
+    return n_kept
+
+@contextlib.contextmanager
+def las_fallback(file_path=None, enabled=True):
+    """Yields a path to a LAS version of a LiDAR file (context manager)
+
+        * For tools which can't read LAZ. Only then LAZ is decompressed into a temporary LAS,
+            which is removed on exit. LAS files are passed through as they are
+
+    Parameters
+    ----------
+    file_path : str
+        path to .las or .laz file
+    enabled : bool
+        if False, `file_path` is yielded as it is
+    """
+    if not enabled or not file_path.lower().endswith('.laz'):
+        yield file_path
+        return
+
+    temp_dir = tempfile.mkdtemp(prefix='las_fallback_')
+    try:
+        output_path = os.path.join(temp_dir, os.path.basename(file_path)[:-4] + '.las')
+        result = decompress_laz_file(file_path, output_path, delete_input=False)
+        if not result["success"]:
+            raise RuntimeError(f"LAS fallback failed for {file_path}: {result['error']}")
+        yield output_path
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
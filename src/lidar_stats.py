@@ -0,0 +1,223 @@
+"""
+Summary statistics of LiDAR tiles, in-process alternative to `wbt.lidar_info`.
+    * One streamed pass over points of a tile (chunk by chunk, tiles in parallel processes) accumulates
+        counts, a density grid, a class histogram and a z histogram, memory is bounded by grid sizes
+    * Z percentiles come from a histogram of fixed-width bins aligned to 0, so tiles merge into dataset percentiles
+    * Dataset density drives suggested gridding params (`resolution`, `radius`), see `suggest_gridding_params`
+    * Tables go to JSON (dataset and tiles), and to Parquet (tiles) if pandas with a Parquet engine is installed,
+        density grids of tiles to .npy files next to them (points per cell, rows from north to south)
+"""
+import datetime
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+Z_BIN_SIZE = 0.1
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+NICE_RESOLUTIONS = (0.1, 0.25, 0.5, 1., 2., 5., 10.)
+POINTS_PER_RADIUS = 4 # points expected within the gridding search radius
+
+def _histogram_percentiles(counts=None, first_bin=0, bin_size=Z_BIN_SIZE, percentiles=PERCENTILES):
+    """Returns percentiles (dict) of values binned into `counts`, bins start at `first_bin * bin_size`"""
+    total = counts.sum()
+    if not total:
+        return {str(percentile) : None for percentile in percentiles}
+    cumulative = np.cumsum(counts)
+    positions = np.searchsorted(cumulative, [total * percentile / 100. for percentile in percentiles])
+    return {str(percentile) : round(float((first_bin + position + 0.5) * bin_size), 3)
+            for percentile, position in zip(percentiles, positions)}
+
+def tile_statistics(file_path=None, cell_size=10., bin_size=Z_BIN_SIZE, chunk_size=None, density_path=None):
+    """Returns statistics of a tile (a record), in one streamed pass over its points
+
+        * `density` is points per square unit over occupied cells of `cell_size` (holes, water don't dilute it),
+            `density_percentiles` are over occupied cells, `first_return_density` counts first returns only
+        * `z_histogram` (first bin and counts) is kept for `dataset_statistics`
+        * `density_grid` is a path to the density grid (.npy of points per cell, rows from north to south,
+            first cell at the north-west corner of `bounds`), if `density_path` is given
+
+    Parameters
+    ----------
+    file_path : str
+        path to .las or .laz file, or to a point store
+    cell_size : float
+        cell size of the density grid
+    bin_size : float
+        z histogram bin size
+    chunk_size : int or None
+        number of points per chunk, `src.lidar_io.DEFAULT_CHUNK_SIZE` if None
+    density_path : str or None
+        path to a .npy to write the density grid to, not written if None
+    """
+    from src.lidar_io import DEFAULT_CHUNK_SIZE, iter_lidar_chunks
+    from src.tile_index import lidar_tile_bounds
+
+    started_at, start = time.time(), time.perf_counter()
+    bounds, _ = lidar_tile_bounds(file_path)
+    n_columns = max(1, math.ceil((bounds[2] - bounds[0]) / cell_size))
+    n_rows = max(1, math.ceil((bounds[3] - bounds[1]) / cell_size))
+    density_grid = np.zeros(n_columns * n_rows, dtype=np.int64)
+    class_counts = np.zeros(256, dtype=np.int64)
+    z_counts, z_first_bin = np.zeros(0, dtype=np.int64), None
+    n_points, n_first_returns, z_sum = 0, 0, 0.
+
+    for points in iter_lidar_chunks(file_path, chunk_size or DEFAULT_CHUNK_SIZE,
+                                    columns=('x', 'y', 'z', 'classification', 'return_number')):
+        x, y, z = np.asarray(points.x), np.asarray(points.y), np.asarray(points.z)
+        columns = np.clip(((x - bounds[0]) / cell_size).astype(np.int64), 0, n_columns - 1)
+        rows = np.clip(((y - bounds[1]) / cell_size).astype(np.int64), 0, n_rows - 1)
+        density_grid += np.bincount(rows * n_columns + columns, minlength=len(density_grid))
+        class_counts += np.bincount(np.asarray(points.classification, dtype=np.int64), minlength=256)[:256]
+        return_number = getattr(points, 'return_number', None)
+        n_first_returns += int((np.asarray(return_number) <= 1).sum()) if return_number is not None else len(z)
+
+        bins = np.floor(z / bin_size).astype(np.int64)
+        if len(bins):
+            low, high = int(bins.min()), int(bins.max())
+            if z_first_bin is None:
+                z_first_bin = low
+            if low < z_first_bin: # grow the histogram to the left
+                z_counts = np.concatenate((np.zeros(z_first_bin - low, dtype=np.int64), z_counts))
+                z_first_bin = low
+            if high - z_first_bin + 1 > len(z_counts):
+                z_counts = np.concatenate((z_counts, np.zeros(high - z_first_bin + 1 - len(z_counts), dtype=np.int64)))
+            z_counts += np.bincount(bins - z_first_bin, minlength=len(z_counts))
+        n_points += len(z)
+        z_sum += float(z.sum())
+
+    if density_path:
+        np.save(density_path, density_grid.reshape(n_rows, n_columns)[::-1]) # rows from north, as rasters
+    occupied = density_grid[density_grid > 0]
+    cell_area = cell_size ** 2
+    density = float(occupied.sum() / (len(occupied) * cell_area)) if len(occupied) else 0.
+    return {"file" : file_path, "point_count" : n_points, "bounds" : bounds,
+            "area" : (bounds[2] - bounds[0]) * (bounds[3] - bounds[1]),
+            "occupied_fraction" : len(occupied) / len(density_grid), "density" : density,
+            "first_return_density" : density * n_first_returns / n_points if n_points else 0.,
+            "density_percentiles" : {str(percentile) : float(value / cell_area) for percentile, value in
+                                     zip((5, 50, 95), np.percentile(occupied, (5, 50, 95)) if len(occupied) else (0, 0, 0))},
+            "class_counts" : {str(cls) : int(count) for cls, count in enumerate(class_counts) if count},
+            "z_mean" : z_sum / n_points if n_points else None,
+            "z_percentiles" : _histogram_percentiles(z_counts, z_first_bin or 0, bin_size),
+            "z_histogram" : {"first_bin" : z_first_bin or 0, "bin_size" : bin_size, "counts" : z_counts.tolist()},
+            "density_grid" : density_path, "density_cell_size" : cell_size, "success" : True, "error" : None,
+            "wall_time" : time.perf_counter() - start, "started_at" : started_at, "pid" : os.getpid()}
+
+def suggest_gridding_params(density=None, nice_resolutions=NICE_RESOLUTIONS, points_per_radius=POINTS_PER_RADIUS):
+    """Returns gridding params (`resolution`, `radius`) suited to a point density
+
+        * `resolution` is the smallest of `nice_resolutions` not finer than the mean point spacing (1 / sqrt(density)),
+            so most cells get a point
+        * `radius` is expected to hold `points_per_radius` points, and at least reaches cell corners
+
+    Parameters
+    ----------
+    density : float
+        points per square unit (f.e. `dataset_statistics(...)["density"]`)
+    nice_resolutions : tuple
+        resolutions to pick from, ascending
+    points_per_radius : int
+        points expected within the search radius
+    """
+    spacing = 1. / math.sqrt(density)
+    resolution = next((resolution for resolution in nice_resolutions if resolution >= spacing), nice_resolutions[-1])
+    radius = max(math.sqrt(points_per_radius / (math.pi * density)), resolution / math.sqrt(2))
+    return {"resolution" : resolution, "radius" : round(radius, 2)}
+
+def _failed_tile_statistics(file_path=None, error=None):
+    """Returns an error record of a tile whose statistics failed (f.e. a corrupted tile, a killed worker)"""
+    return {"file" : file_path, "point_count" : 0, "success" : False, "error" : f"{type(error).__name__}: {error}",
+            "wall_time" : 0., "started_at" : None, "pid" : None}
+
+def dataset_statistics(tiles=None):
+    """Merges tile statistics into dataset statistics (totals, class histogram, z percentiles, density)
+
+        * Failed tiles (error records) and tiles without points are left out
+    """
+    tiles = [tile for tile in tiles if tile.get("success", True) and tile["point_count"]]
+    class_counts = {}
+    for tile in tiles:
+        for cls, count in tile["class_counts"].items():
+            class_counts[cls] = class_counts.get(cls, 0) + count
+    first_bin = min((tile["z_histogram"]["first_bin"] for tile in tiles), default=0)
+    length = max((tile["z_histogram"]["first_bin"] - first_bin + len(tile["z_histogram"]["counts"]) for tile in tiles), default=0)
+    z_counts = np.zeros(length, dtype=np.int64)
+    for tile in tiles:
+        offset = tile["z_histogram"]["first_bin"] - first_bin
+        z_counts[offset:offset + len(tile["z_histogram"]["counts"])] += tile["z_histogram"]["counts"]
+
+    point_count = sum(tile["point_count"] for tile in tiles)
+    # occupied area of tiles, so density isn't diluted by empty cells
+    occupied_area = sum(tile["point_count"] / tile["density"] for tile in tiles if tile["density"])
+    density = point_count / occupied_area if occupied_area else 0.
+    return {"tiles" : len(tiles), "point_count" : point_count,
+            "area" : sum(tile["area"] for tile in tiles), "occupied_area" : occupied_area, "density" : density,
+            "class_counts" : dict(sorted(class_counts.items(), key=lambda item: int(item[0]))),
+            "z_percentiles" : _histogram_percentiles(z_counts, first_bin, tiles[0]["z_histogram"]["bin_size"] if tiles else Z_BIN_SIZE),
+            "suggested_gridding_params" : suggest_gridding_params(density) if density else None}
+
+def lidar_statistics(files=None, output_path=None, cell_size=10., n_workers=1):
+    """Computes statistics of tiles (in a pool of processes) and of the dataset, writes them to `output_path`
+
+        Returns dataset statistics, with tile statistics under `tile_statistics`
+        A tile raising (or its worker dying) gets an error record (`success` False) and is left out of the dataset
+        Writes JSON (`output_path`), and a Parquet table of tiles next to it if pandas can write Parquet,
+        density grids of tiles go to `<output_path stem>_density/<tile>.npy`
+
+    Parameters
+    ----------
+    files : list
+        paths to .las/.laz files or point stores
+    output_path : str or None
+        path to a .json, nothing is written if None
+    cell_size : float
+        cell size of density grids
+    n_workers : int
+        number of worker processes, `1` to compute in the current process
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    print(f"\t{datetime.datetime.now()} LiDAR statistics. {len(files)} files, {n_workers} workers")
+    density_paths = [None] * len(files)
+    if output_path:
+        density_folder = os.path.splitext(output_path)[0] + '_density'
+        os.makedirs(density_folder, exist_ok=True)
+        density_paths = [os.path.join(density_folder, os.path.splitext(os.path.basename(os.path.normpath(file)))[0] + '.npy')
+                         for file in files]
+    tiles = []
+    if n_workers == 1:
+        for file, density_path in zip(files, density_paths):
+            try:
+                tiles.append(tile_statistics(file, cell_size, density_path=density_path))
+            except Exception as error: # reported in the tile record, other tiles go on
+                tiles.append(_failed_tile_statistics(file, error))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(tile_statistics, file, cell_size, density_path=density_path)
+                       for file, density_path in zip(files, density_paths)]
+            for file, future in zip(files, futures):
+                try:
+                    tiles.append(future.result())
+                except Exception as error: # f.e. `BrokenProcessPool`, the worker was killed
+                    tiles.append(_failed_tile_statistics(file, error))
+    failed = [tile for tile in tiles if not tile["success"]]
+    for tile in failed:
+        print(f"\t\tFAIL {os.path.basename(os.path.normpath(tile['file']))} ({tile['error']})")
+    summary = {**dataset_statistics(tiles), "failed_tiles" : len(failed), "tile_statistics" : tiles}
+    print(f"\t\t{summary['tiles']} tiles, {summary['point_count']} points, density {summary['density']:.2f} pts/unit^2, "
+          f"z percentiles {summary['z_percentiles']}, suggested gridding {summary['suggested_gridding_params']}")
+    if output_path:
+        with open(output_path, 'w') as file:
+            json.dump(summary, file, indent=1)
+        try:
+            import pandas as pd
+
+            table = pd.json_normalize([{key : value for key, value in tile.items() if key != "z_histogram"}
+                                       for tile in tiles])
+            table.to_parquet(os.path.splitext(output_path)[0] + '.parquet', index=False)
+        except (ImportError, ValueError) as error: # no pandas or Parquet engine, JSON is enough
+            print(f"\t\tParquet table skipped ({type(error).__name__}: {error})")
+    return summary
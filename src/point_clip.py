@@ -0,0 +1,166 @@
+"""
+Clipping of LiDAR point clouds to footprints (polygons, f.e. OSM parks or parkings), before rasterization.
+    * Footprints are split into polygons, every polygon gets a coarse grid of cells classified once
+        as outside, inside or on the boundary, so most points are decided by a cell lookup
+    * Points are streamed chunk by chunk, tested against polygons whose bounding box they fall into,
+        only points of boundary cells go to an exact (vectorized) point-in-polygon test
+    * Tiles outside all footprints are skipped, tiles inside one footprint are copied as they are
+"""
+import os
+import shutil
+import time
+
+import numpy as np
+
+OUTSIDE, BOUNDARY, INSIDE = 0, 1, 2
+GRID_SIZE = 32
+
+def build_footprints(polygons=None, polygon_crs=None, target_crs=None, grid_size=GRID_SIZE):
+    """Returns footprints (polygons with bounds and a classified grid of cells) for `points_in_footprints`
+
+    Parameters
+    ----------
+    polygons : str, dict, list or shapely geometry
+        footprints, see `src.tile_index.load_polygon` (f.e. a GeoJSON of OSM parks), multi-polygons are split
+    polygon_crs, target_crs : str or None
+        CRS of polygons and of points, f.e. `EPSG:4326` for OSM, no reprojection if any is None
+    grid_size : int
+        cells per side of a polygon grid, more cells - fewer exact tests, longer setup
+    """
+    from shapely.geometry import box
+    from shapely.prepared import prep
+    from src.tile_index import load_polygon
+
+    geometry = load_polygon(polygons, polygon_crs=polygon_crs, target_crs=target_crs)
+    footprints = []
+    for polygon in getattr(geometry, 'geoms', [geometry]):
+        if polygon.is_empty or polygon.geom_type != 'Polygon':
+            continue
+        minx, miny, maxx, maxy = polygon.bounds
+        cell_size = (max(maxx - minx, 1e-9) / grid_size, max(maxy - miny, 1e-9) / grid_size)
+        prepared = prep(polygon)
+        cells = np.full((grid_size, grid_size), OUTSIDE, dtype=np.uint8)
+        for row in range(grid_size):
+            for column in range(grid_size):
+                cell = box(minx + column * cell_size[0], miny + row * cell_size[1],
+                           minx + (column + 1) * cell_size[0], miny + (row + 1) * cell_size[1])
+                if prepared.contains(cell):
+                    cells[row, column] = INSIDE
+                elif prepared.intersects(cell):
+                    cells[row, column] = BOUNDARY
+        footprints.append({"polygon" : polygon, "bounds" : polygon.bounds, "cell_size" : cell_size, "cells" : cells})
+    return footprints
+
+def _contains_xy(polygon=None, x=None, y=None):
+    """Returns a mask of points inside a polygon (holes excluded), vectorized"""
+    import shapely
+
+    if hasattr(shapely, 'contains_xy'): # shapely 2
+        return shapely.contains_xy(polygon, x, y)
+    from matplotlib.path import Path
+
+    xy = np.column_stack((x, y))
+    inside = Path(np.asarray(polygon.exterior.coords)).contains_points(xy)
+    for interior in polygon.interiors:
+        inside &= ~Path(np.asarray(interior.coords)).contains_points(xy)
+    return inside
+
+def points_in_footprints(x=None, y=None, footprints=None):
+    """Returns a mask of points inside any footprint
+
+        Logic (per footprint):
+        - 1. BOUNDING BOX PREFILTER OF POINTS NOT INSIDE YET
+        - 2. CELL LOOKUP, POINTS OF INSIDE CELLS ARE INSIDE
+        - 3. EXACT TEST OF POINTS OF BOUNDARY CELLS
+
+    Parameters
+    ----------
+    x, y : np.array
+        coordinates of points
+    footprints : list
+        output of `build_footprints`
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    inside = np.zeros(len(x), dtype=bool)
+    for footprint in footprints:
+        minx, miny, maxx, maxy = footprint["bounds"]
+        candidates = np.flatnonzero(~inside & (x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy))
+        if not len(candidates):
+            continue
+        n_rows, n_columns = footprint["cells"].shape
+        columns = np.clip(((x[candidates] - minx) / footprint["cell_size"][0]).astype(np.int64), 0, n_columns - 1)
+        rows = np.clip(((y[candidates] - miny) / footprint["cell_size"][1]).astype(np.int64), 0, n_rows - 1)
+        cells = footprint["cells"][rows, columns]
+        inside[candidates[cells == INSIDE]] = True
+        boundary = candidates[cells == BOUNDARY]
+        if len(boundary):
+            inside[boundary] = _contains_xy(footprint["polygon"], x[boundary], y[boundary])
+    return inside
+
+def footprints_intersecting(footprints=None, bounds=None):
+    """Returns footprints whose bounding box overlaps `bounds` (f.e. of a tile)"""
+    from src.tile_index import bounds_intersect
+
+    return [footprint for footprint in footprints if bounds_intersect(footprint["bounds"], bounds)]
+
+def _tile_inside_footprint(footprints=None, bounds=None):
+    from shapely.geometry import box
+
+    tile = box(*bounds)
+    return any(footprint["polygon"].contains(tile) for footprint in footprints)
+
+def clip_lidar_file(input_path=None, output_path=None, footprints=None, chunk_size=None, laz_backend=None):
+    """Writes points of a LiDAR file inside footprints into `output_path`, chunk by chunk
+
+        * Only footprints overlapping the tile (header bounds) are tested. No output is written if there are none
+            or no point is inside, a tile inside one footprint is copied without reading points
+        * A point store (`src.point_store`) is read from its `x`, `y` columns only, kept points are exported to LAS/LAZ
+
+        Returns a result record (`file`, `output`, `points`, `kept`, `mode` - skipped, copied or clipped, `wall_time`)
+
+    Parameters
+    ----------
+    input_path : str
+        path to .las or .laz file, or to a point store
+    output_path : str
+        path to output .las or .laz file
+    footprints : list
+        output of `build_footprints`, in CRS of the tile
+    chunk_size : int or None
+        number of points per chunk, `src.lidar_io.DEFAULT_CHUNK_SIZE` if None
+    laz_backend : laspy.LazBackend or None
+        backend to (de)compress LAZ
+    """
+    from src.lidar_io import DEFAULT_CHUNK_SIZE, stream_filter_lidar_file
+    from src.point_store import export_point_store, is_point_store, iter_point_store
+    from src.tile_index import lidar_tile_bounds
+
+    started_at, start = time.time(), time.perf_counter()
+    bounds, point_count = lidar_tile_bounds(input_path)
+    result = {"file" : input_path, "output" : None, "points" : point_count, "kept" : 0, "mode" : "skipped",
+              "wall_time" : 0., "started_at" : started_at, "pid" : os.getpid()}
+    footprints = footprints_intersecting(footprints, bounds)
+    store = is_point_store(input_path)
+    if footprints and _tile_inside_footprint(footprints, bounds):
+        if store:
+            export_point_store(input_path, output_path, chunk_size=chunk_size)
+        else:
+            shutil.copyfile(input_path, output_path)
+        result.update(output=output_path, kept=point_count, mode="copied")
+    elif footprints and store:
+        keep = np.concatenate([points_in_footprints(points.x, points.y, footprints) for points in
+                               iter_point_store(input_path, columns=('x', 'y'), chunk_size=chunk_size)] or [np.zeros(0, dtype=bool)])
+        if keep.any():
+            result.update(output=output_path, kept=export_point_store(input_path, output_path, keep=keep, chunk_size=chunk_size))
+        result["mode"] = "clipped"
+    elif footprints:
+        n_kept = stream_filter_lidar_file(input_path, output_path,
+                                          keep_mask=lambda points: points_in_footprints(points.x, points.y, footprints),
+                                          chunk_size=chunk_size or DEFAULT_CHUNK_SIZE, laz_backend=laz_backend)
+        if n_kept:
+            result.update(output=output_path, kept=n_kept)
+        else: # rasterizers can't take empty tiles
+            os.remove(output_path)
+        result["mode"] = "clipped"
+    result["wall_time"] = time.perf_counter() - start
+    return result
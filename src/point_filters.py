@@ -0,0 +1,271 @@
+"""
+In-process (NumPy/SciPy) filters of LiDAR point clouds, alternative to whitebox tools.
+    * Filters are declared as a chain of steps, compiled into one streaming pass per tile, no intermediate files
+    * Outliers are found with a KD-tree neighbour index and vectorized (grouped) mean/median
+"""
+import itertools
+
+import numpy as np
+
+LOW_NOISE_CLASS = 7 # ASPRS classes, used if outliers are classified instead of removed
+HIGH_NOISE_CLASS = 18
+# suffixes of filtered files per step, in this order whatever order steps are given in
+FILTER_SUFFIXES = {"outliers" : '_rmv_out', "classes" : '_rmv_cls', "z_range" : '_rmv_z', "clip_polygons" : '_clip'}
+
+def outlier_residuals(x=None, y=None, z=None, radius=2., use_median=False, block_size=100_000):
+    """Returns residuals of points elevation from the mean (median) elevation of their neighbours
+
+        * Same semantics as `wbt.lidar_remove_outliers`: neighbours are points within `radius` in XY plane,
+            the point itself is not a neighbour, points without neighbours have zero residual
+
+        Logic:
+        - 1. BUILD KD-TREE OVER XY
+        - 2. FOR A BLOCK OF POINTS, QUERY NEIGHBOURS AND FLATTEN THEM INTO (GROUP, NEIGHBOUR) PAIRS
+        - 3. MEAN VIA `np.bincount`, MEDIAN VIA SORT BY (GROUP, Z) AND PICKING MIDDLES OF GROUPS
+
+    Parameters
+    ----------
+    x, y, z : np.array
+        coordinates of points
+    radius : float
+        search radius of neighbours
+    use_median : bool
+        if compare with median (instead of mean) elevation of neighbours
+    block_size : int
+        number of points queried at once, bounds memory of neighbour pairs
+    """
+    from scipy.spatial import cKDTree
+
+    if not len(z): # empty tile, no tree to build
+        return np.zeros(0)
+    xy = np.column_stack((x - x.min(), y - y.min())) # local coordinates, better precision of the tree
+    z = np.asarray(z, dtype=np.float64)
+    tree = cKDTree(xy)
+    residuals = np.zeros(len(z))
+    for start in range(0, len(z), block_size):
+        stop = min(start + block_size, len(z))
+        neighbours = tree.query_ball_point(xy[start:stop], r=radius, workers=-1)
+        lengths = np.fromiter(map(len, neighbours), dtype=np.int64, count=len(neighbours))
+        flat = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=np.int64, count=lengths.sum())
+        groups = np.repeat(np.arange(stop - start), lengths)
+        not_itself = flat != groups + start
+        flat, groups = flat[not_itself], groups[not_itself]
+
+        counts = np.bincount(groups, minlength=stop - start)
+        if use_median:
+            centre = _grouped_median(groups, z[flat], counts)
+        else:
+            centre = np.bincount(groups, weights=z[flat], minlength=stop - start) / np.maximum(counts, 1)
+        residuals[start:stop] = np.where(counts > 0, z[start:stop] - centre, 0.)
+    return residuals
+
+def _grouped_median(groups=None, values=None, counts=None):
+    """Returns median of `values` per group, groups are `0..len(counts)-1`, empty groups get 0"""
+    if not len(values):
+        return np.zeros(len(counts))
+    sorted_values = values[np.lexsort((values, groups))]
+    offsets = np.cumsum(counts) - counts
+    lower = np.minimum(offsets + (counts - 1) // 2, len(values) - 1) # clipped for empty groups
+    upper = np.minimum(offsets + counts // 2, len(values) - 1)
+    return np.where(counts > 0, (sorted_values[lower] + sorted_values[upper]) / 2., 0.)
+
+def filter_chain_from_params(filter_outliers_params=None, exclude_cls=None, minz=None, maxz=None):
+    """Builds a filter chain from params used by `filter_lidar_files` and gridding (`minz`, `maxz`)"""
+    filter_chain = []
+    if filter_outliers_params is not None:
+        filter_chain.append({"filter" : "outliers", **filter_outliers_params})
+    if exclude_cls:
+        filter_chain.append({"filter" : "classes", "exclude_cls" : exclude_cls})
+    if minz is not None or maxz is not None:
+        filter_chain.append({"filter" : "z_range", "minz" : minz, "maxz" : maxz})
+    return filter_chain
+
+def filter_chain_suffix(filter_chain=None):
+    """Returns suffix of files filtered by a chain, f.e. `_rmv_out_rmv_cls`, the same for the same steps in any order"""
+    steps = {step["filter"] for step in filter_chain}
+    return ''.join(suffix for name, suffix in FILTER_SUFFIXES.items() if name in steps)
+
+def compile_filter_chain(filter_chain=None):
+    """Compiles a declarative filter chain into point-wise predicates and neighbourhood steps
+
+        Steps (dicts, `filter` key selects a step, other keys are its params)
+            {"filter" : "outliers", "radius" : 4, "elev_diff" : 15, "use_median" : True, "classify" : False}
+            {"filter" : "classes", "exclude_cls" : "0,7,18"}
+            {"filter" : "z_range", "minz" : 0, "maxz" : 80}
+            {"filter" : "clip_polygons", "polygons" : "/kaggle/working/parks.geojson", "polygon_crs" : "EPSG:4326",
+             "crs" : "EPSG:3059"} - keeps points inside footprints, see `src.point_clip`
+            {"filter" : "clip_polygons", "footprints" : build_footprints(...)} - same with footprints built once
+                for many tiles
+
+        * Neighbourhood steps (`outliers`) see all points of a tile, as if they run first.
+            Outliers classified as noise (`classify`) are visible to point-wise steps (f.e. to exclude 7 and 18)
+        * Point-wise steps are combined with logical AND, their order doesn't matter
+
+        Returns (predicates, neighbourhood_steps)
+            predicates - functions taking a chunk of points, returning a mask of points to keep
+            neighbourhood_steps - functions taking x, y, z of a tile, returning (remove mask, noise class or 0)
+
+    Parameters
+    ----------
+    filter_chain : list
+        list of steps
+    """
+    predicates, neighbourhood_steps = [], []
+    for step in filter_chain:
+        params = {key : value for key, value in step.items() if key != "filter"}
+        if step["filter"] == "outliers":
+            neighbourhood_steps.append(_outliers_step(**params))
+        elif step["filter"] == "classes":
+            predicates.append(_classes_predicate(**params))
+        elif step["filter"] == "z_range":
+            predicates.append(_z_range_predicate(**params))
+        elif step["filter"] == "clip_polygons":
+            predicates.append(_clip_polygons_predicate(**params))
+        else:
+            raise ValueError(f"Unknown filter step : {step['filter']}")
+    return predicates, neighbourhood_steps
+
+def _outliers_step(radius=2., elev_diff=50., use_median=False, classify=False):
+    def outliers_step(x, y, z):
+        residuals = outlier_residuals(x, y, z, radius=radius, use_median=use_median)
+        outliers = np.abs(residuals) > elev_diff
+        if not classify:
+            return outliers, np.zeros(len(z), dtype=np.uint8)
+        noise_class = np.where(residuals < 0, LOW_NOISE_CLASS, HIGH_NOISE_CLASS).astype(np.uint8)
+        return np.zeros(len(z), dtype=bool), np.where(outliers, noise_class, 0).astype(np.uint8)
+    return outliers_step
+
+def _classes_predicate(exclude_cls=None):
+    exclude_cls_list = [int(cls) for cls in exclude_cls.split(',')]
+    return lambda points: ~np.isin(points.classification, exclude_cls_list)
+
+def _z_range_predicate(minz=None, maxz=None):
+    minz = -np.inf if minz is None else minz
+    maxz = np.inf if maxz is None else maxz
+    return lambda points: (np.asarray(points.z) >= minz) & (np.asarray(points.z) <= maxz)
+
+def _clip_polygons_predicate(polygons=None, polygon_crs=None, crs=None, grid_size=None, footprints=None):
+    from src.point_clip import GRID_SIZE, build_footprints, points_in_footprints
+
+    if footprints is None:
+        footprints = build_footprints(polygons, polygon_crs=polygon_crs, target_crs=crs, grid_size=grid_size or GRID_SIZE)
+    return lambda points: points_in_footprints(points.x, points.y, footprints)
+
+def apply_filter_chain(input_path=None, output_path=None, filter_chain=None, chunk_size=None, laz_backend=None):
+    """Filters one LiDAR file with a compiled filter chain, in one streaming pass over chunks of points
+
+        Takes a path to a file in LAS/LAZ format
+        Returns number of input and output points
+
+        * Without neighbourhood steps it is one read and one write of chunks.
+            With them, coordinates (x, y, z only) of a tile are collected first, since neighbours of a point
+            may be in any chunk; then points are filtered and written chunk by chunk. No intermediate files
+        * A point store (`src.point_store`) is read from its columns (coordinates only for neighbourhood steps),
+            kept points are exported to LAS/LAZ
+        * A tile without points gets an output without points (its header), (0, 0) is returned
+
+        Logic:
+        - 1. IF NEIGHBOURHOOD STEPS THEN COLLECT X, Y, Z AND COMPUTE REMOVE MASK / NOISE CLASSES
+        - 2. FOR EVERY CHUNK: SET NOISE CLASSES, AND ALL MASKS, WRITE KEPT POINTS
+
+    Parameters
+    ----------
+    input_path : str
+        path to .las or .laz file, or to a point store
+    output_path : str
+        path to output .las or .laz file
+    filter_chain : list
+        see `compile_filter_chain`
+    chunk_size : int or None
+        number of points per chunk, `src.lidar_io.DEFAULT_CHUNK_SIZE` if None
+    laz_backend : laspy.LazBackend or None
+        backend to (de)compress LAZ
+    """
+    import laspy
+    from src.lidar_io import DEFAULT_CHUNK_SIZE, detect_laz_backend, iter_lidar_chunks
+    from src.point_store import is_point_store
+
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    laz_backend = laz_backend or detect_laz_backend()
+    predicates, neighbourhood_steps = compile_filter_chain(filter_chain)
+
+    remove, noise_class = None, None
+    if neighbourhood_steps:
+        coordinates = [(np.asarray(points.x), np.asarray(points.y), np.asarray(points.z))
+                       for points in iter_lidar_chunks(input_path, chunk_size, laz_backend, columns=('x', 'y', 'z'))]
+        x, y, z = ((np.concatenate(dimension) for dimension in zip(*coordinates)) if coordinates
+                   else (np.zeros(0), np.zeros(0), np.zeros(0))) # empty tile, no chunks
+        del coordinates
+        remove, noise_class = np.zeros(len(z), dtype=bool), np.zeros(len(z), dtype=np.uint8)
+        for step in neighbourhood_steps:
+            step_remove, step_noise_class = step(x, y, z)
+            remove |= step_remove
+            noise_class = np.where(step_noise_class > 0, step_noise_class, noise_class)
+        del x, y, z
+
+    if is_point_store(input_path):
+        return _apply_filter_chain_store(input_path, output_path, predicates, remove, noise_class, chunk_size)
+    n_points, n_kept = 0, 0
+    with laspy.open(input_path, laz_backend=laz_backend) as reader:
+        with laspy.open(output_path, mode="w", header=reader.header, laz_backend=laz_backend) as writer:
+            for points in reader.chunk_iterator(chunk_size):
+                keep = np.ones(len(points), dtype=bool)
+                if remove is not None:
+                    keep &= ~remove[n_points:n_points + len(points)]
+                    chunk_noise_class = noise_class[n_points:n_points + len(points)]
+                    if chunk_noise_class.any():
+                        classification = np.array(points.classification)
+                        classification[chunk_noise_class > 0] = chunk_noise_class[chunk_noise_class > 0]
+                        points.classification = classification
+                for predicate in predicates:
+                    keep &= predicate(points)
+                writer.write_points(points[keep])
+                n_points += len(points)
+                n_kept += int(keep.sum())
+    return n_points, n_kept
+
+def _apply_filter_chain_store(store_path=None, output_path=None, predicates=None, remove=None, noise_class=None,
+                              chunk_size=None):
+    """Filters a point store with compiled steps (see `apply_filter_chain`), exports kept points to LAS/LAZ"""
+    from src.point_store import export_point_store, iter_point_store, open_point_store, read_store_meta
+
+    meta = read_store_meta(store_path)
+    keep = np.ones(meta["point_count"], dtype=bool) if remove is None else ~remove
+    overrides = {}
+    if noise_class is not None and noise_class.any():
+        _, arrays = open_point_store(store_path, columns=('classification',))
+        overrides["classification"] = np.where(noise_class > 0, noise_class, arrays["classification"])
+    start = 0
+    for points in iter_point_store(store_path, chunk_size=chunk_size) if predicates else ():
+        stop = start + len(points.x)
+        if "classification" in overrides:
+            points.classification = overrides["classification"][start:stop]
+        for predicate in predicates:
+            keep[start:stop] &= predicate(points)
+        start = stop
+    return meta["point_count"], export_point_store(store_path, output_path, keep=keep, overrides=overrides,
+                                                   chunk_size=chunk_size)
+
+def filter_lidar_file(input_path=None, output_path=None, filter_outliers_params=None, exclude_cls=None,
+                      laz_backend=None):
+    """Filters one LiDAR file in process (outliers and classes), no intermediate files
+
+        Takes a path to a file in LAS/LAZ format
+        Returns number of input and output points
+
+    Parameters
+    ----------
+    input_path : str
+        path to .las or .laz file
+    output_path : str
+        path to output .las or .laz file
+    filter_outliers_params : dict or None
+        params of `wbt.lidar_remove_outliers` (`radius`, `elev_diff`, `use_median`, `classify`),
+        outliers aren't filtered if None
+    exclude_cls : str or None
+        comma separated classes to remove, f.e. "0,7,18", classes aren't filtered if None
+    laz_backend : laspy.LazBackend or None
+        backend to (de)compress LAZ
+    """
+    filter_chain = filter_chain_from_params(filter_outliers_params=filter_outliers_params, exclude_cls=exclude_cls)
+    return apply_filter_chain(input_path, output_path, filter_chain, laz_backend=laz_backend)
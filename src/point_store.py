@@ -0,0 +1,210 @@
+"""
+Columnar point store, an optional interchange format of point clouds between in-process stages.
+    * A tile is a folder (`<tile>.points/`) of one .npy per dimension plus `meta.json` (scales, offsets,
+        bounds, point format, CRS), coordinates are kept as scaled integers (`X`, `Y`, `Z`) like in LAS
+    * Columns are opened as memory maps, a stage reads only the columns it needs, zero-copy
+        (f.e. classes only for a histogram, `X`, `Y` only for clipping)
+    * `iter_point_store` yields chunks with LAS-like attributes (`x`, `y`, `z`, `classification`, ...),
+        so predicates of `src.point_filters` and gridding take them as they take laspy chunks
+    * `export_point_store` writes a store (or its selected points) back to LAS/LAZ, so stages taking stores
+        (statistics, filtering, clipping, numpy gridding) hand LAS/LAZ on to stages which don't
+
+Example
+    store_path = write_point_store('/kaggle/working/filtered_files/tile.laz', '/kaggle/working/point_store/')
+    for chunk in iter_point_store(store_path, columns=('classification',)):
+        ...
+"""
+import json
+import os
+import types
+
+import numpy as np
+
+STORE_DIMENSIONS = ("X", "Y", "Z", "classification", "intensity", "return_number", "number_of_returns")
+STORE_SUFFIX = '.points'
+
+def point_store_path(lidar_path=None, store_folder=None):
+    """Returns path to the store of a LiDAR tile, f.e. `store_folder/tile.points`"""
+    return os.path.join(store_folder, os.path.splitext(os.path.basename(lidar_path))[0] + STORE_SUFFIX)
+
+def is_point_store(path=None):
+    """Returns True if `path` is a point store folder"""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+def read_store_meta(store_path=None):
+    """Returns metadata of a store (`point_count`, `scales`, `offsets`, `bounds`, `dimensions`, ...)"""
+    with open(os.path.join(store_path, 'meta.json')) as file:
+        return json.load(file)
+
+def lidar_output_path(input_path=None, output_folder=None, extension='.laz'):
+    """Returns path to a LAS/LAZ output of a tile in `output_folder`, a store gets `extension` (f.e. `tile.laz`)"""
+    name = os.path.basename(os.path.normpath(input_path))
+    if name.endswith(STORE_SUFFIX):
+        name = name[:-len(STORE_SUFFIX)] + extension
+    return os.path.join(output_folder, name)
+
+def write_point_store(input_path=None, store_folder=None, dimensions=STORE_DIMENSIONS, chunk_size=None):
+    """Converts a LAS/LAZ tile into a store, chunk by chunk, returns path to the store
+
+        * Columns are written straight into memory-mapped .npy files, one chunk of points in memory at most
+        * An existing store newer than the tile is reused, dimensions missing in the point format are skipped
+        * A tile without points gets empty columns, so stages see a valid store of 0 points
+
+    Parameters
+    ----------
+    input_path : str
+        path to .las or .laz file
+    store_folder : str
+        folder of stores
+    dimensions : tuple
+        dimensions to store, scaled integer coordinates `X`, `Y`, `Z` and any laspy dimension names
+    chunk_size : int or None
+        number of points per chunk, `src.lidar_io.DEFAULT_CHUNK_SIZE` if None
+    """
+    import laspy
+    from src.lidar_io import DEFAULT_CHUNK_SIZE, detect_laz_backend
+
+    store_path = point_store_path(input_path, store_folder)
+    meta_path = os.path.join(store_path, 'meta.json')
+    if is_point_store(store_path) and os.path.getmtime(meta_path) >= os.path.getmtime(input_path):
+        return store_path
+
+    os.makedirs(store_path, exist_ok=True)
+    with laspy.open(input_path, laz_backend=detect_laz_backend()) as reader:
+        header = reader.header
+        dimensions = [name for name in dimensions if name in header.point_format.dimension_names]
+        n_points = int(header.point_count)
+        columns, offset = {}, 0
+        for points in reader.chunk_iterator(chunk_size or DEFAULT_CHUNK_SIZE):
+            for name in dimensions:
+                values = np.asarray(points[name])
+                if name not in columns:
+                    columns[name] = np.lib.format.open_memmap(os.path.join(store_path, f'{name}.npy'), mode='w+',
+                                                              dtype=values.dtype, shape=(n_points,))
+                columns[name][offset:offset + len(values)] = values
+            offset += len(points)
+        for column in columns.values():
+            column.flush()
+        del columns
+        if not offset: # no chunks, memory maps of 0 points can't be created
+            empty = laspy.ScaleAwarePointRecord.zeros(0, header=header)
+            for name in dimensions:
+                np.save(os.path.join(store_path, f'{name}.npy'), np.asarray(empty[name]))
+        try:
+            crs = header.parse_crs()
+        except Exception: # pyproj isn't installed, or broken VLRs
+            crs = None
+        meta = {"source" : os.path.abspath(input_path), "point_count" : offset, "dimensions" : dimensions,
+                "scales" : [float(scale) for scale in header.scales],
+                "offsets" : [float(value) for value in header.offsets],
+                "bounds" : [float(value) for value in (*header.mins, *header.maxs)],
+                "point_format" : int(header.point_format.id), "version" : str(header.version),
+                "crs" : crs.to_wkt() if crs is not None else None}
+    with open(meta_path + '.tmp', 'w') as file:
+        json.dump(meta, file, indent=1)
+    os.replace(meta_path + '.tmp', meta_path) # meta is written last, a partial store is never reused
+    return store_path
+
+def open_point_store(store_path=None, columns=None, mmap_mode='r'):
+    """Returns metadata and a dict of memory-mapped columns of a store
+
+    Parameters
+    ----------
+    store_path : str
+        path to a store
+    columns : tuple or None
+        dimensions to open, all stored ones if None
+    mmap_mode : str
+        `r` read-only, `r+` to edit columns in place, `c` copy on write
+    """
+    meta = read_store_meta(store_path)
+    columns = meta["dimensions"] if columns is None else columns
+    return meta, {name : np.load(os.path.join(store_path, f'{name}.npy'), mmap_mode=mmap_mode) for name in columns}
+
+def iter_point_store(store_path=None, columns=None, chunk_size=None):
+    """Iterates over chunks of a store, chunks have LAS-like attributes
+
+        * `x`, `y`, `z` are scaled (float64) from `X`, `Y`, `Z` per chunk, other columns are views of memory maps
+        * With `columns`, only these are read, f.e. ('x', 'y') reads `X.npy` and `Y.npy` only.
+            Columns the store doesn't have are skipped, as a point format without them (`getattr` finds none)
+
+    Parameters
+    ----------
+    store_path : str
+        path to a store
+    columns : tuple or None
+        attributes of chunks, lower case `x`, `y`, `z` for scaled coordinates, all stored ones if None
+    chunk_size : int or None
+        number of points per chunk, `src.lidar_io.DEFAULT_CHUNK_SIZE` if None
+    """
+    from src.lidar_io import DEFAULT_CHUNK_SIZE
+
+    meta = read_store_meta(store_path)
+    columns = [*meta["dimensions"], "x", "y", "z"] if columns is None else columns
+    columns = [name for name in columns if name in ('x', 'y', 'z') or name in meta["dimensions"]]
+    stored = sorted({name.upper() if name in ('x', 'y', 'z') else name for name in columns})
+    _, arrays = open_point_store(store_path, columns=stored)
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    for start in range(0, meta["point_count"], chunk_size):
+        chunk = types.SimpleNamespace()
+        for name in columns:
+            if name in ('x', 'y', 'z'):
+                axis = 'xyz'.index(name)
+                values = arrays[name.upper()][start:start + chunk_size] * meta["scales"][axis] + meta["offsets"][axis]
+            else:
+                values = arrays[name][start:start + chunk_size]
+            setattr(chunk, name, values)
+        yield chunk
+
+def store_header(meta=None):
+    """Returns a `laspy.LasHeader` of the source tile of a store (point format, scales, offsets, CRS), without points"""
+    import laspy
+
+    header = laspy.LasHeader(point_format=meta["point_format"], version=meta["version"])
+    header.scales, header.offsets = np.array(meta["scales"]), np.array(meta["offsets"])
+    if meta["crs"]:
+        from pyproj import CRS
+
+        header.add_crs(CRS.from_wkt(meta["crs"]))
+    return header
+
+def export_point_store(store_path=None, output_path=None, keep=None, overrides=None, chunk_size=None):
+    """Writes a store back to LAS/LAZ (compressed if `output_path` ends with .laz), returns number of points written
+
+        * Header takes point format, scales, offsets and CRS of the source tile, dimensions which weren't stored
+            are zeros
+
+    Parameters
+    ----------
+    store_path : str
+        path to a store
+    output_path : str
+        path to output .las or .laz file
+    keep : np.array or None
+        boolean mask of points to write (f.e. of a filter), all points if None
+    overrides : dict or None
+        arrays (of all points) written instead of stored columns, f.e. {"classification" : reclassified}
+    chunk_size : int or None
+        number of points per chunk, `src.lidar_io.DEFAULT_CHUNK_SIZE` if None
+    """
+    import laspy
+    from src.lidar_io import DEFAULT_CHUNK_SIZE, detect_laz_backend
+
+    meta, arrays = open_point_store(store_path)
+    arrays.update(overrides or {})
+    header = store_header(meta)
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    n_written = 0
+    with laspy.open(output_path, mode="w", header=header, laz_backend=detect_laz_backend()) as writer:
+        for start in range(0, meta["point_count"], chunk_size):
+            stop = min(start + chunk_size, meta["point_count"])
+            selected = slice(None) if keep is None else np.asarray(keep[start:stop])
+            n_points = stop - start if keep is None else int(selected.sum())
+            if not n_points:
+                continue
+            points = laspy.ScaleAwarePointRecord.zeros(n_points, header=header)
+            for name, column in arrays.items():
+                points[name] = column[start:stop][selected]
+            writer.write_points(points)
+            n_written += n_points
+    return n_written
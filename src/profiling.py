@@ -0,0 +1,147 @@
+"""
+Per-stage and per-tile profiling of the pipeline.
+    * Spans (context manager `span` or decorator `profiled`) record wall and CPU time, peak RSS,
+        bytes read and written (/proc/self/io, Linux only) and counters (f.e. points, pixels)
+    * Tile records of worker processes (result records with `started_at`, `wall_time`) are added as spans too
+    * Spans are appended to a JSON lines file as they close, `write_chrome_trace` writes a Chrome trace
+        (chrome://tracing, https://ui.perfetto.dev)
+    * Messages go through `logging`, verbosity is set by `configure_logging`
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def configure_logging(level='INFO'):
+    """Sets up logging of the pipeline (format with time, level and module), `level` f.e. `DEBUG` or `WARNING`"""
+    logging.basicConfig(level=getattr(logging, str(level).upper(), logging.INFO),
+                        format='%(asctime)s %(levelname)s %(name)s : %(message)s', force=True)
+
+def _io_counters():
+    """Returns bytes read and written by this process from storage, zeros if /proc isn't available"""
+    try:
+        with open('/proc/self/io') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def _resources():
+    """Returns CPU seconds and peak RSS (MB) of this process and its finished children (f.e. pool workers)"""
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    return cpu_time, max(own.ru_maxrss, children.ru_maxrss) / 1024. # KB on Linux
+
+class Profiler:
+    """Collects spans of the pipeline
+
+    Parameters
+    ----------
+    jsonl_path : str or None
+        JSON lines file, a line is appended per closed span, only in memory if None
+    """
+    def __init__(self, jsonl_path=None):
+        self.jsonl_path = jsonl_path
+        self.spans = []
+        self._stack = threading.local()
+        self._lock = threading.Lock()
+        if jsonl_path:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl_path)), exist_ok=True)
+
+    @contextlib.contextmanager
+    def span(self, name=None, category='stage', **attributes):
+        """Records a span around the block, yields a dict of counters to fill, f.e. `counters["points"] += n`"""
+        stack = self._stack.__dict__.setdefault('spans', [])
+        counters = {}
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        started_at, start = time.time(), time.perf_counter()
+        cpu_start, _ = _resources()
+        read_start, written_start = _io_counters()
+        logger.info("start %s %s", category, name)
+        try:
+            yield counters
+        finally:
+            cpu_end, max_rss_mb = _resources()
+            read_end, written_end = _io_counters()
+            stack.pop()
+            self.add({"name" : name, "category" : category, "parent" : parent, "started_at" : started_at,
+                      "wall_time" : time.perf_counter() - start, "cpu_time" : cpu_end - cpu_start,
+                      "max_rss_mb" : max_rss_mb, "bytes_read" : read_end - read_start,
+                      "bytes_written" : written_end - written_start, "pid" : os.getpid(),
+                      "tid" : threading.get_ident(), "attributes" : attributes, "counters" : counters})
+
+    def add(self, record=None):
+        """Adds a closed span, appends it to the JSON lines file"""
+        with self._lock:
+            self.spans.append(record)
+            if self.jsonl_path:
+                with open(self.jsonl_path, 'a') as file:
+                    file.write(json.dumps(record, default=str) + '\n')
+        logger.info("%s %s : %.2f s wall, %.2f s CPU, peak RSS %.0f MB, read %.1f MB, written %.1f MB %s",
+                    record["category"], record["name"], record["wall_time"], record.get("cpu_time", 0.),
+                    record.get("max_rss_mb", 0.), record.get("bytes_read", 0) / 1024 ** 2,
+                    record.get("bytes_written", 0) / 1024 ** 2, record.get("counters") or '')
+
+    def add_task_records(self, stage=None, results=None):
+        """Adds result records of tiles (jobs) run in workers as spans of `stage`
+
+            * Records need `started_at` (epoch seconds) and `wall_time`, `bytes_in`, `bytes_out`, `points`,
+                `cells`, `max_rss_mb` are taken if present
+        """
+        for result in results:
+            if result.get("started_at") is None:
+                continue
+            name = os.path.basename(result.get("file") or result.get("plot_filename") or '')
+            self.add({"name" : name, "category" : stage, "parent" : stage, "started_at" : result["started_at"],
+                      "wall_time" : result["wall_time"], "cpu_time" : result.get("cpu_time", 0.),
+                      "max_rss_mb" : result.get("max_rss_mb", 0.), "bytes_read" : result.get("bytes_in", 0),
+                      "bytes_written" : result.get("bytes_out", 0), "pid" : result.get("pid", os.getpid()),
+                      "tid" : result.get("pid", 0), "attributes" : {"success" : result.get("success"),
+                                                                      "error" : result.get("error")},
+                      "counters" : {key : result[key] for key in ("points", "cells") if key in result}})
+
+    def write_chrome_trace(self, trace_path=None):
+        """Writes spans as complete events of the Chrome trace format"""
+        events = [{"name" : span["name"], "cat" : span["category"], "ph" : "X",
+                   "ts" : span["started_at"] * 1e6, "dur" : span["wall_time"] * 1e6,
+                   "pid" : span["pid"], "tid" : span["tid"],
+                   "args" : {key : span.get(key) for key in ("cpu_time", "max_rss_mb", "bytes_read",
+                                                             "bytes_written", "counters", "attributes")}}
+                  for span in self.spans]
+        with open(trace_path, 'w') as file:
+            json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, file, default=str)
+        logger.info("chrome trace of %d spans : %s", len(events), trace_path)
+        return trace_path
+
+_PROFILER = Profiler()
+
+def get_profiler():
+    """Returns the profiler of the process"""
+    return _PROFILER
+
+def set_profiler(profiler=None):
+    """Replaces the profiler of the process, f.e. `set_profiler(Profiler('/kaggle/working/profile.jsonl'))`"""
+    global _PROFILER
+    _PROFILER = profiler
+    return profiler
+
+def span(name=None, category='stage', **attributes):
+    """`Profiler.span` of the process profiler"""
+    return get_profiler().span(name, category, **attributes)
+
+def profiled(name=None, category='stage'):
+    """Decorator recording a span per call, named after the function by default"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with get_profiler().span(name or function.__name__, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,172 @@
+"""
+Block-parallel NumPy filters of raster mosaics, alternative to whitebox image filters.
+    * `median`, `conservative_smoothing` and `bilateral`, same params as the whitebox tools
+    * Raster is split into blocks, every block is read with a halo of half the kernel size and filtered
+        in a worker process, only the block core is written back
+    * Pixels outside the raster and nodata are NaN and ignored by kernels, so output does not depend
+        on the block split (bit-identical to a single-block run)
+"""
+import concurrent.futures
+import datetime
+import math
+
+import numpy as np
+
+STRIP_BUDGET_BYTES = 64 * 1024 ** 2 # memory of sliding windows of the median, per worker
+
+def kernel_halo(method='median', filter_params=None):
+    """Returns halo (rows, cols) of a filter, pixels a block must be grown by to filter its core exactly"""
+    filter_params = filter_params or {}
+    if method == 'bilateral':
+        radius = bilateral_radius(filter_params.get("sigma_dist", 0.75))
+        return radius, radius
+    default_size = 11 if method == 'median' else 3
+    return filter_params.get("filtery", default_size) // 2, filter_params.get("filterx", default_size) // 2
+
+def bilateral_radius(sigma_dist=0.75):
+    """Returns kernel radius of the bilateral filter, 3 sigmas of the distance kernel (at least 1 pixel)"""
+    return max(1, int(math.floor(sigma_dist * 3.)))
+
+def median_filter(values=None, filterx=11, filtery=11, sig_digits=2):
+    """Median of valid (not NaN) neighbours in a `filtery` x `filterx` window, of a halo-padded block
+
+        * Values are rounded to `sig_digits` decimals first, as whitebox bins values by them
+        * Sliding windows are taken over row strips, memory is bounded by `STRIP_BUDGET_BYTES`
+    """
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    half_y, half_x = filtery // 2, filterx // 2
+    if sig_digits is not None:
+        values = np.round(values, sig_digits)
+    height, width = values.shape[0] - 2 * half_y, values.shape[1] - 2 * half_x
+    output = np.full((height, width), np.nan, dtype=np.float32)
+    strip_rows = max(1, STRIP_BUDGET_BYTES // (width * filterx * filtery * values.itemsize * 2))
+    for row in range(0, height, strip_rows):
+        stop = min(height, row + strip_rows)
+        windows = sliding_window_view(values[row:stop + 2 * half_y], (2 * half_y + 1, 2 * half_x + 1))
+        windows = windows.reshape(stop - row, width, -1)
+        valid = ~np.isnan(windows).all(axis=-1)
+        output[row:stop][valid] = np.nanmedian(windows[valid], axis=-1)
+    return output
+
+def conservative_smoothing_filter(values=None, filterx=3, filtery=3):
+    """Clips a pixel to [min, max] of its valid neighbours (the pixel itself excluded), of a halo-padded block"""
+    half_y, half_x = filtery // 2, filterx // 2
+    height, width = values.shape[0] - 2 * half_y, values.shape[1] - 2 * half_x
+    centre = values[half_y:half_y + height, half_x:half_x + width]
+    lowest = np.full((height, width), np.nan, dtype=values.dtype)
+    highest = np.full((height, width), np.nan, dtype=values.dtype)
+    for row_offset in range(2 * half_y + 1):
+        for col_offset in range(2 * half_x + 1):
+            if (row_offset, col_offset) == (half_y, half_x):
+                continue
+            neighbour = values[row_offset:row_offset + height, col_offset:col_offset + width]
+            lowest, highest = np.fmin(lowest, neighbour), np.fmax(highest, neighbour)
+    return np.where(np.isnan(lowest), centre, np.clip(centre, lowest, highest)).astype(np.float32)
+
+def bilateral_filter(values=None, sigma_dist=0.75, sigma_int=1.):
+    """Edge-preserving smoothing, neighbours weighted by distance and by value difference, of a halo-padded block"""
+    radius = bilateral_radius(sigma_dist)
+    height, width = values.shape[0] - 2 * radius, values.shape[1] - 2 * radius
+    centre = values[radius:radius + height, radius:radius + width].astype(np.float64)
+    sums, weights = np.zeros((height, width)), np.zeros((height, width))
+    for row_offset in range(-radius, radius + 1):
+        for col_offset in range(-radius, radius + 1):
+            neighbour = values[radius + row_offset:radius + row_offset + height,
+                               radius + col_offset:radius + col_offset + width].astype(np.float64)
+            weight = (math.exp(-(row_offset ** 2 + col_offset ** 2) / (2. * sigma_dist ** 2)) *
+                      np.exp(-(neighbour - centre) ** 2 / (2. * sigma_int ** 2)))
+            weight[np.isnan(weight)] = 0.
+            sums += weight * np.nan_to_num(neighbour)
+            weights += weight
+    output = np.where(weights > 0, sums / np.maximum(weights, 1e-12), np.nan)
+    return output.astype(np.float32)
+
+FILTERS = {"median" : median_filter, "conservative_smoothing" : conservative_smoothing_filter,
+           "bilateral" : bilateral_filter}
+
+def read_padded_window(src=None, row=0, col=0, height=0, width=0, halo=(0, 0)):
+    """Reads a window grown by `halo` as float32, NaN for nodata and for pixels outside the raster"""
+    from rasterio.windows import Window
+
+    halo_y, halo_x = halo
+    row_start, row_stop = max(0, row - halo_y), min(src.height, row + height + halo_y)
+    col_start, col_stop = max(0, col - halo_x), min(src.width, col + width + halo_x)
+    data = src.read(1, window=Window(col_start, row_start, col_stop - col_start, row_stop - row_start),
+                    masked=True).astype(np.float32).filled(np.nan)
+    return np.pad(data, ((row_start - (row - halo_y), row + height + halo_y - row_stop),
+                         (col_start - (col - halo_x), col + width + halo_x - col_stop)),
+                  constant_values=np.nan)
+
+def filter_block(input_path=None, method='median', filter_params=None, row=0, col=0, height=0, width=0):
+    """Filters one block of a raster (read with its halo), returns the block core, NaN where input is nodata"""
+    import rasterio
+
+    halo = kernel_halo(method, filter_params)
+    with rasterio.open(input_path) as src:
+        values = read_padded_window(src, row, col, height, width, halo)
+    output = FILTERS[method](values, **(filter_params or {}))
+    output[np.isnan(values[halo[0]:halo[0] + height, halo[1]:halo[1] + width])] = np.nan
+    return output
+
+def filter_raster(input_path=None, output_path=None, method='median', filter_params=None,
+                  block_size=1024, n_workers=1, compress='deflate'):
+    """Filters a raster block by block over a process pool
+
+        Takes a raster (.tif or .vrt, read lazily by windows)
+        Creates a filtered tiled GeoTIFF to `output_path`
+
+        Logic:
+        - 1. SPLIT RASTER INTO `block_size` BLOCKS
+        - 2. IN WORKERS: READ BLOCK + HALO (NaN OUTSIDE RASTER), FILTER, RETURN BLOCK CORE
+        - 3. WRITE BLOCKS AS THEY COMPLETE, AT MOST 2 BLOCKS PER WORKER IN FLIGHT
+
+    Parameters
+    ----------
+    input_path : str
+        path to input raster
+    output_path : str
+        path to output .tif
+    method : str
+        `median`, `conservative_smoothing` or `bilateral`
+    filter_params : dict
+        params of the whitebox tool of the same name, f.e. {"filterx" : 9, "filtery" : 9, "sig_digits" : 2}
+    block_size : int
+        side of a block in pixels, multiple of 256
+    n_workers : int
+        number of worker processes
+    compress : str
+        GeoTIFF compression
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    if method not in FILTERS:
+        raise ValueError(f"Unknown raster filter : {method}")
+    with rasterio.open(input_path) as src:
+        nodata = src.nodata if src.nodata is not None else -32768.
+        profile = {"driver" : "GTiff", "width" : src.width, "height" : src.height, "count" : 1, "dtype" : "float32",
+                   "nodata" : nodata, "crs" : src.crs, "transform" : src.transform,
+                   "tiled" : True, "blockxsize" : 256, "blockysize" : 256,
+                   "compress" : compress, "predictor" : 3, "BIGTIFF" : "IF_SAFER"}
+    blocks = [(row, col, min(block_size, profile["height"] - row), min(block_size, profile["width"] - col))
+              for row in range(0, profile["height"], block_size) for col in range(0, profile["width"], block_size)]
+    print(f"\t{datetime.datetime.now()} {method} filter {profile['width']}x{profile['height']} px, "
+          f"{len(blocks)} blocks, halo {kernel_halo(method, filter_params)}, {n_workers} workers")
+
+    with rasterio.open(output_path, "w", **profile) as dst, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending, blocks = {}, iter(blocks)
+        while True:
+            for row, col, height, width in blocks:
+                future = pool.submit(filter_block, input_path, method, filter_params, row, col, height, width)
+                pending[future] = Window(col, row, width, height)
+                if len(pending) >= 2 * n_workers:
+                    break
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                output = future.result()
+                dst.write(np.where(np.isnan(output), nodata, output).astype(np.float32), 1, window=pending.pop(future))
+    return output_path
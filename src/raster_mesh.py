@@ -0,0 +1,124 @@
+"""
+Raster to PyVista mesh with (nearly) one copy of the raster in memory.
+    * Heights are read as float32 in row strips straight into one buffer (optionally a memory-mapped .npy),
+        rows are flipped on the fly into VTK order (south to north, x varies fastest)
+    * Flat grid geometry is an `ImageData` (`UniformGrid` in older pyvista), origin and spacing only,
+        no coordinate arrays, the buffer is wrapped by VTK as scalars without a copy
+    * 3D surface is a `StructuredGrid` of float32 points filled in place, 4 float32 per cell with the scalars
+        (`warp_by_scalar` of the flat grid peaks at about 11)
+"""
+import json
+import os
+
+import numpy as np
+
+STRIP_ROWS = 1024
+GDAL_CACHE_MB = 64 # strips read every block once, a bigger GDAL block cache only adds to the peak
+
+def read_height_array(raster_path=None, factor=1, memmap_path=None, strip_rows=STRIP_ROWS):
+    """Reads a raster band into a float32 array in VTK row order, NaN for nodata
+
+        * With `memmap_path`, heights go into a memory-mapped .npy (page cache instead of process memory),
+            an existing .npy newer than the raster is reused without reading the raster (f.e. by render workers),
+            if it was read from the same raster (absolute path and size) with the same `factor` and has its shape
+        * `factor` > 1 reads a decimated level, served from overviews if the raster has them
+
+        Returns heights (rows from south to north), origin (x, y of the south-west cell) and spacing (x, y)
+
+    Parameters
+    ----------
+    raster_path : str
+        path to a raster (.tif or .vrt)
+    factor : int
+        decimation factor, see `src.raster_mosaic.overview_factor`
+    memmap_path : str or None
+        path to a .npy to read heights into, in memory if None
+    strip_rows : int
+        rows read at once, only one strip is held besides the output
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.windows import Window
+
+    meta_path = memmap_path + '.json' if memmap_path else None
+    source = {"raster" : os.path.abspath(raster_path), "raster_size" : os.path.getsize(raster_path), "factor" : factor}
+    if (memmap_path and os.path.exists(meta_path) and os.path.exists(memmap_path) and
+            os.path.getmtime(memmap_path) >= os.path.getmtime(raster_path)):
+        with open(meta_path) as file:
+            meta = json.load(file)
+        if all(meta.get(key) == value for key, value in source.items()):
+            values = np.load(memmap_path, mmap_mode='c')
+            if list(values.shape) == meta.get("shape"): # not rewritten since by another read
+                return values, tuple(meta["origin"]), tuple(meta["spacing"])
+            del values
+
+    with rasterio.Env(GDAL_CACHEMAX=GDAL_CACHE_MB), rasterio.open(raster_path) as src:
+        height, width = int(np.ceil(src.height / factor)), int(np.ceil(src.width / factor))
+        spacing = (src.res[0] * src.width / width, src.res[1] * src.height / height)
+        origin = (src.bounds.left + spacing[0] / 2., src.bounds.bottom + spacing[1] / 2.) # cell centres
+        if memmap_path:
+            if os.path.exists(meta_path): # meta goes last, an interrupted read is never reused
+                os.remove(meta_path)
+            values = np.lib.format.open_memmap(memmap_path, mode='w+', dtype=np.float32, shape=(height, width))
+        else:
+            values = np.empty((height, width), dtype=np.float32)
+        strip_rows = strip_rows if factor == 1 else height # decimated levels are small, one read
+        for row in range(0, height, strip_rows):
+            stop = min(height, row + strip_rows)
+            if factor == 1:
+                strip = src.read(1, window=Window(0, row, width, stop - row), masked=True)
+            else:
+                strip = src.read(1, out_shape=(height, width), resampling=Resampling.average, masked=True)
+            values[height - stop:height - row] = strip.astype(np.float32).filled(np.nan)[::-1] # integer rasters too
+            del strip
+    if memmap_path:
+        values.flush()
+        with open(meta_path, 'w') as file:
+            json.dump({**source, "shape" : [height, width], "origin" : origin, "spacing" : spacing}, file)
+    return values, origin, spacing
+
+def surface_points(values=None, origin=(0., 0.), spacing=(1., 1.)):
+    """Returns float32 points (n, 3) of a surface of heights, filled in place (no meshgrid, no float64 temporaries)"""
+    height, width = values.shape
+    points = np.empty((height, width, 3), dtype=np.float32)
+    points[:, :, 0] = origin[0] + spacing[0] * np.arange(width)
+    points[:, :, 1] = (origin[1] + spacing[1] * np.arange(height))[:, None]
+    points[:, :, 2] = values
+    return points.reshape(-1, 3)
+
+def heights_to_mesh(values=None, origin=(0., 0.), spacing=(1., 1.), scalars_name="Tiff Scalars", warp=True):
+    """Wraps heights (VTK row order) into a mesh without copying them, a 3D surface or a flat `ImageData`
+
+        * The 3D surface is a `StructuredGrid` of float32 points (3 float32 per cell) set once,
+            `warp_by_scalar` would make float64 points and copies of the scalars (about 6 float32 per cell more)
+
+    Parameters
+    ----------
+    values : np.array
+        float32 heights of `read_height_array`
+    origin, spacing : tuple
+        geometry of the grid, see `read_height_array`
+    scalars_name : str
+        name of point scalars
+    warp : bool
+        if displace points by heights (3D surface, `StructuredGrid`), flat grid with scalars otherwise
+    """
+    import pyvista as pv
+
+    if warp:
+        mesh = pv.StructuredGrid()
+        mesh.points = surface_points(values, origin, spacing) # float32 points are wrapped, not converted
+        mesh.dimensions = (values.shape[1], values.shape[0], 1)
+    else:
+        mesh = (getattr(pv, 'ImageData', None) or pv.UniformGrid)()
+        mesh.dimensions = (values.shape[1], values.shape[0], 1)
+        mesh.origin = (origin[0], origin[1], 0.)
+        mesh.spacing = (spacing[0], spacing[1], 1.)
+    mesh.point_data.set_array(values.reshape(-1), scalars_name, deep_copy=False) # a view, no copy
+    mesh.set_active_scalars(scalars_name)
+    return mesh
+
+def read_raster_mesh(raster_path=None, factor=1, memmap_path=None, scalars_name="Tiff Scalars", warp=True):
+    """Reads a raster into a PyVista mesh, see `read_height_array` and `heights_to_mesh`"""
+    values, origin, spacing = read_height_array(raster_path, factor=factor, memmap_path=memmap_path)
+    return heights_to_mesh(values, origin, spacing, scalars_name=scalars_name, warp=warp)
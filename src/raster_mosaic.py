@@ -0,0 +1,326 @@
+"""
+Windowed, out-of-core mosaic of raster tiles.
+    * Output is written block by block into a tiled, compressed GeoTIFF
+    * For every output block only overlapping windows of source tiles are read (tiles found via `src.tile_index`)
+    * Peak memory is bounded by the block budget, not by the size of a city
+    * A VRT (virtual mosaic) references tiles without writing pixels, windows are read lazily on demand
+    * Overview pyramid (2x, 4x, 8x...) is built once, previews read the level matching the render window
+"""
+import contextlib
+import datetime
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+RESAMPLING_METHODS = {"nn" : "nearest", "bilinear" : "bilinear", "cc" : "cubic"} # whitebox names -> rasterio names
+BYTES_PER_BLOCK_PIXEL = 16 # output float32, filled mask, source window (masked float32) and resampling buffers
+GTIFF_BLOCK_SIZE = 256
+
+def block_size_from_budget(block_budget_mb=256):
+    """Returns side (pixels) of a square output block fitting `block_budget_mb`, multiple of GeoTIFF block size"""
+    side = int(math.sqrt(block_budget_mb * 1024 ** 2 / BYTES_PER_BLOCK_PIXEL))
+    return max(GTIFF_BLOCK_SIZE, side // GTIFF_BLOCK_SIZE * GTIFF_BLOCK_SIZE)
+
+def mosaic_grid(tile_index=None, resolution=None):
+    """Returns output grid of a mosaic (bounds, resolution, width, height) covering all tiles
+
+        * Resolution of the first tile is used if `resolution` is None (tiles of one gridding run share it)
+    """
+    from src.tile_index import index_bounds
+
+    resolution = resolution or tile_index[0]["resolution"][0]
+    minx, miny, maxx, maxy = index_bounds(tile_index)
+    width, height = int(math.ceil((maxx - minx) / resolution - 1e-6)), int(math.ceil((maxy - miny) / resolution - 1e-6))
+    return (minx, maxy - height * resolution, minx + width * resolution, maxy), resolution, width, height
+
+def read_block(tile_index=None, buckets=None, block_bounds=None, shape=None, resolution=None,
+               nodata=None, mosaic_method='nn'):
+    """Reads one output block of a mosaic, first valid tile (in index order) wins in overlaps
+
+        Takes bounds and shape of an output block
+        Returns a float32 array of the block, `nodata` where no tile has valid data
+
+    Parameters
+    ----------
+    tile_index : list
+        index of raster tiles, see `src.tile_index.build_tile_index`
+    buckets : dict or None
+        see `src.tile_index.bucket_tile_index`
+    block_bounds : tuple
+        bounds of the block
+    shape : tuple
+        (height, width) of the block
+    resolution : float
+        output resolution
+    nodata : float
+        output nodata value
+    mosaic_method : str
+        `nn`, `bilinear` or `cc`, resampling of source windows onto the output grid
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.windows import from_bounds
+    from src.tile_index import tiles_intersecting
+
+    resampling = getattr(Resampling, RESAMPLING_METHODS[mosaic_method])
+    block = np.full(shape, nodata, dtype=np.float32)
+    filled = np.zeros(shape, dtype=bool)
+    for tile in tiles_intersecting(tile_index, block_bounds, buckets):
+        overlap = (max(block_bounds[0], tile["bounds"][0]), max(block_bounds[1], tile["bounds"][1]),
+                   min(block_bounds[2], tile["bounds"][2]), min(block_bounds[3], tile["bounds"][3]))
+        col_start = int(round((overlap[0] - block_bounds[0]) / resolution))
+        col_stop = int(round((overlap[2] - block_bounds[0]) / resolution))
+        row_start = int(round((block_bounds[3] - overlap[3]) / resolution))
+        row_stop = int(round((block_bounds[3] - overlap[1]) / resolution))
+        if col_stop <= col_start or row_stop <= row_start:
+            continue
+        with rasterio.open(tile["path"]) as src:
+            data = src.read(1, window=from_bounds(*overlap, transform=src.transform),
+                            out_shape=(row_stop - row_start, col_stop - col_start),
+                            resampling=resampling, masked=True)
+        free = ~filled[row_start:row_stop, col_start:col_stop] & ~np.ma.getmaskarray(data)
+        block[row_start:row_stop, col_start:col_stop][free] = data.data[free]
+        filled[row_start:row_stop, col_start:col_stop] |= free
+    return block
+
+def mosaic_windowed(input_files=None, output_path=None, mosaic_method='nn', block_budget_mb=256,
+                    resolution=None, compress='deflate'):
+    """Mosaics raster tiles block by block into a tiled, compressed GeoTIFF
+
+        Takes raster tiles
+        Creates a mosaic to `output_path`
+
+        Logic:
+        - 1. INDEX TILE FOOTPRINTS, BUCKET THEM INTO A GRID
+        - 2. FOR EVERY OUTPUT BLOCK: READ OVERLAPPING SOURCE WINDOWS, RESAMPLE, FIRST VALID WINS
+        - 3. WRITE THE BLOCK, FORGET IT
+
+    Parameters
+    ----------
+    input_files : list
+        paths to raster tiles (.tif)
+    output_path : str
+        path to output mosaic (.tif)
+    mosaic_method : str
+        `nn`, `bilinear` or `cc`
+    block_budget_mb : float
+        memory budget of one output block
+    resolution : float or None
+        output resolution, resolution of the first tile if None
+    compress : str
+        GeoTIFF compression
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+    from src.tile_index import build_tile_index, bucket_tile_index
+
+    tile_index = build_tile_index(input_files)
+    buckets = bucket_tile_index(tile_index)
+    bounds, resolution, width, height = mosaic_grid(tile_index, resolution)
+    nodata = next((tile["nodata"] for tile in tile_index if tile["nodata"] is not None), -32768.)
+    block_size = block_size_from_budget(block_budget_mb)
+    with rasterio.open(tile_index[0]["path"]) as src:
+        crs = src.crs
+
+    profile = {"driver" : "GTiff", "width" : width, "height" : height, "count" : 1, "dtype" : "float32",
+               "nodata" : nodata, "crs" : crs, "transform" : from_origin(bounds[0], bounds[3], resolution, resolution),
+               "tiled" : True, "blockxsize" : GTIFF_BLOCK_SIZE, "blockysize" : GTIFF_BLOCK_SIZE,
+               "compress" : compress, "predictor" : 3, "BIGTIFF" : "IF_SAFER"}
+    n_blocks = math.ceil(height / block_size) * math.ceil(width / block_size)
+    print(f"\t{datetime.datetime.now()} windowed mosaic {width}x{height} px, {len(tile_index)} tiles, "
+          f"{n_blocks} blocks of {block_size}x{block_size} px")
+    with rasterio.open(output_path, "w", **profile) as dst:
+        for row in range(0, height, block_size):
+            for col in range(0, width, block_size):
+                block_height, block_width = min(block_size, height - row), min(block_size, width - col)
+                block_bounds = (bounds[0] + col * resolution, bounds[3] - (row + block_height) * resolution,
+                                bounds[0] + (col + block_width) * resolution, bounds[3] - row * resolution)
+                block = read_block(tile_index, buckets, block_bounds, (block_height, block_width),
+                                   resolution, nodata, mosaic_method)
+                dst.write(block, 1, window=Window(col, row, block_width, block_height))
+    return output_path
+
+def build_vrt(input_files=None, output_path=None, mosaic_method='nn', resolution=None):
+    """Writes a GDAL VRT (virtual mosaic) over raster tiles, no pixels are read or written
+
+        * One `ComplexSource` per tile, sources are listed in reverse index order,
+            so the first valid tile wins in overlaps (same as `mosaic_windowed`)
+        * Tiles are referenced by absolute paths, the VRT can't be moved to another machine without them
+
+    Parameters
+    ----------
+    input_files : list
+        paths to raster tiles (.tif)
+    output_path : str
+        path to output mosaic (.vrt)
+    mosaic_method : str
+        `nn`, `bilinear` or `cc`, resampling of tiles when windows are read
+    resolution : float or None
+        output resolution, resolution of the first tile if None
+    """
+    import rasterio
+    from xml.sax.saxutils import escape
+    from src.tile_index import build_tile_index
+
+    tile_index = build_tile_index(input_files)
+    bounds, resolution, width, height = mosaic_grid(tile_index, resolution)
+    nodata = next((tile["nodata"] for tile in tile_index if tile["nodata"] is not None), -32768.)
+    with rasterio.open(tile_index[0]["path"]) as src:
+        crs = src.crs
+
+    lines = [f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">']
+    if crs is not None:
+        lines.append(f'  <SRS>{escape(crs.to_wkt())}</SRS>')
+    lines += [f'  <GeoTransform>{bounds[0]!r}, {resolution!r}, 0.0, {bounds[3]!r}, 0.0, {-resolution!r}</GeoTransform>',
+              '  <VRTRasterBand dataType="Float32" band="1">',
+              f'    <NoDataValue>{nodata!r}</NoDataValue>']
+    for tile in reversed(tile_index):
+        with rasterio.open(tile["path"]) as src:
+            src_width, src_height, src_nodata = src.width, src.height, src.nodata
+        minx, miny, maxx, maxy = tile["bounds"]
+        lines += [f'    <ComplexSource resampling="{RESAMPLING_METHODS[mosaic_method]}">',
+                  f'      <SourceFilename relativeToVRT="0">{escape(tile["path"])}</SourceFilename>',
+                  '      <SourceBand>1</SourceBand>',
+                  f'      <SrcRect xOff="0" yOff="0" xSize="{src_width}" ySize="{src_height}" />',
+                  f'      <DstRect xOff="{(minx - bounds[0]) / resolution!r}" yOff="{(bounds[3] - maxy) / resolution!r}" '
+                  f'xSize="{(maxx - minx) / resolution!r}" ySize="{(maxy - miny) / resolution!r}" />']
+        if src_nodata is not None:
+            lines.append(f'      <NODATA>{src_nodata!r}</NODATA>')
+        lines.append('    </ComplexSource>')
+    lines += ['  </VRTRasterBand>', '</VRTDataset>']
+    with open(output_path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    print(f"\t{datetime.datetime.now()} VRT mosaic {width}x{height} px over {len(tile_index)} tiles : {output_path}")
+    return output_path
+
+def export_mosaic(input_path=None, output_path=None, block_budget_mb=256, compress='deflate'):
+    """Materializes a (virtual) mosaic into a tiled, compressed GeoTIFF, block by block
+
+    Parameters
+    ----------
+    input_path : str
+        path to a mosaic readable by rasterio, f.e. .vrt of `build_vrt`
+    output_path : str
+        path to output .tif
+    block_budget_mb : float
+        memory budget of one block
+    compress : str
+        GeoTIFF compression
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    block_size = block_size_from_budget(block_budget_mb)
+    with rasterio.open(input_path) as src:
+        profile = {"driver" : "GTiff", "width" : src.width, "height" : src.height, "count" : 1, "dtype" : "float32",
+                   "nodata" : src.nodata, "crs" : src.crs, "transform" : src.transform,
+                   "tiled" : True, "blockxsize" : GTIFF_BLOCK_SIZE, "blockysize" : GTIFF_BLOCK_SIZE,
+                   "compress" : compress, "predictor" : 3, "BIGTIFF" : "IF_SAFER"}
+        with rasterio.open(output_path, "w", **profile) as dst:
+            for row in range(0, src.height, block_size):
+                for col in range(0, src.width, block_size):
+                    window = Window(col, row, min(block_size, src.width - col), min(block_size, src.height - row))
+                    dst.write(src.read(1, window=window).astype(np.float32), 1, window=window)
+    return output_path
+
+@contextlib.contextmanager
+def materialized(input_path=None, block_budget_mb=256):
+    """Yields a GeoTIFF path of a mosaic, a temporary export for .vrt (for tools which can't read VRT)"""
+    if not input_path.lower().endswith('.vrt'):
+        yield input_path
+        return
+    temp_dir = tempfile.mkdtemp(prefix='materialized_')
+    try:
+        yield export_mosaic(input_path, os.path.join(temp_dir, os.path.basename(input_path)[:-4] + '.tif'),
+                            block_budget_mb=block_budget_mb)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def read_mosaic(input_path=None, bounds=None, factor=1):
+    """Reads a mosaic (or a window of it by `bounds`) lazily via rasterio
+
+        * `factor` > 1 reads a decimated level, GDAL serves it from the closest overview of `build_overviews`
+
+        Returns a float32 array (NaN for nodata, rows from north to south) and its transform
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.transform import Affine
+    from rasterio.windows import Window, from_bounds
+
+    with rasterio.open(input_path) as src:
+        if bounds:
+            window = from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+        else:
+            window = Window(0, 0, src.width, src.height)
+        out_shape = (max(1, math.ceil(window.height / factor)), max(1, math.ceil(window.width / factor)))
+        data = src.read(1, window=window, out_shape=out_shape, resampling=Resampling.average,
+                        masked=True).astype(np.float32).filled(np.nan)
+        transform = src.window_transform(window) * Affine.scale(window.width / out_shape[1], window.height / out_shape[0])
+    return data, transform
+
+def read_thumbnail(input_path=None, max_size=512):
+    """Reads a raster decimated to at most `max_size` pixels per side (from overviews if there are any)
+
+        Returns a float32 array (NaN for nodata) and extent (minx, maxx, miny, maxy) for `matplotlib.imshow`
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+
+    with rasterio.open(input_path) as src:
+        scale = min(1., max_size / max(src.width, src.height))
+        out_shape = (max(1, int(round(src.height * scale))), max(1, int(round(src.width * scale))))
+        data = src.read(1, out_shape=out_shape, resampling=Resampling.average, masked=True)
+        bounds = src.bounds
+    return data.astype(np.float32).filled(np.nan), (bounds.left, bounds.right, bounds.bottom, bounds.top)
+
+def build_overviews(input_path=None, factors=(2, 4, 8, 16, 32), resampling='average'):
+    """Builds an overview pyramid of a raster once, decimated reads (`read_mosaic`) use it
+
+        * Internal overviews for GeoTIFF, external `.ovr` for VRT
+        * Levels coarser than 256 px are skipped
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+
+    with rasterio.open(input_path, 'r+') as dst:
+        factors = [factor for factor in factors if max(dst.width, dst.height) / factor >= GTIFF_BLOCK_SIZE]
+        if factors:
+            dst.build_overviews(factors, getattr(Resampling, resampling))
+            dst.update_tags(ns='rio_overview', resampling=resampling)
+    print(f"\t{datetime.datetime.now()} overviews {factors} : {input_path}")
+    return factors
+
+def overview_factor(input_path=None, window_size=None, zoom=1.):
+    """Returns the coarsest overview factor still giving at least one raster cell per screen pixel
+
+        * Whole raster fills `window_size` at `zoom` 1, zooming in by 2 needs 2 times finer cells
+        * 1 (full resolution) if there are no overviews or the window needs them all
+
+    Parameters
+    ----------
+    input_path : str
+        path to a raster with overviews
+    window_size : list
+        render window size in pixels, f.e. [800, 800]
+    zoom : float
+        camera zoom relative to the view fitting the whole raster (closer camera - bigger zoom)
+    """
+    import rasterio
+
+    with rasterio.open(input_path) as src:
+        factors, size = src.overviews(1), max(src.width, src.height)
+    return max([1] + [factor for factor in factors if size / factor >= max(window_size) * zoom])
+
+def vrt_sources(input_path=None):
+    """Returns paths of tiles referenced by a VRT, empty list for other rasters"""
+    import xml.etree.ElementTree as ElementTree
+
+    if not input_path.lower().endswith('.vrt'):
+        return []
+    root = ElementTree.parse(input_path).getroot()
+    return sorted({element.text for element in root.iter('SourceFilename')})
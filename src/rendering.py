@@ -0,0 +1,676 @@
+"""
+Offscreen rendering of raster meshes with PyVista, importable by worker processes.
+    * `build_plotter` - plotter, mesh actor, camera, lights, shadows, grid and bounding box (as `plot_3D`)
+    * `RenderSession` - many views (camera, colormap or color, shadows, eye dome lighting) from one plotter,
+        the mesh is uploaded once per actor style, lights, grid and bounding box are set up once
+    * Render farm - a list of render jobs (views, colormaps, lighting) scheduled over a process pool,
+        every worker loads the mesh once from a shared memory-mapped .npy of heights,
+        stills of the same window and overview level are rendered in sessions
+    * Tiled screenshots - a k x k grid of sub-frusta rendered at a moderate window size and streamed
+        into a tiled TIFF, a memory-mapped .npy or an array, for prints beyond the ~4K framebuffer limit
+    * Orbits - frames of the camera path are split over worker processes into a bounded queue,
+        an encoder process writes the GIF (MP4) in frame order as frames arrive
+"""
+import collections
+import datetime
+import gc
+import json
+import math
+import os
+import resource
+import time
+
+import numpy as np
+
+RENDER_JOB_DEFAULTS = {"plotter_params" : {"window_size" : [3200, 3200]},
+                       "plot_actor_params" : {"cmap" : "blues", "log_scale" : False, "show_scalar_bar" : False},
+                       "plot_isometric" : True, "enable_shades" : False, "enable_eye_dome_lighting" : False,
+                       "save_plot_mode" : "save render", "factor" : 1, "plot_filename" : None,
+                       "tile_size" : None, "n_frames" : 72, "fps" : 24}
+ORBIT_MODES = ('save render orbiting', 'save render orbiting video')
+MESH_BYTES_PER_CELL = 64 # warped points, scalars, normals and VTK render copies a worker holds per raster cell
+ORBIT_POLL_SECONDS = 1. # how often the parent checks orbit processes are alive
+ORBIT_FRAME_TIMEOUT = 600. # seconds the encoder waits for the next frame before it gives up
+
+def build_plotter(mesh=None, plotter_params=None, plot_actor_params=None, plot_isometric=True,
+                  enable_shades=False, enable_eye_dome_lighting=False, off_screen=True):
+    """Returns a plotter with the mesh actor, camera, lights, shadows, grid and bounding box
+
+        * Params are the ones of `custom_visualizations.plot_3D`
+    """
+    import pyvista as pv
+
+    plotter = pv.Plotter(off_screen=off_screen, **(plotter_params or {}))
+    plotter.add_mesh(mesh, **(plot_actor_params or {}))
+    if not plot_isometric:
+        plotter.view_xy()
+        plotter.camera.zoom(1.25)
+
+    light = pv.Light(intensity=0.7)
+    light.set_direction_angle(300, -20)
+    plotter.add_light(light)
+    if enable_shades:
+        plotter.enable_shadows()
+    plotter.enable_anti_aliasing(aa_type='msaa')
+    if enable_eye_dome_lighting:
+        plotter.enable_eye_dome_lighting()
+    plotter.show_grid(color='lightgrey', font_size=36)
+    plotter.add_bounding_box(opacity=0.75, color='lightgrey')
+    return plotter
+
+class RenderSession:
+    """Renders many views of one mesh from one plotter (one render context)
+
+        * An actor is added once per distinct actor params (f.e. colormap, `color='tan'`), views toggle visibility
+        * Camera, shadows and eye dome lighting are switched between screenshots, not rebuilt
+
+    Parameters
+    ----------
+    mesh : pyvista.DataSet
+        mesh to render
+    plotter_params : dict
+        params of `pyvista.Plotter`, f.e. {"window_size" : [6000, 6000]}
+    off_screen : bool
+        if render offscreen
+    """
+    def __init__(self, mesh=None, plotter_params=None, off_screen=True):
+        import pyvista as pv
+
+        self.mesh = mesh
+        self.plotter = pv.Plotter(off_screen=off_screen, **(plotter_params or {}))
+        self.actors = {}
+        self.shadows = False
+        self.eye_dome_lighting = False
+
+        light = pv.Light(intensity=0.7)
+        light.set_direction_angle(300, -20)
+        self.plotter.add_light(light)
+        self.plotter.enable_anti_aliasing(aa_type='msaa')
+
+    def _actor(self, plot_actor_params=None):
+        key = json.dumps(plot_actor_params or {}, sort_keys=True, default=str)
+        if key not in self.actors:
+            first = not self.actors
+            self.actors[key] = self.plotter.add_mesh(self.mesh, reset_camera=first, **(plot_actor_params or {}))
+            if first: # grid and bounding box follow bounds of the first actor
+                self.plotter.show_grid(color='lightgrey', font_size=36)
+                self.plotter.add_bounding_box(opacity=0.75, color='lightgrey')
+        for other_key, actor in self.actors.items():
+            actor.SetVisibility(other_key == key)
+        return self.actors[key]
+
+    def render(self, plot_actor_params=None, plot_isometric=True, enable_shades=False, enable_eye_dome_lighting=False,
+               magnification=1, output_path=None):
+        """Sets up a view and returns its screenshot array, params are the ones of `build_plotter`
+
+            * `magnification` > 1 renders a tiled screenshot of `magnification` times the window size,
+                streamed into `output_path` if given, see `screenshot_tiled`
+        """
+        self._actor(plot_actor_params)
+        if plot_isometric:
+            self.plotter.view_isometric()
+        else:
+            self.plotter.view_xy()
+            self.plotter.camera.zoom(1.25)
+        if enable_shades != self.shadows:
+            self.plotter.enable_shadows() if enable_shades else self.plotter.disable_shadows()
+            self.shadows = enable_shades
+        if enable_eye_dome_lighting != self.eye_dome_lighting:
+            if enable_eye_dome_lighting:
+                self.plotter.enable_eye_dome_lighting()
+            else:
+                self.plotter.disable_eye_dome_lighting()
+            self.eye_dome_lighting = enable_eye_dome_lighting
+        if magnification > 1 or output_path is not None:
+            return screenshot_tiled(self.plotter, magnification, output_path)
+        return self.plotter.screenshot(filename=None, return_img=True)
+
+    def close(self):
+        """Releases the render context and actors"""
+        self.plotter.close()
+        self.plotter.deep_clean()
+        self.actors.clear()
+
+def tiled_window_size(output_size=None, tile_size=2000):
+    """Returns magnification and window size rendering `output_size` in tiles not bigger than `tile_size`
+
+        * Output is `magnification` times the window size, up to `magnification` - 1 pixels bigger than asked
+    """
+    magnification = max(1, math.ceil(max(output_size) / tile_size))
+    return magnification, [math.ceil(output_size[0] / magnification), math.ceil(output_size[1] / magnification)]
+
+def _open_tiled_output(output_path=None, shape=None):
+    """Returns a writer of image tiles (rows, cols, tile) and a function returning the result"""
+    if output_path is not None and output_path.lower().endswith(('.tif', '.tiff')):
+        import rasterio
+        from rasterio.windows import Window
+
+        profile = {"driver" : "GTiff", "width" : shape[1], "height" : shape[0], "count" : shape[2], "dtype" : "uint8",
+                   "tiled" : True, "blockxsize" : 256, "blockysize" : 256, "compress" : "deflate",
+                   "photometric" : "RGB", "BIGTIFF" : "IF_SAFER"}
+        if shape[2] == 4:
+            profile["alpha"] = "YES"
+        dst = rasterio.open(output_path, "w", **profile)
+        def write(row, col, tile):
+            dst.write(np.moveaxis(tile, -1, 0), window=Window(col, row, tile.shape[1], tile.shape[0]))
+        def finish():
+            dst.close()
+            return output_path
+        return write, finish
+
+    if output_path is not None and output_path.lower().endswith('.npy'):
+        output = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.uint8, shape=shape)
+    else:
+        output = np.empty(shape, dtype=np.uint8)
+    def write(row, col, tile):
+        output[row:row + tile.shape[0], col:col + tile.shape[1]] = tile
+    def finish():
+        if isinstance(output, np.memmap):
+            output.flush()
+        return output
+    return write, finish
+
+def screenshot_tiled(plotter=None, magnification=2, output_path=None):
+    """Renders a screenshot `magnification` times bigger than the window, tile by tile
+
+        * The camera view angle (parallel scale) is narrowed `magnification` times and the window centre
+            is shifted over a `magnification` x `magnification` grid of sub-frusta, as `vtkRenderLargeImage`
+        * Only one window sized framebuffer is used, tiles are streamed into the output
+        * Screen space effects (eye dome lighting, text of grid labels) are computed per tile
+
+        Returns the image array (memory-mapped for .npy) or `output_path` of a tiled TIFF
+
+    Parameters
+    ----------
+    plotter : pyvista.Plotter
+        plotter with a view set up
+    magnification : int
+        output size in window sizes
+    output_path : str or None
+        .tif (tiled, deflate) or .npy (memory-mapped) to stream tiles into, in memory if None
+    """
+    camera = plotter.camera
+    view_angle, parallel_scale, window_center = camera.GetViewAngle(), camera.GetParallelScale(), camera.GetWindowCenter()
+    camera.SetViewAngle(math.degrees(2. * math.atan(math.tan(math.radians(view_angle) / 2.) / magnification)))
+    camera.SetParallelScale(parallel_scale / magnification)
+    write, finish = None, None
+    try:
+        for tile_row in range(magnification): # from the top
+            for tile_col in range(magnification):
+                camera.SetWindowCenter(2 * tile_col - magnification + 1, magnification - 1 - 2 * tile_row)
+                tile = plotter.screenshot(filename=None, return_img=True)
+                if write is None:
+                    write, finish = _open_tiled_output(output_path, (tile.shape[0] * magnification,
+                                                                     tile.shape[1] * magnification, tile.shape[2]))
+                write(tile_row * tile.shape[0], tile_col * tile.shape[1], tile)
+                del tile
+    finally:
+        camera.SetViewAngle(view_angle)
+        camera.SetParallelScale(parallel_scale)
+        camera.SetWindowCenter(*window_center)
+    return finish()
+
+def render_views(mesh=None, plotter_params=None, views=None):
+    """Renders and saves many views of a mesh from one `RenderSession` (in the current process)
+
+    Parameters
+    ----------
+    mesh : pyvista.DataSet
+        mesh to render
+    plotter_params : dict
+        params of `pyvista.Plotter`
+    views : list
+        dicts with `plot_filename` and params of `RenderSession.render`
+    """
+    session = RenderSession(mesh, plotter_params)
+    try:
+        for view in views:
+            view = dict(view)
+            plot_filename = view.pop("plot_filename")
+            print(f"\t{datetime.datetime.now()} Render {plot_filename}")
+            image_writer().submit(session.render(**view), plot_filename)
+        image_writer().wait()
+    finally:
+        session.close()
+        gc.collect()
+
+def save_rendered_image(image=None, plot_filename=None, save_np_array=False, array_format='npz',
+                        compress_level=6, optimize=False, quality=95):
+    """Saves a screenshot array with PIL (no 4K limit of `pyvista` screenshots), optionally the raw array too
+
+    Parameters
+    ----------
+    image : np.array
+        screenshot (rows, cols, RGB or RGBA)
+    plot_filename : str
+        output file (.png, .jpg)
+    save_np_array : bool
+        if also dump the raw array, `{plot_filename}.array.npz` or `.npy`
+    array_format : str
+        `npz` (compressed) or `npy` (memory-mapped, written page by page)
+    compress_level : int
+        PNG zlib level, 0 (fastest, biggest) - 9 (slowest, smallest)
+    optimize : bool
+        if search for the smallest PNG/JPEG encoding (much slower)
+    quality : int
+        JPEG quality
+    """
+    from PIL import Image
+
+    if save_np_array:
+        if array_format == 'npy':
+            array = np.lib.format.open_memmap(plot_filename + ".array.npy", mode='w+', dtype=image.dtype, shape=image.shape)
+            array[:] = image
+            array.flush()
+            del array
+        else:
+            np.savez_compressed(plot_filename + ".array.npz", image=image)
+    if plot_filename.lower().endswith(('.jpg', '.jpeg')):
+        Image.fromarray(image[..., :3]).save(plot_filename, quality=quality, optimize=optimize)
+    else:
+        Image.fromarray(image).save(plot_filename, compress_level=compress_level, optimize=optimize)
+
+class BackgroundImageWriter:
+    """Encodes and writes screenshots on one background thread, so the next render starts meanwhile
+
+        * At most `max_pending` images wait for encoding, `submit` blocks on the oldest one beyond that
+        * `submit` returns a future of the write, `wait` raises the first error of writes it waited for
+
+    Parameters
+    ----------
+    max_pending : int
+        images held in memory for encoding
+    """
+    def __init__(self, max_pending=2):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image_writer')
+        self.pending = collections.deque()
+        self.max_pending = max_pending
+
+    def submit(self, image=None, plot_filename=None, **save_params):
+        """Queues `save_rendered_image(image, plot_filename, **save_params)`, returns its future"""
+        while len(self.pending) >= self.max_pending:
+            self.pending[0].exception() # waits, errors stay in the future
+            self.pending.popleft()
+        future = self.executor.submit(save_rendered_image, image, plot_filename, **save_params)
+        self.pending.append(future)
+        return future
+
+    def wait(self):
+        """Blocks until all queued images are written"""
+        errors = [future.exception() for future in self.pending]
+        self.pending.clear()
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+_IMAGE_WRITER = None
+
+def image_writer():
+    """Returns the background image writer of the process (created on first use)"""
+    global _IMAGE_WRITER
+    if _IMAGE_WRITER is None:
+        _IMAGE_WRITER = BackgroundImageWriter()
+    return _IMAGE_WRITER
+
+def height_memmap_path(raster_path=None, memmap_folder=None, factor=1):
+    """Returns path of a memory-mapped .npy of heights of a raster at overview `factor`"""
+    name = os.path.splitext(os.path.basename(raster_path))[0]
+    return os.path.join(memmap_folder, f"{name}_heights_x{factor}.npy")
+
+_WORKER_STATE = {}
+
+def _init_render_worker(raster_path=None, memmap_folder=None):
+    """Starts a virtual display for the worker, meshes are loaded lazily (once per overview factor)"""
+    import pyvista as pv
+
+    if not os.environ.get("DISPLAY"):
+        pv.start_xvfb()
+    pv.global_theme.transparent_background = True
+    _WORKER_STATE.update(raster_path=raster_path, memmap_folder=memmap_folder, meshes={})
+
+def _worker_mesh(factor=1):
+    from src.raster_mesh import read_raster_mesh
+
+    meshes = _WORKER_STATE["meshes"]
+    if factor not in meshes:
+        memmap_path = height_memmap_path(_WORKER_STATE["raster_path"], _WORKER_STATE["memmap_folder"], factor)
+        meshes[factor] = read_raster_mesh(_WORKER_STATE["raster_path"], factor=factor, memmap_path=memmap_path,
+                                          scalars_name='data', warp=True)
+    return meshes[factor]
+
+def render_job(job=None):
+    """Renders one job in a worker, returns a result record of the job (never raises)
+
+        * `save render` - screenshot saved by `save_rendered_image`
+        * `save render orbiting` (.gif), `save render orbiting video` (.mp4) - orbit in this process only,
+            `render_orbit` splits frames over processes
+    """
+    job = {**RENDER_JOB_DEFAULTS, **job}
+    result = {"plot_filename" : job["plot_filename"], "success" : False, "pid" : os.getpid(),
+              "wall_time" : 0., "max_rss_mb" : 0., "error" : None, "started_at" : time.time()}
+    start = time.perf_counter()
+    plotter = None
+    try:
+        mesh = _worker_mesh(job["factor"])
+        plotter = build_plotter(mesh, job["plotter_params"], job["plot_actor_params"], job["plot_isometric"],
+                                job["enable_shades"], job["enable_eye_dome_lighting"])
+        if job["save_plot_mode"] in ORBIT_MODES:
+            plotter.camera.zoom(1.5)
+            path = plotter.generate_orbital_path(n_points=job["n_frames"], shift=mesh.length, viewup=(0, 0, 1))
+            if job["save_plot_mode"] == 'save render orbiting video':
+                plotter.open_movie(job["plot_filename"], framerate=job["fps"])
+            else:
+                plotter.open_gif(job["plot_filename"])
+            plotter.orbit_on_path(path, write_frames=True, viewup=(0, 0, 1))
+        else:
+            save_rendered_image(plotter.screenshot(filename=None, return_img=True), job["plot_filename"])
+        result["success"] = True
+    except Exception as error: # reported in the summary, other jobs go on
+        result["error"] = f"{type(error).__name__}: {error}"
+    finally:
+        if plotter is not None:
+            plotter.close()
+            plotter.deep_clean()
+        gc.collect()
+        result["wall_time"] = time.perf_counter() - start
+        result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. # worker peak so far
+    return result
+
+def _orbit_frame_worker(raster_path=None, memmap_folder=None, job=None, frame_indices=None, frames=None):
+    """Renders frames `frame_indices` of an orbit and puts (index, frame) into `frames` queue
+
+        * Every worker builds the same plotter and camera path, so frames don't depend on the split
+    """
+    try:
+        _init_render_worker(raster_path, memmap_folder)
+        mesh = _worker_mesh(job["factor"])
+        plotter = build_plotter(mesh, job["plotter_params"], job["plot_actor_params"], job["plot_isometric"],
+                                job["enable_shades"], job["enable_eye_dome_lighting"])
+        plotter.camera.zoom(1.5)
+        path = plotter.generate_orbital_path(n_points=job["n_frames"], shift=mesh.length, viewup=(0, 0, 1))
+        focus = plotter.center
+        for index in frame_indices: # as `pyvista.Plotter.orbit_on_path`
+            plotter.set_position(path.points[index], render=False)
+            plotter.set_focus(focus, render=False)
+            plotter.set_viewup((0, 0, 1), render=False)
+            plotter.renderer.ResetCameraClippingRange()
+            frames.put((index, plotter.screenshot(filename=None, return_img=True)[..., :3]))
+        plotter.close()
+    except Exception as error: # the encoder stops on it, the parent reports it
+        frames.put((None, f"{type(error).__name__}: {error}"))
+
+def _orbit_encoder(frames=None, results=None, plot_filename=None, n_frames=72, fps=24, frame_timeout=ORBIT_FRAME_TIMEOUT):
+    """Writes frames from `frames` queue in index order into a GIF or MP4 (imageio, ffmpeg for video)
+
+        * Fails if no frame arrives for `frame_timeout` seconds (f.e. a worker died in VTK without reporting)
+        * GIF frames take `duration` (ms per frame, imageio >= 2.28 pillow plugin), `fps` is a video option only
+    """
+    import imageio
+    import queue
+
+    start = time.perf_counter()
+    buffered, next_index, error, max_buffered = {}, 0, None, 0
+    if plot_filename.lower().endswith('.gif'):
+        writer = imageio.get_writer(plot_filename, mode='I', duration=1000. / fps, loop=0)
+    else:
+        writer = imageio.get_writer(plot_filename, mode='I', fps=fps)
+    try:
+        while next_index < n_frames:
+            try:
+                index, frame = frames.get(timeout=frame_timeout)
+            except queue.Empty:
+                error = f"no frame for {frame_timeout:.0f} s, {next_index} of {n_frames} frames encoded"
+                break
+            if index is None:
+                error = frame
+                break
+            buffered[index] = frame
+            max_buffered = max(max_buffered, len(buffered))
+            while next_index in buffered:
+                writer.append_data(buffered.pop(next_index))
+                next_index += 1
+    except Exception as exception:
+        error = f"{type(exception).__name__}: {exception}"
+    finally:
+        writer.close()
+    results.put({"frames" : next_index, "error" : error, "max_buffered" : max_buffered,
+                 "encoder_time" : time.perf_counter() - start})
+
+def render_orbit(job=None, raster_path=None, memmap_folder=None, n_workers=2, queue_size=None):
+    """Renders an orbit with frames split over worker processes, encoded in order by a separate process
+
+        Returns a result record of the orbit (frames/sec, peak frames waiting for their turn)
+
+        Logic:
+        - 1. WORKER i RENDERS FRAMES i, i + N, i + 2N... (INTERLEAVED, SO FRAMES ARRIVE ROUGHLY IN ORDER)
+        - 2. FRAMES GO INTO A BOUNDED QUEUE, WORKERS WAIT WHEN IT IS FULL
+        - 3. ENCODER BUFFERS OUT-OF-ORDER FRAMES AND APPENDS THEM STRICTLY BY INDEX (DETERMINISTIC OUTPUT)
+        - 4. PARENT WAITS FOR THE ENCODER RESULT, CHECKING EVERY `ORBIT_POLL_SECONDS` THAT NO PROCESS DIED,
+             RAISES `RuntimeError` (OTHER PROCESSES TERMINATED) IF ONE DID
+
+    Parameters
+    ----------
+    job : dict
+        render job with `save_plot_mode` `save render orbiting` (.gif) or `save render orbiting video` (.mp4),
+        `n_frames` and `fps`
+    raster_path : str
+        path to a raster mosaic
+    memmap_folder : str
+        folder of memory-mapped heights, see `render_jobs`
+    n_workers : int
+        number of frame rendering processes
+    queue_size : int or None
+        frames in flight between workers and the encoder, 2 per worker if None
+    """
+    import multiprocessing
+    import queue
+    from src.raster_mesh import read_height_array
+
+    job = {**RENDER_JOB_DEFAULTS, **job}
+    os.makedirs(memmap_folder, exist_ok=True)
+    read_height_array(raster_path, factor=job["factor"],
+                      memmap_path=height_memmap_path(raster_path, memmap_folder, job["factor"]))
+    n_workers = max(1, min(n_workers, job["n_frames"]))
+    context = multiprocessing.get_context('spawn')
+    frames, results = context.Queue(maxsize=queue_size or 2 * n_workers), context.Queue()
+
+    started_at, start = time.time(), time.perf_counter()
+    encoder = context.Process(target=_orbit_encoder,
+                              args=(frames, results, job["plot_filename"], job["n_frames"], job["fps"]))
+    encoder.start()
+    workers = [context.Process(target=_orbit_frame_worker,
+                               args=(raster_path, memmap_folder, job, list(range(worker, job["n_frames"], n_workers)), frames))
+               for worker in range(n_workers)]
+    for worker in workers:
+        worker.start()
+    encoded = None # the encoder finishes (or fails) before workers are joined, frames are drained
+    while encoded is None:
+        try:
+            encoded = results.get(timeout=ORBIT_POLL_SECONDS)
+        except queue.Empty:
+            died = [process for process in [encoder, *workers] if process.exitcode not in (None, 0)]
+            if encoder.exitcode is not None and results.empty(): # finished without a result
+                died.append(encoder)
+            if died:
+                for process in [encoder, *workers]:
+                    process.terminate()
+                    process.join()
+                raise RuntimeError(f"orbit {job['plot_filename']} : process {died[0].pid} died "
+                                   f"(exit code {died[0].exitcode}), other processes terminated")
+    for worker in workers:
+        if encoded["error"]:
+            worker.terminate()
+        worker.join()
+    encoder.join()
+
+    wall_time = time.perf_counter() - start
+    result = {"plot_filename" : job["plot_filename"], "success" : encoded["error"] is None, "pid" : encoder.pid,
+              "wall_time" : wall_time, "max_rss_mb" : 0., "error" : encoded["error"], "frames" : encoded["frames"],
+              "started_at" : started_at,
+              "frames_per_sec" : encoded["frames"] / wall_time, "max_buffered" : encoded["max_buffered"]}
+    print(f"\t{datetime.datetime.now()} Orbit {job['plot_filename']} : {encoded['frames']}/{job['n_frames']} frames "
+          f"in {wall_time:.1f} s, {result['frames_per_sec']:.2f} frames/sec, {n_workers} workers, "
+          f"at most {encoded['max_buffered']} frames waiting for their turn")
+    return result
+
+def render_session(jobs=None):
+    """Renders still jobs of one window size and overview level from one `RenderSession` in a worker
+
+        Returns result records of jobs (never raises), session setup time is reported separately from view times
+    """
+    jobs = [{**RENDER_JOB_DEFAULTS, **job} for job in jobs]
+    results = [{"plot_filename" : job["plot_filename"], "success" : False, "pid" : os.getpid(),
+                "wall_time" : 0., "setup_time" : 0., "max_rss_mb" : 0., "error" : None,
+                "started_at" : None} for job in jobs]
+    start = time.perf_counter()
+    session, writes = None, []
+    try:
+        plotter_params, magnification = jobs[0]["plotter_params"], 1
+        if jobs[0]["tile_size"]: # window of one tile, the big output is assembled from tiles
+            magnification, window_size = tiled_window_size(plotter_params["window_size"], jobs[0]["tile_size"])
+            plotter_params = {**plotter_params, "window_size" : window_size}
+        session = RenderSession(_worker_mesh(jobs[0]["factor"]), plotter_params)
+        setup_time = time.perf_counter() - start
+        for job, result in zip(jobs, results):
+            start = time.perf_counter()
+            result["setup_time"], result["started_at"] = setup_time, time.time()
+            try:
+                tiff = job["plot_filename"].lower().endswith(('.tif', '.tiff'))
+                image = session.render(job["plot_actor_params"], job["plot_isometric"],
+                                       job["enable_shades"], job["enable_eye_dome_lighting"],
+                                       magnification=magnification, output_path=job["plot_filename"] if tiff else None)
+                if not tiff: # tiled TIFFs are written while rendering, others while the next view renders
+                    writes.append((result, image_writer().submit(image, job["plot_filename"])))
+                del image
+                result["success"] = True
+            except Exception as error: # reported in the summary, other views go on
+                result["error"] = f"{type(error).__name__}: {error}"
+            result["wall_time"] = time.perf_counter() - start
+            result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    except Exception as error: # session couldn't be set up, all its views failed
+        for result in results:
+            result["error"] = result["error"] or f"{type(error).__name__}: {error}"
+    finally:
+        for result, write in writes:
+            if write.exception() is not None:
+                result.update(success=False, error=f"{type(write.exception()).__name__}: {write.exception()}")
+        if session is not None:
+            session.close()
+        gc.collect()
+    return results
+
+def group_render_jobs(jobs=None, n_workers=1):
+    """Splits jobs into tasks, stills of the same window and overview level share sessions
+
+        * Every group of stills is split into up to `n_workers` sessions, so sessions still run in parallel
+        * Returns tasks, lists of (position of a job, job), orbit jobs are tasks of their own
+    """
+    tasks, groups = [], {}
+    for position, job in enumerate(jobs):
+        job = {**RENDER_JOB_DEFAULTS, **job}
+        if job["save_plot_mode"] != 'save render':
+            tasks.append([(position, job)])
+            continue
+        key = (json.dumps(job["plotter_params"], sort_keys=True), job["factor"], job["tile_size"])
+        groups.setdefault(key, []).append((position, job))
+    for group in groups.values():
+        n_sessions = min(n_workers, len(group))
+        tasks += [group[start::n_sessions] for start in range(n_sessions)]
+    return tasks
+
+def _render_task(task=None):
+    if len(task) == 1 and task[0][1]["save_plot_mode"] != 'save render':
+        return [render_job(task[0][1])]
+    return render_session([job for _, job in task])
+
+def render_workers(raster_path=None, factor=1, max_workers=None):
+    """Returns number of render workers whose meshes (at overview `factor`) fit in available memory
+
+        * Every worker warps its own mesh from the shared heights, that dominates its memory,
+            framebuffers of tiled screenshots (f.e. 2000x2000) are small next to it
+    """
+    import rasterio
+
+    with rasterio.open(raster_path) as src:
+        mesh_bytes = math.ceil(src.height / factor) * math.ceil(src.width / factor) * MESH_BYTES_PER_CELL
+    available_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    return max(1, min(max_workers or os.cpu_count(), available_bytes // max(mesh_bytes, 1)))
+
+def render_jobs(jobs=None, raster_path=None, memmap_folder=None, n_workers=2):
+    """Renders jobs over a process pool, every worker loads a mesh once per overview factor
+
+        Takes render jobs, dicts of `plot_3D` params plus `factor` (overview level), see `RENDER_JOB_DEFAULTS`
+        Returns result records of jobs (wall time and peak RSS of a worker)
+
+        Logic:
+        - 1. READ HEIGHTS OF EVERY NEEDED FACTOR ONCE INTO MEMORY-MAPPED .NPY FILES
+        - 2. WORKERS MAP THEM (SHARED PAGE CACHE) AND BUILD THEIR MESHES ONCE
+        - 3. ORBITS RUN ONE BY ONE, THEIR FRAMES OVER ALL WORKERS (`render_orbit`)
+        - 4. STILLS RUN IN PARALLEL, STILLS OF THE SAME WINDOW AND LEVEL SHARE A `RenderSession` (SETUP ONCE),
+             JOBS OF A FAILED TASK (F.E. `BrokenProcessPool`, A WORKER DIED IN VTK) GET FAILED RECORDS
+
+    Parameters
+    ----------
+    jobs : list
+        render jobs
+    raster_path : str
+        path to a raster mosaic
+    memmap_folder : str
+        folder of memory-mapped heights
+    n_workers : int
+        number of worker processes, every worker renders into its own offscreen framebuffer
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from src.raster_mesh import read_height_array
+
+    os.makedirs(memmap_folder, exist_ok=True)
+    for factor in sorted({job.get("factor", 1) for job in jobs}):
+        read_height_array(raster_path, factor=factor,
+                          memmap_path=height_memmap_path(raster_path, memmap_folder, factor))
+        gc.collect()
+
+    print(f"\t{datetime.datetime.now()} Render {len(jobs)} jobs, {n_workers} workers")
+    start = time.perf_counter()
+    results = [None] * len(jobs)
+    for position, job in enumerate(jobs): # orbits use all workers for their frames
+        if job.get("save_plot_mode") in ORBIT_MODES:
+            try:
+                results[position] = render_orbit(job, raster_path, memmap_folder, n_workers=n_workers)
+            except RuntimeError as error: # a process of the orbit died, other jobs go on
+                results[position] = _failed_render_result(job, str(error))
+    stills = [(position, job) for position, job in enumerate(jobs) if job.get("save_plot_mode") not in ORBIT_MODES]
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_render_worker, initargs=(raster_path, memmap_folder)) as pool:
+        tasks = group_render_jobs([job for _, job in stills], n_workers)
+        futures = [pool.submit(_render_task, task) for task in tasks]
+        for task, future in zip(tasks, futures):
+            try:
+                task_results = future.result()
+            except Exception as error: # the worker died (`BrokenProcessPool`), its jobs and queued ones fail
+                task_results = [_failed_render_result(job, f"{type(error).__name__}: {error}") for _, job in task]
+            for (position, _), result in zip(task, task_results):
+                results[stills[position][0]] = result
+    print_render_report(results, time.perf_counter() - start)
+    return results
+
+def _failed_render_result(job=None, error=None):
+    """Returns a result record of a render job which didn't return one"""
+    return {"plot_filename" : job.get("plot_filename"), "success" : False, "pid" : None,
+            "wall_time" : 0., "max_rss_mb" : 0., "error" : error, "started_at" : None}
+
+def print_render_report(results=None, wall_time=0.):
+    """Prints wall time and peak RSS per render job"""
+    for result in results:
+        status = 'ok' if result["success"] else f"FAILED {result['error']}"
+        setup = f" (+ {result['setup_time']:.1f} s shared session setup)" if result.get("setup_time") else ''
+        print(f"\t\t{result['plot_filename']} : {result['wall_time']:.1f} s{setup}, worker {result['pid']} "
+              f"peak {result['max_rss_mb']:.0f} MB, {status}")
+    print(f"\t\t{sum(result['success'] for result in results)}/{len(results)} jobs in {wall_time:.1f} s "
+          f"(sum of job times {sum(result['wall_time'] for result in results):.1f} s)")
@@ -0,0 +1,249 @@
+"""
+On-disk cache of pipeline stage outputs, so re-runs of `get_data._main_get_data` skip unchanged work.
+    * An entry is keyed by hashes of input files (content, not names) plus exact stage parameters
+    * Entries are evicted in LRU order when the cache grows above `max_size_gb`
+
+Example
+    python -m src.stage_cache stats --cache-dir /kaggle/working/stage_cache/
+    python -m src.stage_cache evict --cache-dir /kaggle/working/stage_cache/ --max-size-gb 20
+"""
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+
+HASH_BLOCK_SIZE = 8 * 1024 ** 2
+
+class StageCache:
+    """Content-addressed cache of stage outputs
+
+        Layout of `cache_dir`
+            index.json          - entries (stage, outputs, size, last access, hits) and hit/miss counters,
+                                  written by `flush` (once per stage), not after every tile
+            file_hashes.json    - memo of input hashes by (path, size, mtime), so big tiles aren't re-hashed,
+                                  written by `flush` too
+            objects/<key>/      - cached output files
+
+    Parameters
+    ----------
+    cache_dir : str
+        folder of the cache
+    max_size_gb : float
+        size limit, least recently used entries are evicted above it
+    """
+    def __init__(self, cache_dir='/kaggle/working/stage_cache/', max_size_gb=50.):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_gb * 1024 ** 3)
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self._index = self._load_json('index.json', {"entries" : {}, "hits" : 0, "misses" : 0})
+        self._index_dirty = False
+        self._file_hashes = self._load_json('file_hashes.json', {})
+        self._file_hashes_dirty = False
+
+    def _load_json(self, file_name, default):
+        path = os.path.join(self.cache_dir, file_name)
+        if not os.path.exists(path):
+            return default
+        with open(path) as file:
+            return json.load(file)
+
+    def _save_json(self, file_name, data):
+        path = os.path.join(self.cache_dir, file_name)
+        with open(path + '.tmp', 'w') as file:
+            json.dump(data, file, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def file_hash(self, file_path):
+        """Returns sha256 of a file content, memoized by (absolute path, size, mtime)
+
+            * A folder (f.e. a point store) hashes names and hashes of its files
+        """
+        if os.path.isdir(file_path):
+            digest = hashlib.sha256()
+            for name in sorted(os.listdir(file_path)):
+                digest.update(name.encode())
+                digest.update(self.file_hash(os.path.join(file_path, name)).encode())
+            return digest.hexdigest()
+        stat = os.stat(file_path)
+        memo_key = os.path.abspath(file_path)
+        memo = self._file_hashes.get(memo_key)
+        if memo and memo["size"] == stat.st_size and memo["mtime_ns"] == stat.st_mtime_ns:
+            return memo["sha256"]
+
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        self._file_hashes[memo_key] = {"size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns,
+                                       "sha256" : digest.hexdigest()}
+        self._file_hashes_dirty = True
+        return digest.hexdigest()
+
+    def flush(self):
+        """Writes the index and new memoized hashes, call once at the end of a stage
+
+            * Entries stored since the last flush are lost if a run dies before it, their objects are overwritten
+                by the next `store`, unsaved hashes are re-hashed
+        """
+        if self._index_dirty:
+            self._save_json('index.json', self._index)
+            self._index_dirty = False
+        if self._file_hashes_dirty:
+            self._save_json('file_hashes.json', self._file_hashes)
+            self._file_hashes_dirty = False
+
+    def key(self, stage=None, input_files=None, params=None):
+        """Returns a key of a stage run, sha256 of stage name, sorted input hashes and parameters
+
+        Parameters
+        ----------
+        stage : str
+            name of a stage, f.e. `filter`, `rasterize`, `mosaic`
+        input_files : list
+            paths to input files, order doesn't matter
+        params : dict
+            all parameters changing output of a stage, must be JSON serializable
+        """
+        digest = hashlib.sha256(stage.encode())
+        for input_hash in sorted(self.file_hash(file) for file in input_files):
+            digest.update(input_hash.encode())
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def restore(self, stage=None, input_files=None, params=None, output_folder=None, output_paths=None):
+        """Copies cached outputs of a stage run, returns (hit, paths to restored files), (False, None) on a miss
+
+            * A hit may restore no files (f.e. a tile clipped away), check `hit`, not the paths
+            * An entry with missing objects (f.e. removed `objects/`) is dropped and counts as a miss
+
+        Parameters
+        ----------
+        stage, input_files, params :
+            see `key`
+        output_folder : str
+            folder to restore outputs to, with their original names
+        output_paths : list
+            or exact paths to restore outputs to, in the order they were stored
+        """
+        key = self.key(stage, input_files, params)
+        entry = self._index["entries"].get(key)
+        object_paths = [os.path.join(self.cache_dir, 'objects', key, name) for name in (entry or {}).get("outputs", [])]
+        if entry is not None and not all(os.path.isfile(path) for path in object_paths):
+            del self._index["entries"][key]
+            entry = None
+        self._index_dirty = True
+        if entry is None:
+            self._index["misses"] += 1
+            return False, None
+
+        if output_paths is None:
+            output_paths = [os.path.join(output_folder, name) for name in entry["outputs"]]
+        output_paths = output_paths[:len(entry["outputs"])]
+        for object_path, output_path in zip(object_paths, output_paths):
+            _copy_file(object_path, output_path)
+
+        entry["last_access"] = time.time()
+        entry["hits"] += 1
+        self._index["hits"] += 1
+        print(f"\t\tcache hit {stage} : {key[:12]}, restored {len(output_paths)} files")
+        return True, output_paths
+
+    def store(self, stage=None, input_files=None, params=None, output_files=None):
+        """Stores outputs of a stage run, evicts old entries (never the stored one) if the cache is too big
+
+        Parameters
+        ----------
+        stage, input_files, params :
+            see `key`
+        output_files : list
+            paths to outputs of a stage run
+        """
+        key = self.key(stage, input_files, params)
+        entry_dir = os.path.join(self.cache_dir, 'objects', key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.makedirs(entry_dir)
+        for file in output_files:
+            _copy_file(file, os.path.join(entry_dir, os.path.basename(file)))
+
+        self._index["entries"][key] = {"stage" : stage, "outputs" : [os.path.basename(file) for file in output_files],
+                                       "size" : sum(os.path.getsize(file) for file in output_files),
+                                       "created" : time.time(), "last_access" : time.time(), "hits" : 0}
+        self._index_dirty = True
+        self.evict(keep=key)
+        return key
+
+    def evict(self, max_size_bytes=None, keep=None):
+        """Removes least recently used entries until the cache fits `max_size_bytes`, returns number of removed entries
+
+            * The entry `keep` (f.e. just stored) is never removed, even if it alone is above `max_size_bytes`
+        """
+        max_size_bytes = self.max_size_bytes if max_size_bytes is None else max_size_bytes
+        entries = self._index["entries"]
+        total_size = sum(entry["size"] for entry in entries.values())
+        evicted = 0
+        for key in sorted(entries, key=lambda key: entries[key]["last_access"]):
+            if total_size <= max_size_bytes:
+                break
+            if key == keep:
+                continue
+            total_size -= entries[key]["size"]
+            shutil.rmtree(os.path.join(self.cache_dir, 'objects', key), ignore_errors=True)
+            del entries[key]
+            evicted += 1
+        if evicted:
+            self._index_dirty = True
+        return evicted
+
+    def stats(self):
+        """Returns statistics of the cache (entries, size, hits and misses, per stage)"""
+        stages = {}
+        for entry in self._index["entries"].values():
+            stage = stages.setdefault(entry["stage"], {"entries" : 0, "size" : 0, "hits" : 0})
+            stage["entries"] += 1
+            stage["size"] += entry["size"]
+            stage["hits"] += entry["hits"]
+        requests = self._index["hits"] + self._index["misses"]
+        return {"entries" : len(self._index["entries"]),
+                "size" : sum(stage["size"] for stage in stages.values()),
+                "max_size" : self.max_size_bytes,
+                "hits" : self._index["hits"], "misses" : self._index["misses"],
+                "hit_rate" : self._index["hits"] / requests if requests else 0.,
+                "stages" : stages}
+
+    def print_stats(self):
+        """Prints `stats` report"""
+        self.flush()
+        stats = self.stats()
+        print(f"\t{datetime.datetime.now()} Stage cache {self.cache_dir}")
+        print(f"\t\tentries : {stats['entries']}, size : {stats['size'] / 1024 ** 3:.2f} "
+              f"of {stats['max_size'] / 1024 ** 3:.2f} GB")
+        print(f"\t\thits : {stats['hits']}, misses : {stats['misses']}, hit rate : {stats['hit_rate']:.1%}")
+        for stage, stage_stats in sorted(stats["stages"].items()):
+            print(f"\t\t{stage:<16} entries : {stage_stats['entries']:>5}, "
+                  f"size : {stage_stats['size'] / 1024 ** 3:.2f} GB, hits : {stage_stats['hits']}")
+
+def _copy_file(source, destination):
+    """Copies `source` to `destination`
+
+        * Not hard links, whitebox tools overwrite existing outputs in place, that would alter cached files
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    shutil.copy2(source, destination)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Stage cache report and maintenance')
+    parser.add_argument('command', choices=['stats', 'evict'])
+    parser.add_argument('--cache-dir', default='/kaggle/working/stage_cache/')
+    parser.add_argument('--max-size-gb', type=float, default=50.)
+    arguments = parser.parse_args()
+
+    cache = StageCache(cache_dir=arguments.cache_dir, max_size_gb=arguments.max_size_gb)
+    if arguments.command == 'evict':
+        print(f"\tevicted {cache.evict()} entries")
+        cache.flush()
+    cache.print_stats()
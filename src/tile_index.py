@@ -0,0 +1,255 @@
+"""
+Spatial index of tiles by their bounding boxes (extents from LAS/LAZ headers and GeoTIFF bounds).
+    * Used to find neighbours of a tile (halo points), or tiles overlapping an area
+    * Bounds are tuples (minx, miny, maxx, maxy) in CRS of tiles
+    * For many queries (f.e. every block of a mosaic), tiles are bucketed into a regular grid
+    * `TileIndex` keeps the index in a JSON file, only new or changed tiles have their headers read,
+        stages take the tiles of a region of interest (bbox or polygon, f.e. an OSM boundary) as `input_files`
+
+Example
+    tile_index = TileIndex('/kaggle/working/tile_index.json')
+    files = tile_index.query(glob_lidar_files('/kaggle/working/laz_files/'), polygon='/kaggle/working/downtown.geojson',
+                             polygon_crs='EPSG:4326')
+"""
+import json
+import math
+import os
+
+def lidar_tile_bounds(file_path=None):
+    """Returns bounds and number of points of a LAS/LAZ tile (or a point store), read from its header only"""
+    import laspy
+    from src.point_store import is_point_store, read_store_meta
+
+    if is_point_store(file_path):
+        meta = read_store_meta(file_path)
+        minx, miny, _, maxx, maxy, _ = meta["bounds"]
+        return (minx, miny, maxx, maxy), meta["point_count"]
+    with laspy.open(file_path) as reader:
+        mins, maxs = reader.header.mins, reader.header.maxs
+        return (float(mins[0]), float(mins[1]), float(maxs[0]), float(maxs[1])), int(reader.header.point_count)
+
+def raster_tile_bounds(file_path=None):
+    """Returns bounds, resolution (x, y) and nodata of a raster tile, read from its metadata only"""
+    import rasterio
+
+    with rasterio.open(file_path) as src:
+        return tuple(src.bounds), tuple(src.res), src.nodata
+
+def build_tile_index(files=None):
+    """Returns index of tiles, list of dicts sorted by path
+
+        * LAS/LAZ tiles - `path`, `bounds`, `point_count`
+        * raster tiles (.tif) - `path`, `bounds`, `resolution`, `nodata`
+
+    Parameters
+    ----------
+    files : list
+        paths to .las, .laz or .tif tiles, or to point stores
+    """
+    tile_index = []
+    for file in sorted(files):
+        if file.lower().endswith(('.tif', '.tiff')):
+            bounds, resolution, nodata = raster_tile_bounds(file)
+            tile_index.append({"path" : os.path.abspath(file), "bounds" : bounds,
+                               "resolution" : resolution, "nodata" : nodata})
+        else:
+            bounds, point_count = lidar_tile_bounds(file)
+            tile_index.append({"path" : os.path.abspath(file), "bounds" : bounds, "point_count" : point_count})
+    return tile_index
+
+def index_bounds(tile_index=None):
+    """Returns union bounds of all tiles"""
+    return (min(tile["bounds"][0] for tile in tile_index), min(tile["bounds"][1] for tile in tile_index),
+            max(tile["bounds"][2] for tile in tile_index), max(tile["bounds"][3] for tile in tile_index))
+
+def bucket_tile_index(tile_index=None, cell_size=None):
+    """Buckets tiles into a regular grid of `cell_size`, returns buckets for `tiles_intersecting`
+
+    Parameters
+    ----------
+    tile_index : list
+        index of tiles
+    cell_size : float or None
+        size of a bucket, median tile width if None
+    """
+    if cell_size is None:
+        widths = sorted(tile["bounds"][2] - tile["bounds"][0] for tile in tile_index)
+        cell_size = max(widths[len(widths) // 2], 1e-9)
+    buckets = {}
+    for position, tile in enumerate(tile_index):
+        for key in _bucket_keys(tile["bounds"], cell_size):
+            buckets.setdefault(key, []).append(position)
+    return {"cell_size" : cell_size, "buckets" : buckets}
+
+def _bucket_keys(bounds=None, cell_size=1.):
+    for i in range(math.floor(bounds[0] / cell_size), math.floor(bounds[2] / cell_size) + 1):
+        for j in range(math.floor(bounds[1] / cell_size), math.floor(bounds[3] / cell_size) + 1):
+            yield i, j
+
+def expand_bounds(bounds=None, buffer=0.):
+    """Returns bounds grown by `buffer` on every side"""
+    return (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+
+def bounds_intersect(bounds=None, other_bounds=None):
+    """Returns True if two bounds overlap (touching edges count)"""
+    return (bounds[0] <= other_bounds[2] and other_bounds[0] <= bounds[2] and
+            bounds[1] <= other_bounds[3] and other_bounds[1] <= bounds[3])
+
+def tiles_intersecting(tile_index=None, bounds=None, buckets=None):
+    """Returns tiles of `tile_index` overlapping `bounds`, in index order
+
+    Parameters
+    ----------
+    tile_index : list
+        index of tiles
+    bounds : tuple
+        query bounds
+    buckets : dict or None
+        output of `bucket_tile_index`, all tiles are scanned if None
+    """
+    if buckets is None:
+        return [tile for tile in tile_index if bounds_intersect(tile["bounds"], bounds)]
+    positions = set()
+    for key in _bucket_keys(bounds, buckets["cell_size"]):
+        positions.update(buckets["buckets"].get(key, ()))
+    return [tile_index[position] for position in sorted(positions)
+            if bounds_intersect(tile_index[position]["bounds"], bounds)]
+
+def tile_crs(file_path=None):
+    """Returns CRS of a tile as a string (f.e. `EPSG:3059`), None if it has none or can't be parsed"""
+    try:
+        if file_path.lower().endswith(('.tif', '.tiff')):
+            import rasterio
+
+            with rasterio.open(file_path) as src:
+                return src.crs.to_string() if src.crs else None
+        from src.point_store import is_point_store, read_store_meta
+
+        if is_point_store(file_path):
+            from pyproj import CRS
+
+            wkt = read_store_meta(file_path)["crs"]
+            return CRS.from_wkt(wkt).to_string() if wkt else None
+        import laspy
+
+        with laspy.open(file_path) as reader:
+            crs = reader.header.parse_crs() # needs pyproj
+            return crs.to_string() if crs else None
+    except Exception:
+        return None
+
+def load_polygon(polygon=None, polygon_crs=None, target_crs=None):
+    """Returns a shapely geometry of a region of interest, reprojected from `polygon_crs` to `target_crs`
+
+    Parameters
+    ----------
+    polygon : str, dict, list or shapely geometry
+        path to a GeoJSON file (f.e. an OSM boundary export, features are merged), GeoJSON dict, WKT string,
+        or a list of (x, y) vertices
+    polygon_crs, target_crs : str or None
+        CRS of the polygon and of tiles, f.e. `EPSG:4326` for OSM, no reprojection if any is None
+    """
+    from shapely import wkt
+    from shapely.geometry import Polygon, shape
+    from shapely.ops import transform, unary_union
+
+    if isinstance(polygon, str) and os.path.exists(polygon):
+        with open(polygon) as file:
+            polygon = json.load(file)
+    if isinstance(polygon, str):
+        geometry = wkt.loads(polygon)
+    elif isinstance(polygon, dict):
+        features = polygon.get("features") or [polygon]
+        geometry = unary_union([shape(feature.get("geometry", feature)) for feature in features])
+    elif isinstance(polygon, (list, tuple)):
+        geometry = Polygon(polygon)
+    else:
+        geometry = polygon
+    if polygon_crs and target_crs and polygon_crs != target_crs:
+        from pyproj import Transformer
+
+        transformer = Transformer.from_crs(polygon_crs, target_crs, always_xy=True)
+        geometry = transform(transformer.transform, geometry)
+    return geometry
+
+class TileIndex:
+    """Spatial index of tiles persisted to a JSON file, updated incrementally
+
+        * Entries are keyed by absolute path, a tile is re-read only if its size or mtime changed,
+            entries of deleted files are dropped
+        * Entries are records of `build_tile_index` plus `crs`, `size` and `mtime_ns`
+
+    Parameters
+    ----------
+    index_path : str
+        JSON file of the index, created on the first `update`
+    """
+    def __init__(self, index_path='/kaggle/working/tile_index.json'):
+        self.index_path = index_path
+        self.entries = {}
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                self.entries = {tile["path"] : {**tile, "bounds" : tuple(tile["bounds"])} for tile in json.load(file)}
+
+    def save(self):
+        """Writes the index (atomically)"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        with open(self.index_path + '.tmp', 'w') as file:
+            json.dump(sorted(self.entries.values(), key=lambda tile: tile["path"]), file, indent=1)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def update(self, files=None):
+        """Indexes new or changed `files`, drops deleted ones, returns their tiles (index order)"""
+        changed = False
+        for path in [path for path in self.entries if not os.path.exists(path)]:
+            del self.entries[path]
+            changed = True
+        tiles = []
+        for file in sorted(os.path.abspath(file) for file in files):
+            stat = os.stat(file)
+            tile = self.entries.get(file)
+            if tile is None or tile["size"] != stat.st_size or tile["mtime_ns"] != stat.st_mtime_ns:
+                tile = {**build_tile_index([file])[0], "crs" : tile_crs(file),
+                        "size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns}
+                self.entries[file] = tile
+                changed = True
+            tiles.append(tile)
+        if changed:
+            self.save()
+        return tiles
+
+    def query(self, files=None, bounds=None, polygon=None, polygon_crs=None):
+        """Returns paths of `files` whose tiles intersect `bounds` and `polygon`, all of them if both are None
+
+            * Tiles are prefiltered by bounds (of the polygon too), only remaining ones are tested against the polygon
+            * Raises ValueError if `polygon_crs` is given but tiles have no CRS or different ones,
+                the polygon can't be reprojected and the query would silently miss tiles
+
+        Parameters
+        ----------
+        files : list
+            candidate tiles (.las, .laz or .tif), f.e. `glob_lidar_files(folder)`, indexed if needed
+        bounds : tuple or None
+            (minx, miny, maxx, maxy) in CRS of tiles
+        polygon : str, dict, list, shapely geometry or None
+            region of interest, see `load_polygon`
+        polygon_crs : str or None
+            CRS of the polygon, reprojected to CRS of tiles
+        """
+        tiles = self.update(files)
+        if polygon is not None:
+            from shapely.geometry import box
+            from shapely.prepared import prep
+
+            tile_crss = {tile["crs"] for tile in tiles if tile.get("crs")}
+            if polygon_crs and tiles and len(tile_crss) != 1:
+                reason = f"tiles have {len(tile_crss)} different CRS" if tile_crss else "tiles have no CRS"
+                raise ValueError(f"Can't reproject the polygon from {polygon_crs} to CRS of tiles, {reason}")
+            target_crs = next(iter(tile_crss), None)
+            geometry = load_polygon(polygon, polygon_crs=polygon_crs, target_crs=target_crs)
+            tiles = tiles_intersecting(tiles, geometry.bounds)
+            prepared = prep(geometry)
+            tiles = [tile for tile in tiles if prepared.intersects(box(*tile["bounds"]))]
+        if bounds is not None:
+            tiles = tiles_intersecting(tiles, bounds)
+        return [tile["path"] for tile in tiles]
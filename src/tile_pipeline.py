@@ -0,0 +1,327 @@
+"""
+Pipelined per-tile processing: filter -> rasterize -> mosaic, without barriers between stages.
+    * Every tile flows through the stages on its own, different stages run at once on different tiles
+        in one pool of processes, tiles are admitted in mosaic order (north to south, west to east)
+    * A tile is rasterized as soon as it and its halo neighbours are filtered, an output block of the mosaic
+        is written as soon as all tiles overlapping it are rasterized (or failed, or empty)
+    * At most `max_tiles_in_flight` tiles are admitted and not yet released (their filtered points still needed
+        by a neighbour), so intermediate files on disk are bounded by the window, not by the city.
+        The window is never below what the neighbour graph needs to keep all workers busy, see `schedule_tiles`
+    * Pixels equal `src.raster_mosaic.mosaic_windowed` of the raster tiles (first valid tile by path wins), the grid
+        covers input tiles, while `mosaic_windowed` covers raster tiles - it is smaller by the cells of edge tiles
+        which were filtered (or failed) away, and placed the same
+
+Example
+    run_tile_pipeline(files, '/kaggle/working/filtered_files/', '/kaggle/working/tif_files/',
+                      '/kaggle/working/mosaic.tif', filter_chain=[{"filter" : "outliers", "radius" : 4, "elev_diff" : 15}],
+                      gridding_params={"resolution" : 1, "radius" : 0.8}, n_workers=8, max_tiles_in_flight=16)
+"""
+import datetime
+import os
+import time
+
+def _filter_tile(input_path=None, output_path=None, filter_chain=None):
+    """Filters one tile with a filter chain, returns a result record with bounds of kept points (never raises)"""
+    from src.point_filters import apply_filter_chain
+    from src.tile_index import lidar_tile_bounds
+
+    result = {"file" : input_path, "output" : output_path, "success" : False, "bounds" : None,
+              "bytes_in" : 0, "bytes_out" : 0, "points" : 0, "kept" : 0,
+              "wall_time" : 0., "error" : None, "started_at" : time.time(), "pid" : os.getpid()}
+    start = time.perf_counter()
+    try:
+        result["bytes_in"] = os.path.getsize(input_path)
+        result["points"], result["kept"] = apply_filter_chain(input_path, output_path, filter_chain)
+        if result["kept"]:
+            result["bounds"], _ = lidar_tile_bounds(output_path)
+            result["bytes_out"] = os.path.getsize(output_path)
+        else: # nothing to rasterize
+            os.remove(output_path)
+            result["output"] = None
+        result["success"] = True
+    except Exception as error: # reported in the summary, other tiles go on
+        result["error"] = f"{type(error).__name__}: {error}"
+    result["wall_time"] = time.perf_counter() - start
+    return result
+
+def _prebuild_footprints(filter_chain=None):
+    """Returns a filter chain with footprints of `clip_polygons` steps built, so tiles don't rebuild them"""
+    from src.point_clip import GRID_SIZE, build_footprints
+
+    prebuilt = []
+    for step in filter_chain or []:
+        if step["filter"] == "clip_polygons" and "footprints" not in step:
+            step = {"filter" : "clip_polygons",
+                    "footprints" : build_footprints(step["polygons"], polygon_crs=step.get("polygon_crs"),
+                                                    target_crs=step.get("crs"), grid_size=step.get("grid_size") or GRID_SIZE)}
+        prebuilt.append(step)
+    return prebuilt
+
+def tiles_window(neighbours=None, n_workers=1, max_tiles_in_flight=None):
+    """Returns tiles admitted and not released at once, `max_tiles_in_flight` (`2 * n_workers` if None) raised to the
+    minimum of the neighbour graph, see `schedule_tiles`"""
+    span = max((abs(neighbour - position) for position, positions in enumerate(neighbours) for neighbour in positions),
+               default=0)
+    return max(max_tiles_in_flight or 2 * n_workers, 2 * span + n_workers)
+
+def schedule_tiles(neighbours=None, blocks=None, submit_filter=None, submit_rasterize=None, write_block=None,
+                   release=None, failed_result=None, n_workers=1, max_tiles_in_flight=None):
+    """Runs tiles (in admission order) through filter -> rasterize -> block writes, returns task results and statistics
+
+        * Tasks are futures of any executor, the schedule runs in this thread and only waits for the next finished one
+        * The oldest unreleased tile waits for its last consumer to be rasterized, which waits for the last neighbour
+            of that consumer to be filtered, so `2 * span` tiles after it must be admitted (`span` - largest distance
+            of positions of a tile and its neighbour, a row of tiles and one for a grid). The window is at least
+            `2 * span + n_workers`, so `n_workers` new tiles are filtered while the oldest one waits
+        * A task raising (or failing to submit, f.e. `BrokenProcessPool` after a worker was killed) becomes
+            a failed result record of its tile, the schedule goes on with other tiles
+
+        Returns dict of `filtered`, `rasters` (position -> task result), `window`, `max_in_flight`, `blocks_left`
+
+    Parameters
+    ----------
+    neighbours : list
+        positions of halo neighbours (the tile itself included) of every tile, tiles are in admission order
+    blocks : list
+        positions of tiles overlapping every output block
+    submit_filter : callable
+        `submit_filter(position)` -> future, its result is passed to `submit_rasterize` and `release` as it is
+    submit_rasterize : callable
+        `submit_rasterize(position, filtered)` -> future, or None if there is nothing to rasterize (empty tile),
+        `filtered` maps positions to filter results
+    write_block : callable
+        `write_block(index, rasters)` writes a block when all its tiles are rasterized, `rasters` maps positions
+        to rasterize results (None if nothing was rasterized)
+    release : callable or None
+        `release(position, filter_result)` when no neighbour needs filtered points of a tile anymore
+    failed_result : callable or None
+        `failed_result(kind, position, error)` -> result record of a failed `filter` or `rasterize` task,
+        `{"success" : False, "output" : None, "error" : ...}` if None
+    n_workers : int
+        number of workers of the executor
+    max_tiles_in_flight : int or None
+        tiles admitted and not released at once, `2 * n_workers` if None, raised to the minimum above
+    """
+    from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+    n_tiles = len(neighbours)
+    window = tiles_window(neighbours, n_workers, max_tiles_in_flight)
+    consumers = [[] for _ in neighbours] # tiles whose halo needs points of a tile
+    for position, positions in enumerate(neighbours):
+        for neighbour in positions:
+            consumers[neighbour].append(position)
+
+    filtered, rasters = {}, {}
+    waiting, unreleased = set(), set() # admitted and not submitted to rasterize, admitted and not released
+    blocks_left = dict(enumerate(blocks))
+    futures, next_tile, max_in_flight = {}, 0, 0
+
+    def submit(submit_task, *args):
+        try:
+            return submit_task(*args)
+        except Exception as error: # f.e. `BrokenProcessPool`, the executor takes no tasks anymore
+            future = Future()
+            future.set_exception(error)
+            return future
+
+    while True:
+        for future in [future for future in futures if future.done()]:
+            kind, position = futures.pop(future)
+            try:
+                result = future.result()
+            except Exception as error: # the task raised or its worker died, the tile fails, others go on
+                result = (failed_result(kind, position, error) if failed_result is not None else
+                          {"success" : False, "output" : None, "error" : f"{type(error).__name__}: {error}"})
+            (filtered if kind == 'filter' else rasters)[position] = result
+
+        # tiles with all neighbours filtered
+        for position in sorted(waiting):
+            if position not in filtered or not all(neighbour in filtered for neighbour in neighbours[position]):
+                continue
+            waiting.remove(position)
+            future = submit(submit_rasterize, position, filtered)
+            if future is None:
+                rasters[position] = None
+            else:
+                futures[future] = ('rasterize', position)
+        for position in sorted(unreleased): # filtered points nobody needs anymore
+            if all(consumer in rasters for consumer in consumers[position]):
+                unreleased.remove(position)
+                if release is not None:
+                    release(position, filtered[position])
+
+        # blocks with all tiles done
+        for index in [index for index, positions in blocks_left.items() if all(position in rasters for position in positions)]:
+            write_block(index, rasters)
+            del blocks_left[index]
+
+        # admit tiles, the window is only exceeded if nothing else can run
+        while next_tile < n_tiles and (len(unreleased) < window or not futures):
+            futures[submit(submit_filter, next_tile)] = ('filter', next_tile)
+            waiting.add(next_tile)
+            unreleased.add(next_tile)
+            next_tile += 1
+        max_in_flight = max(max_in_flight, len(unreleased))
+        if not futures:
+            break
+        wait(list(futures), return_when=FIRST_COMPLETED)
+    return {"filtered" : filtered, "rasters" : rasters, "window" : window, "max_in_flight" : max_in_flight,
+            "blocks_left" : len(blocks_left)}
+
+def run_tile_pipeline(files=None, filtered_folder=None, raster_folder=None, output_mosaic_path=None,
+                      filter_chain=None, raster_method='surface', gridding_params=None, halo=10.,
+                      mosaic_method='nn', block_budget_mb=256, n_workers=1, max_tiles_in_flight=None,
+                      keep_filtered=True):
+    """Filters, rasterizes and mosaics tiles in a pipeline, returns result records and pipeline statistics
+
+        Logic (scheduler loop in this process, tile work in worker processes, see `schedule_tiles`):
+        - 1. INDEX INPUT TILES, FIND HALO NEIGHBOURS AND TILES OF EVERY MOSAIC BLOCK (BY INPUT BOUNDS),
+             NO MOSAIC IF THERE ARE NO TILES
+        - 2. HANDLE FINISHED TASKS: FILTERED TILE -> MAYBE RASTERIZE IT OR NEIGHBOURS, RASTER -> MAYBE RELEASE FILTERED
+        - 3. WRITE MOSAIC BLOCKS WHOSE TILES ARE ALL DONE (FIRST VALID RASTER BY PATH WINS, AS IN
+             `src.raster_mosaic.mosaic_windowed`)
+        - 4. ADMIT NEW TILES (FILTER TASKS) WHILE THE WINDOW ALLOWS, WAIT FOR THE NEXT FINISHED TASK
+
+    Parameters
+    ----------
+    files : list
+        paths to .las or .laz tiles
+    filtered_folder : str
+        folder of filtered tiles
+    raster_folder : str
+        folder of raster tiles (.tif)
+    output_mosaic_path : str
+        path to output mosaic (.tif)
+    filter_chain : list
+        filter steps, see `src.point_filters.compile_filter_chain` (f.e. with a `clip_polygons` step,
+        its footprints are built once here)
+    raster_method : str
+        `delaunay`, `surface` or `numpy`, see `src.tile_rasterizer.rasterize_tile`
+    gridding_params : dict
+        gridding params, `resolution` is required
+    halo : float
+        halo width (CRS units) borrowed from neighbouring tiles
+    mosaic_method : str
+        `nn`, `bilinear` or `cc`
+    block_budget_mb : float
+        memory budget of one output block of the mosaic
+    n_workers : int
+        number of worker processes (shared by all stages)
+    max_tiles_in_flight : int or None
+        tiles admitted and not released at once, `2 * n_workers` if None, at least the minimum of `schedule_tiles`
+    keep_filtered : bool
+        if keep filtered tiles, deleted as soon as no neighbour needs them otherwise
+    """
+    import rasterio
+    from concurrent.futures import ProcessPoolExecutor
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+    from src.gridding import NODATA
+    from src.lidar_io import failed_tile_result
+    from src.raster_mosaic import GTIFF_BLOCK_SIZE, block_size_from_budget, read_block
+    from src.tile_index import (build_tile_index, bucket_tile_index, expand_bounds, index_bounds, tile_crs,
+                                tiles_intersecting)
+    from src.tile_rasterizer import rasterize_tile, snap_bounds
+
+    start = time.perf_counter()
+    if raster_method == "numpy": # fail before any tile, not in every one
+        from src.gridding import check_gridding_params
+
+        check_gridding_params(gridding_params)
+    resolution = gridding_params["resolution"]
+    filter_chain = _prebuild_footprints(filter_chain)
+    tiles = sorted(build_tile_index(files), key=lambda tile: (-tile["bounds"][3], tile["bounds"][0])) # north to south
+    if not tiles:
+        print(f"\t{datetime.datetime.now()} pipeline : no tiles, no mosaic")
+        return {"filter" : [], "rasterize" : [], "wall_time" : time.perf_counter() - start, "first_block_time" : None,
+                "max_in_flight" : 0, "mosaic" : None}
+    for position, tile in enumerate(tiles):
+        tile["position"] = position
+    buckets = bucket_tile_index(tiles)
+    neighbours = [[neighbour["position"] for neighbour in tiles_intersecting(tiles, expand_bounds(tile["bounds"], halo), buckets)]
+                  for tile in tiles]
+
+    # mosaic grid covers snapped tiles, every block waits for tiles overlapping it (a cell of snapping around)
+    bounds = snap_bounds(index_bounds(tiles), resolution)
+    width, height = int(round((bounds[2] - bounds[0]) / resolution)), int(round((bounds[3] - bounds[1]) / resolution))
+    block_size = block_size_from_budget(block_budget_mb)
+    blocks = []
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            block_height, block_width = min(block_size, height - row), min(block_size, width - col)
+            block_bounds = (bounds[0] + col * resolution, bounds[3] - (row + block_height) * resolution,
+                            bounds[0] + (col + block_width) * resolution, bounds[3] - row * resolution)
+            blocks.append({"window" : Window(col, row, block_width, block_height), "bounds" : block_bounds,
+                           "tiles" : sorted(tile["position"] for tile in
+                                            tiles_intersecting(tiles, expand_bounds(block_bounds, resolution), buckets))})
+
+    os.makedirs(filtered_folder, exist_ok=True)
+    os.makedirs(raster_folder, exist_ok=True)
+    profile = {"driver" : "GTiff", "width" : width, "height" : height, "count" : 1, "dtype" : "float32",
+               "nodata" : NODATA, "crs" : tile_crs(tiles[0]["path"]),
+               "transform" : from_origin(bounds[0], bounds[3], resolution, resolution),
+               "tiled" : True, "blockxsize" : GTIFF_BLOCK_SIZE, "blockysize" : GTIFF_BLOCK_SIZE,
+               "compress" : 'deflate', "predictor" : 3, "BIGTIFF" : "IF_SAFER"}
+    raster_tiles, timings = {}, {"first_block" : None} # position -> raster tile record, indexed once
+    print(f"\t{datetime.datetime.now()} pipeline of {len(tiles)} tiles, {n_workers} workers, "
+          f"at most {tiles_window(neighbours, n_workers, max_tiles_in_flight)} tiles in flight, "
+          f"mosaic {width}x{height} px in {len(blocks)} blocks")
+
+    def filtered_tile(result):
+        return {"path" : result["output"], "bounds" : result["bounds"]} if result["success"] and result["output"] else None
+
+    def filtered_path(position):
+        return os.path.join(filtered_folder, os.path.basename(tiles[position]["path"]))
+
+    def raster_path(position):
+        return os.path.join(raster_folder, os.path.splitext(os.path.basename(tiles[position]["path"]))[0] + '.tif')
+
+    def failed_result(kind, position, error):
+        if kind == 'filter':
+            return {**failed_tile_result(tiles[position]["path"], filtered_path(position), error),
+                    "output" : None, "bounds" : None, "points" : 0, "kept" : 0}
+        return failed_tile_result(filtered_path(position), raster_path(position), error)
+
+    def submit_filter(position):
+        return pool.submit(_filter_tile, tiles[position]["path"], filtered_path(position), filter_chain)
+
+    def submit_rasterize(position, filtered):
+        if filtered_tile(filtered[position]) is None:
+            return None
+        output_path = raster_path(position)
+        return pool.submit(rasterize_tile, tile=filtered_tile(filtered[position]),
+                           neighbours=[filtered_tile(filtered[neighbour]) for neighbour in neighbours[position]
+                                       if filtered_tile(filtered[neighbour])],
+                           output_path=output_path, raster_method=raster_method,
+                           gridding_params=gridding_params, halo=halo)
+
+    def write_block(index, rasters):
+        block = blocks[index]
+        for position in block["tiles"]:
+            if position not in raster_tiles:
+                result = rasters[position]
+                raster_tiles[position] = build_tile_index([result["output"]])[0] if result and result["success"] else None
+        block_tiles = sorted((raster_tiles[position] for position in block["tiles"] if raster_tiles[position]),
+                             key=lambda tile: tile["path"])
+        window = block["window"]
+        dst.write(read_block(block_tiles, None, block["bounds"], (window.height, window.width),
+                             resolution, NODATA, mosaic_method), 1, window=window)
+        timings["first_block"] = timings["first_block"] or time.perf_counter() - start
+
+    def release(position, result):
+        if not keep_filtered and filtered_tile(result):
+            os.remove(result["output"])
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool, rasterio.open(output_mosaic_path, "w", **profile) as dst:
+        schedule = schedule_tiles(neighbours, [block["tiles"] for block in blocks], submit_filter, submit_rasterize,
+                                  write_block, release, failed_result, n_workers=n_workers,
+                                  max_tiles_in_flight=max_tiles_in_flight)
+
+    wall_time = time.perf_counter() - start
+    print(f"\t{datetime.datetime.now()} pipeline done in {wall_time:.1f} s, first mosaic block after "
+          f"{timings['first_block'] or 0.:.1f} s, at most {schedule['max_in_flight']} tiles in flight, "
+          f"{schedule['blocks_left']} blocks left unwritten")
+    return {"filter" : [schedule["filtered"][position] for position in sorted(schedule["filtered"])],
+            "rasterize" : [result for _, result in sorted(schedule["rasters"].items()) if result is not None],
+            "wall_time" : wall_time, "first_block_time" : timings["first_block"],
+            "max_in_flight" : schedule["max_in_flight"], "mosaic" : output_mosaic_path}
@@ -0,0 +1,282 @@
+"""
+Tile-parallel rasterization of LiDAR tiles with halo buffers.
+    * Every tile is rasterized independently (process pool), with points borrowed from neighbouring tiles
+        within `halo` distance, so interpolation near tile edges sees the same points as inside a tile
+    * Output of a tile is cropped (by an integer window) to the tile extent snapped to a global grid
+        (multiples of `resolution`), so tiles line up without seams or overlaps,
+        and outputs are identical for any number of workers
+"""
+import datetime
+import math
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+def snap_bounds(bounds=None, resolution=1.):
+    """Returns bounds snapped to the nearest lines of the global grid (multiples of `resolution`, origin 0, 0)
+
+        * A cell belongs to the tile its centre falls in, so neighbouring tiles whose extents meet near a grid line
+            share that line, they neither overlap nor leave a gap
+    """
+    return tuple(math.floor(value / resolution + 0.5) * resolution for value in bounds)
+
+def halo_grid_bounds(bounds=None, halo=0., resolution=1.):
+    """Returns snapped bounds grown by `halo` rounded up to whole cells, still on the global grid"""
+    from src.tile_index import expand_bounds
+
+    return expand_bounds(bounds, math.ceil(halo / resolution) * resolution)
+
+def _chunk_dimensions(points=None):
+    """Returns dimension names of a chunk, of a LAS/LAZ chunk or of a point store chunk (`src.point_store`)"""
+    if hasattr(points, 'point_format'):
+        return points.point_format.dimension_names
+    return vars(points)
+
+def _convert_points(points=None, header=None, mask=None):
+    """Returns points (`mask`ed) re-encoded in point format, scales and offsets of `header`
+
+        * Neighbour tiles may use other point formats, scales and offsets, and point stores yield chunks of columns.
+            Dimensions are copied by name, dimensions the source doesn't have are zeros
+    """
+    import laspy
+
+    if (isinstance(points, laspy.ScaleAwarePointRecord) and
+            list(points.point_format.dimension_names) == list(header.point_format.dimension_names) and
+            np.allclose(points.scales, header.scales) and np.allclose(points.offsets, header.offsets)):
+        return points if mask is None else points[mask]
+    select = (lambda values: np.asarray(values)) if mask is None else (lambda values: np.asarray(values)[mask])
+    x, y, z = select(points.x), select(points.y), select(points.z)
+    converted = laspy.ScaleAwarePointRecord.zeros(len(x), header=header)
+    source_dimensions = set(_chunk_dimensions(points))
+    for name in header.point_format.dimension_names:
+        if name not in ('X', 'Y', 'Z') and name in source_dimensions:
+            converted[name] = select(getattr(points, name))
+    converted.x, converted.y, converted.z = x, y, z
+    return converted
+
+def gather_tile_with_halo(tile=None, neighbours=None, halo=0., output_path=None, chunk_size=None, grid_bounds=None):
+    """Writes points of a tile plus points of its neighbours within `halo` of the tile extent
+
+        Takes a tile and its neighbours (records of `src.tile_index.build_tile_index`), LAS/LAZ or point stores
+        Returns number of points written
+
+        * Points are written in point format, scales and offsets of the tile (a store gets the header of its source)
+
+    Parameters
+    ----------
+    tile : dict
+        tile to rasterize
+    neighbours : list
+        tiles overlapping the tile extent grown by `halo`, the tile itself is skipped
+    halo : float
+        halo width in CRS units
+    output_path : str
+        path to output .las or .laz (for tools reading one file)
+    chunk_size : int or None
+        number of points per chunk
+    grid_bounds : tuple or None
+        bounds on the global grid written as the header extent (x, y) instead of the extent of points,
+        so tools gridding from the header extent (whitebox) lay cells on the global grid. Points outside are dropped
+    """
+    import laspy
+    from src.lidar_io import DEFAULT_CHUNK_SIZE, detect_laz_backend, iter_lidar_chunks, read_lidar_header
+    from src.tile_index import bounds_intersect, expand_bounds
+
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    halo_bounds = expand_bounds(tile["bounds"], halo)
+    if grid_bounds is not None:
+        halo_bounds = (max(halo_bounds[0], grid_bounds[0]), max(halo_bounds[1], grid_bounds[1]),
+                       min(halo_bounds[2], grid_bounds[2]), min(halo_bounds[3], grid_bounds[3]))
+    header = read_lidar_header(tile["path"])
+    n_points = 0
+    with laspy.open(output_path, mode="w", header=header, laz_backend=detect_laz_backend()) as writer:
+        if grid_bounds is not None: # points are inside, so only z is grown by them
+            writer.header.x_min, writer.header.y_min, writer.header.x_max, writer.header.y_max = grid_bounds
+        sources = [tile] + sorted([neighbour for neighbour in neighbours if neighbour["path"] != tile["path"]],
+                                  key=lambda neighbour: neighbour["path"])
+        for source in sources:
+            clip_bounds = grid_bounds if source is tile else halo_bounds
+            if clip_bounds is None:
+                for points in iter_lidar_chunks(source["path"], chunk_size):
+                    writer.write_points(_convert_points(points, header))
+                    n_points += len(points.x)
+                continue
+            if not bounds_intersect(source["bounds"], clip_bounds):
+                continue
+            for points in iter_lidar_chunks(source["path"], chunk_size):
+                x, y = np.asarray(points.x), np.asarray(points.y)
+                inside = (x >= clip_bounds[0]) & (x <= clip_bounds[2]) & (y >= clip_bounds[1]) & (y <= clip_bounds[3])
+                if inside.any():
+                    writer.write_points(_convert_points(points, header, inside))
+                    n_points += int(inside.sum())
+    return n_points
+
+def crop_to_grid(input_path=None, output_path=None, bounds=None, resolution=1.):
+    """Crops a raster on the global grid to `bounds` (on the global grid too) by an integer window, no resampling
+
+        * Cells outside the raster are nodata
+        * Raises ValueError if the raster isn't on the global grid (other cell size, origin off grid lines)
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    minx, miny, maxx, maxy = bounds
+    width, height = int(round((maxx - minx) / resolution)), int(round((maxy - miny) / resolution))
+    with rasterio.open(input_path) as src:
+        col, row = (minx - src.transform.c) / resolution, (src.transform.f - maxy) / resolution
+        if (not np.allclose(src.res, (resolution, resolution)) or
+                abs(col - round(col)) > 1e-6 or abs(row - round(row)) > 1e-6):
+            raise ValueError(f"{input_path} isn't on the global grid of {resolution} "
+                             f"(origin {src.transform.c}, {src.transform.f}, cell size {src.res})")
+        nodata = src.nodata if src.nodata is not None else -32768.
+        values = src.read(1, window=Window(int(round(col)), int(round(row)), width, height),
+                          boundless=True, fill_value=nodata).astype(np.float32)
+        profile = src.profile.copy()
+    profile.update(driver="GTiff", width=width, height=height, transform=from_origin(minx, maxy, resolution, resolution),
+                   dtype="float32", nodata=nodata, count=1, tiled=True, blockxsize=256, blockysize=256, compress="deflate")
+    with rasterio.open(output_path, "w", **profile) as dst:
+        dst.write(values, 1)
+
+def rasterize_tile(tile=None, neighbours=None, output_path=None, raster_method='surface',
+                   gridding_params=None, halo=10., las_fallback=False, max_procs=1):
+    """Rasterizes one tile with its halo, returns a result record of the tile (never raises)
+
+        Logic:
+        - 1. GATHER TILE + HALO POINTS INTO A TEMPORARY .LAZ (.LAS IF `las_fallback`)
+        - 2. RASTERIZE IT (`wbt.lidar_digital_surface_model` OR `wbt.lidar_tin_gridding`)
+        - 3. CROP TO TILE EXTENT SNAPPED TO THE GLOBAL GRID (INTEGER WINDOW, THE HALO FILE HAS ITS HEADER EXTENT
+             ON THE GLOBAL GRID, SO WHITEBOX CELLS ARE ON IT TOO)
+        * `numpy` method grids points directly onto the global grid, see `src.gridding.rasterize_tile_numpy`
+
+    Parameters
+    ----------
+    tile : dict
+        tile to rasterize, record of `src.tile_index.build_tile_index`
+    neighbours : list
+        tiles overlapping the tile extent grown by `halo`
+    output_path : str
+        path to output .tif
+    raster_method : str
+        `delaunay`, `surface` or `numpy`, see `get_data.rasterize_lidar_files`
+    gridding_params : dict
+        params of a whitebox gridding tool or of `src.gridding.grid_lidar_points`, `resolution` is required
+    halo : float
+        halo width in CRS units
+    las_fallback : bool
+        if gather points into LAS (only if whitebox build can't read LAZ)
+    max_procs : int
+        threads of a whitebox tool, keep low when many tiles run in parallel
+    """
+    result = {"file" : tile["path"], "output" : output_path, "success" : False, "bytes_in" : 0, "bytes_out" : 0,
+              "wall_time" : 0., "error" : None, "started_at" : time.time(), "pid" : os.getpid()}
+    start = time.perf_counter()
+    temp_dir = tempfile.mkdtemp(prefix='rasterize_tile_')
+    try:
+        result["bytes_in"] = os.path.getsize(tile["path"])
+        if raster_method == "numpy":
+            from src.gridding import rasterize_tile_numpy
+
+            result["cells"] = rasterize_tile_numpy(tile, neighbours, output_path, gridding_params, halo)
+            result.update(success=True, bytes_out=os.path.getsize(output_path))
+            return result
+
+        import whitebox
+
+        resolution = gridding_params["resolution"]
+        bounds = snap_bounds(tile["bounds"], resolution)
+        halo_path = os.path.join(temp_dir, 'tile_with_halo.las' if las_fallback else 'tile_with_halo.laz')
+        result["points"] = gather_tile_with_halo(tile, neighbours, halo, halo_path,
+                                                 grid_bounds=halo_grid_bounds(bounds, halo, resolution))
+
+        wbt = whitebox.WhiteboxTools()
+        wbt.verbose = False
+        if hasattr(wbt, 'set_max_procs'):
+            wbt.set_max_procs(max_procs)
+        raster_path = os.path.join(temp_dir, 'tile_with_halo.tif')
+        if raster_method == "delaunay":
+            return_code = wbt.lidar_tin_gridding(i=halo_path, output=raster_path, **gridding_params)
+        else:
+            return_code = wbt.lidar_digital_surface_model(i=halo_path, output=raster_path, **gridding_params)
+        if return_code != 0:
+            raise RuntimeError(f"whitebox returned {return_code}")
+
+        crop_to_grid(raster_path, output_path, bounds, resolution)
+        result.update(success=True, bytes_out=os.path.getsize(output_path))
+    except Exception as error: # reported in the summary, other tiles go on
+        result["error"] = f"{type(error).__name__}: {error}"
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        result["wall_time"] = time.perf_counter() - start
+        result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024. # worker peak so far
+    return result
+
+def rasterize_tiles(files=None, output_folder=None, raster_method='surface', gridding_params=None,
+                    halo=10., las_fallback=False, n_workers=1, cache=None):
+    """Schedules rasterization of tiles over a process pool
+
+        Takes LAS/LAZ tiles
+        Creates one .tif per tile in `output_folder`, returns result records of tiles
+
+    Parameters
+    ----------
+    files : list
+        paths to .las or .laz tiles
+    output_folder : str
+        folder of output rasters
+    raster_method, gridding_params, halo, las_fallback :
+        see `rasterize_tile`
+    n_workers : int
+        number of worker processes
+    cache : src.stage_cache.StageCache or None
+        stage cache, keyed by the tile itself (its content hash) and its halo neighbours
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from src.tile_index import build_tile_index, expand_bounds, tiles_intersecting
+
+    if raster_method == "numpy": # fail before any tile, not in every one
+        from src.gridding import check_gridding_params
+
+        check_gridding_params(gridding_params)
+    tile_index = build_tile_index(files)
+    jobs = []
+    for tile in tile_index:
+        neighbours = tiles_intersecting(tile_index, expand_bounds(tile["bounds"], halo))
+        output_path = os.path.join(output_folder, os.path.splitext(os.path.basename(tile["path"]))[0] + '.tif')
+        jobs.append(dict(tile=tile, neighbours=neighbours, output_path=output_path, raster_method=raster_method,
+                         gridding_params=gridding_params, halo=halo, las_fallback=las_fallback))
+
+    cache_params = {"raster_method" : raster_method, "gridding_params" : gridding_params, "halo" : halo}
+    results, pending = [], []
+    for job in jobs:
+        neighbour_files = [neighbour["path"] for neighbour in job["neighbours"]]
+        if cache is not None:
+            # neighbour sets are shared by tiles (f.e. a 2x2 block), the tile itself tells them apart
+            job["cache_params"] = {**cache_params, "tile" : cache.file_hash(job["tile"]["path"])}
+        if cache is not None and cache.restore('rasterize_tile', neighbour_files, job["cache_params"],
+                                               output_paths=[job["output_path"]])[0]:
+            results.append({"file" : job["tile"]["path"], "output" : job["output_path"], "success" : True,
+                            "bytes_in" : os.path.getsize(job["tile"]["path"]),
+                            "bytes_out" : os.path.getsize(job["output_path"]),
+                            "wall_time" : 0., "error" : None, "cached" : True})
+        else:
+            pending.append(job)
+
+    print(f"\t{datetime.datetime.now()} rasterize {len(pending)} tiles ({len(jobs) - len(pending)} cached), "
+          f"{n_workers} workers, halo {halo}")
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(rasterize_tile, **{key : value for key, value in job.items() if key != "cache_params"})
+                   for job in pending]
+        for job, future in zip(pending, futures):
+            result = future.result()
+            results.append(result)
+            if cache is not None and result["success"]:
+                cache.store('rasterize_tile', [neighbour["path"] for neighbour in job["neighbours"]],
+                            job["cache_params"], [result["output"]])
+    if cache is not None:
+        cache.flush()
+    return results
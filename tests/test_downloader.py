@@ -0,0 +1,97 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import pytest
+
+from src.downloader import download_file
+
+CONTENT = os.urandom(300 * 1024)
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.files`, honours `Range`, drops the connection after `server.drop_after[path]` bytes once"""
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        content = self.server.files.get(self.path)
+        if content is None:
+            return self.send_error(404)
+        start = int(self.headers['Range'].split('=')[1].split('-')[0]) if self.headers.get('Range') else 0
+        if start >= len(content):
+            return self.send_error(416)
+        body = content[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(body)))
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+        self.end_headers()
+        self.wfile.write(body[:self.server.drop_after.pop(self.path, len(body))])
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.files, server.drop_after, server.requests = {"/tile.laz" : CONTENT}, {}, []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def link(server, path='/tile.laz'):
+    return f'http://127.0.0.1:{server.server_address[1]}{path}'
+
+def test_download_resumes_after_dropped_connection(server, tmp_path):
+    server.drop_after["/tile.laz"] = 100 * 1024
+    result = download_file(link(server), str(tmp_path), expected_sha256=hashlib.sha256(CONTENT).hexdigest(), n_retries=2)
+
+    assert result["success"] and result["error"] is None
+    assert (tmp_path / 'tile.laz').read_bytes() == CONTENT and not (tmp_path / 'tile.laz.part').exists()
+    assert result["resumed_from"] == 100 * 1024
+    assert result["bytes"] == len(CONTENT) - 100 * 1024 # the last attempt only
+    assert server.requests == [("/tile.laz", None), ("/tile.laz", f"bytes={100 * 1024}-")]
+
+def test_download_fails_without_retries_left(server, tmp_path):
+    server.drop_after["/tile.laz"] = 100 * 1024
+    result = download_file(link(server), str(tmp_path), n_retries=0)
+
+    assert not result["success"] and result["error"].startswith('IncompleteRead')
+    assert not (tmp_path / 'tile.laz').exists()
+    assert (tmp_path / 'tile.laz.part').stat().st_size == 100 * 1024 # resumed by the next call
+    assert download_file(link(server), str(tmp_path), n_retries=0)["resumed_from"] == 100 * 1024
+    assert (tmp_path / 'tile.laz').read_bytes() == CONTENT
+
+def test_download_checksum_mismatch(server, tmp_path):
+    result = download_file(link(server), str(tmp_path), expected_sha256='0' * 64, n_retries=1)
+
+    assert not result["success"] and 'checksum mismatch' in result["error"]
+    assert not (tmp_path / 'tile.laz').exists() and not (tmp_path / 'tile.laz.part').exists()
+    assert len(server.requests) == 2 # a corrupted `.part` isn't resumed, every attempt starts over
+    assert all(range_header is None for _, range_header in server.requests)
+
+def test_download_skips_verified_file(server, tmp_path):
+    sha256 = hashlib.sha256(CONTENT).hexdigest()
+    assert download_file(link(server), str(tmp_path), expected_sha256=sha256)["success"]
+    result = download_file(link(server), str(tmp_path), expected_sha256=sha256)
+
+    assert result["success"] and result["skipped"] and result["sha256"] == sha256
+    assert len(server.requests) == 1
+
+def test_download_client_error_is_not_retried(server, tmp_path):
+    result = download_file(link(server, '/missing.laz'), str(tmp_path), n_retries=2)
+
+    assert not result["success"] and 'HTTP Error 404' in result["error"]
+    assert len(server.requests) == 1
+
+def test_download_files_same_names(server, tmp_path):
+    from src.downloader import download_files
+
+    server.files["/other/tile.laz"] = CONTENT
+    with pytest.raises(ValueError, match="tile.laz"):
+        download_files([link(server), link(server, '/other/tile.laz')], str(tmp_path))
+    assert not server.requests
+
+    results = download_files([link(server)] * 3, str(tmp_path)) # a repeated link is downloaded once
+    assert len(results) == 1 and results[0]["success"] and len(server.requests) == 1
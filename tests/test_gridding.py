@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+laspy = pytest.importorskip("laspy")
+pytest.importorskip("scipy")
+
+from src.gridding import NODATA, fill_gaps_tin, grid_lidar_points
+
+def write_las(path, x, y, z):
+    header = laspy.LasHeader(point_format=1, version="1.2")
+    header.scales, header.offsets = np.array([0.001] * 3), np.array([0., 0., 0.])
+    points = laspy.ScaleAwarePointRecord.zeros(len(x), header=header)
+    points.x, points.y, points.z = x, y, z
+    with laspy.open(str(path), mode="w", header=header) as writer:
+        writer.write_points(points)
+    return str(path)
+
+def test_idw_over_chunks_as_brute_force(tmp_path):
+    rng = np.random.default_rng(0)
+    x, y, z = rng.uniform(0., 8., 600), rng.uniform(0., 6., 600), rng.uniform(0., 30., 600)
+    path = write_las(tmp_path / 'tile.las', x, y, z)
+    x, y, z = (np.asarray(values) for values in (lambda points: (points.x, points.y, points.z))(laspy.read(path)))
+
+    grid = grid_lidar_points([(path, None)], (0., 0., 8., 6.), resolution=1., statistic='idw', radius=1.5,
+                             chunk_size=100)
+    expected = np.full((6, 8), NODATA)
+    for row in range(6):
+        for col in range(8):
+            distance = np.hypot(x - (col + 0.5), y - (6. - row - 0.5))
+            near = distance <= 1.5
+            if near.any():
+                weight = 1. / np.maximum(distance[near], 1e-6) ** 2
+                expected[row, col] = (weight * z[near]).sum() / weight.sum()
+    np.testing.assert_allclose(grid, expected.astype(np.float32), rtol=1e-5)
+
+def test_fill_gaps_on_a_plane():
+    rows, cols = np.mgrid[0:40, 0:50]
+    plane = (2. * rows + 0.5 * cols + 100.).astype(np.float32)
+    grid = plane.copy()
+    grid[10:20, 5:30] = NODATA # enclosed gap
+    grid[25:28, 40:43] = NODATA
+    grid[0:5, 0:5] = NODATA # a corner, partly outside the hull of cells around it
+    filled = fill_gaps_tin(grid.copy())
+
+    np.testing.assert_allclose(filled[10:20, 5:30], plane[10:20, 5:30], rtol=1e-5)
+    np.testing.assert_allclose(filled[25:28, 40:43], plane[25:28, 40:43], rtol=1e-5)
+    corner = filled[0:5, 0:5]
+    assert (corner[0:2, 0:2] == NODATA).all() # beyond the diagonal of the L of cells bordering the corner
+    np.testing.assert_allclose(corner[corner != NODATA], plane[0:5, 0:5][corner != NODATA], rtol=1e-5)
+    assert (filled[grid != NODATA] == grid[grid != NODATA]).all()
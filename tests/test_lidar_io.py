@@ -0,0 +1,12 @@
+import pytest
+
+pytest.importorskip("laspy")
+
+from src.lidar_io import decompress_laz_file
+
+def test_missing_tile_is_a_failed_record(tmp_path):
+    result = decompress_laz_file(str(tmp_path / 'missing.laz'), str(tmp_path / 'missing.las'), n_retries=1)
+
+    assert not result["success"] and result["attempts"] == 2
+    assert result["error"].startswith('FileNotFoundError') and result["bytes_in"] == 0
+    assert not (tmp_path / 'missing.las').exists()
@@ -0,0 +1,33 @@
+import json
+
+import numpy as np
+import pytest
+
+laspy = pytest.importorskip("laspy")
+
+from src.lidar_stats import lidar_statistics
+
+def write_tile(path, n_points=500):
+    rng = np.random.default_rng(0)
+    header = laspy.LasHeader(point_format=1, version="1.2")
+    header.scales, header.offsets = np.array([0.01] * 3), np.array([0., 0., 0.])
+    points = laspy.ScaleAwarePointRecord.zeros(n_points, header=header)
+    points.x, points.y, points.z = rng.uniform(0., 50., n_points), rng.uniform(0., 50., n_points), rng.uniform(10., 20., n_points)
+    points.classification = np.full(n_points, 2)
+    with laspy.open(str(path), mode="w", header=header) as writer:
+        writer.write_points(points)
+    return str(path)
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_failed_tiles_recorded_and_left_out(tmp_path, n_workers):
+    files = [write_tile(tmp_path / 'good.las'), str(tmp_path / 'corrupted.las')]
+    (tmp_path / 'corrupted.las').write_bytes(b'not a LAS file')
+    output_path = str(tmp_path / 'stats.json')
+
+    summary = lidar_statistics(files, output_path, n_workers=n_workers)
+    good, corrupted = summary["tile_statistics"]
+    assert good["success"] and good["error"] is None
+    assert not corrupted["success"] and corrupted["file"] == files[1] and corrupted["error"]
+    assert summary["tiles"] == 1 and summary["point_count"] == 500 and summary["failed_tiles"] == 1
+    with open(output_path) as file:
+        assert json.load(file)["failed_tiles"] == 1
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+shapely = pytest.importorskip("shapely")
+
+from src.point_clip import BOUNDARY, INSIDE, OUTSIDE, build_footprints, points_in_footprints
+
+# a U, the notch x in [3, 7], y in [3, 10] is outside
+U_SHAPE = [(0., 0.), (10., 0.), (10., 10.), (7., 10.), (7., 3.), (3., 3.), (3., 10.), (0., 10.)]
+
+def cell_of(footprint, x, y):
+    minx, miny, _, _ = footprint["bounds"]
+    return footprint["cells"][int((y - miny) / footprint["cell_size"][1]), int((x - minx) / footprint["cell_size"][0])]
+
+def test_cells_of_a_concave_polygon():
+    footprint, = build_footprints(U_SHAPE, grid_size=8) # cells of 1.25 m
+    assert cell_of(footprint, 1., 1.) == INSIDE
+    assert cell_of(footprint, 5., 8.) == OUTSIDE # in the notch, within the bounding box
+    assert cell_of(footprint, 3.1, 7.) == cell_of(footprint, 2.9, 7.) == BOUNDARY # crossed by x = 3
+    assert (footprint["cells"] == OUTSIDE).sum() == 2 * 5 # x in [3.75, 6.25], y in [3.75, 10]
+
+def test_points_on_both_sides_of_a_boundary_cell():
+    footprints = build_footprints(U_SHAPE, grid_size=8)
+    x = np.array([1., 5., 2.9, 3.1, 6.9, 7.1, 5., 5., 11., -0.5])
+    y = np.array([1., 8., 7., 7., 4., 4., 2.9, 3.1, 5., 5.])
+    np.testing.assert_array_equal(points_in_footprints(x, y, footprints),
+                                  [True, False, True, False, False, True, True, False, False, False])
+
+def test_points_as_exact_test():
+    from shapely.geometry import Polygon
+
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(-2., 22., 20000), rng.uniform(-2., 12., 20000)
+    second = [(12., 0.), (20., 0.), (16., 10.)]
+    footprints = build_footprints({"type" : "MultiPolygon", "coordinates" : [[U_SHAPE], [second]]}, grid_size=16)
+    assert len(footprints) == 2
+
+    expected = shapely.contains_xy(Polygon(U_SHAPE), x, y) | shapely.contains_xy(Polygon(second), x, y)
+    np.testing.assert_array_equal(points_in_footprints(x, y, footprints), expected)
@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("scipy")
+
+from src.point_filters import _grouped_median, outlier_residuals
+
+def brute_force_residuals(x, y, z, radius, use_median):
+    residuals = np.zeros(len(z))
+    for point in range(len(z)):
+        distance = np.hypot(x - x[point], y - y[point])
+        neighbours = (distance <= radius) & (np.arange(len(z)) != point)
+        if neighbours.any():
+            centre = np.median(z[neighbours]) if use_median else z[neighbours].mean()
+            residuals[point] = z[point] - centre
+    return residuals
+
+def ground_with_spike(n_side=20, spike=50.):
+    """Flat ground at 10 m, points every 0.5 m, one point `spike` m above it in the middle"""
+    x, y = (values.ravel() for values in np.meshgrid(np.arange(n_side) * 0.5, np.arange(n_side) * 0.5))
+    z = np.full(len(x), 10.)
+    middle = (n_side // 2) * n_side + n_side // 2
+    z[middle] += spike
+    return x + 504000., y + 310000., z, middle
+
+def test_planted_outlier_has_the_biggest_residual():
+    x, y, z, middle = ground_with_spike()
+    for use_median in (False, True):
+        residuals = outlier_residuals(x, y, z, radius=1., use_median=use_median)
+        assert np.argmax(np.abs(residuals)) == middle and residuals[middle] == pytest.approx(50.)
+        assert (np.abs(np.delete(residuals, middle)) < 50. / 4).all() # neighbours of the spike see it in a mean
+
+@pytest.mark.parametrize("use_median", [False, True])
+def test_residuals_as_brute_force_over_blocks(use_median):
+    rng = np.random.default_rng(0)
+    x, y = rng.uniform(0., 10., 500), rng.uniform(0., 10., 500)
+    z = rng.normal(10., 1., 500)
+    x[:3], y[:3] = [50., 60., 70.], [50., 60., 70.] # isolated points, no neighbours, zero residual
+    expected = brute_force_residuals(x, y, z, 1., use_median)
+
+    residuals = outlier_residuals(x, y, z, radius=1., use_median=use_median, block_size=64)
+    np.testing.assert_allclose(residuals, expected, atol=1e-9)
+    assert (residuals[:3] == 0.).all()
+
+def test_grouped_median_even_odd_and_empty_groups():
+    groups = np.array([0, 0, 0, 2, 2, 2, 2, 3])
+    values = np.array([5., 1., 3., 4., 1., 2., 3., 7.])
+    counts = np.bincount(groups, minlength=5)
+    np.testing.assert_array_equal(_grouped_median(groups, values, counts), [3., 0., 2.5, 7., 0.])
+    np.testing.assert_array_equal(_grouped_median(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(3, dtype=np.int64)),
+                                  np.zeros(3))
+
+def test_no_points_no_residuals():
+    empty = np.zeros(0)
+    assert outlier_residuals(empty, empty, empty).shape == (0,)
+    assert outlier_residuals(empty, empty, empty, use_median=True).shape == (0,)
+
+def write_las(path, x, y, z, classification):
+    import laspy
+
+    header = laspy.LasHeader(point_format=1, version="1.2")
+    header.scales, header.offsets = np.array([0.01, 0.01, 0.01]), np.array([504000., 310000., 0.])
+    points = laspy.ScaleAwarePointRecord.zeros(len(x), header=header)
+    points.x, points.y, points.z, points.classification = x, y, z, classification
+    with laspy.open(str(path), mode="w", header=header) as writer:
+        writer.write_points(points)
+    return str(path)
+
+@pytest.fixture
+def tile(tmp_path):
+    """Ground with a spike (50 m up), a strip of class 7 points and a ridge 35 m up (not an outlier at 40 m), 400 points"""
+    pytest.importorskip("laspy")
+    x, y, z, middle = ground_with_spike()
+    classification = np.full(len(x), 2)
+    classification[:20] = 7
+    z[20:30] = 45.
+    return write_las(tmp_path / 'tile.las', x, y, z, classification), middle
+
+def test_point_wise_predicates_combine():
+    from types import SimpleNamespace
+    from src.point_filters import compile_filter_chain
+
+    points = SimpleNamespace(classification=np.array([2, 7, 2, 18, 2]), z=np.array([10., 10., 90., 10., -5.]))
+    predicates, neighbourhood_steps = compile_filter_chain([{"filter" : "classes", "exclude_cls" : "7,18"},
+                                                            {"filter" : "z_range", "minz" : 0, "maxz" : 80}])
+    assert not neighbourhood_steps
+    keep = np.logical_and.reduce([predicate(points) for predicate in predicates])
+    np.testing.assert_array_equal(keep, [True, False, False, False, False])
+    with pytest.raises(ValueError):
+        compile_filter_chain([{"filter" : "unknown"}])
+
+def test_fused_chain_over_chunks(tile, tmp_path):
+    import laspy
+    from src.point_filters import apply_filter_chain
+
+    path, middle = tile
+    output_path = str(tmp_path / 'filtered.laz')
+    filter_chain = [{"filter" : "outliers", "radius" : 1., "elev_diff" : 40.},
+                    {"filter" : "classes", "exclude_cls" : "7"}, {"filter" : "z_range", "maxz" : 40.}]
+    assert apply_filter_chain(path, output_path, filter_chain, chunk_size=64) == (400, 400 - 1 - 20 - 10)
+
+    points, original = laspy.read(output_path), laspy.read(path)
+    assert (points.z <= 40.).all() and (points.classification == 2).all()
+    assert original.z[middle] == 60. and not np.isclose(points.z, 60.).any() # the spike is gone
+
+def test_classified_outliers_seen_by_classes(tile, tmp_path):
+    import laspy
+    from src.point_filters import HIGH_NOISE_CLASS, apply_filter_chain
+
+    path, middle = tile
+    classify = {"filter" : "outliers", "radius" : 1., "elev_diff" : 40., "classify" : True}
+    assert apply_filter_chain(path, str(tmp_path / 'classified.las'), [classify], chunk_size=64) == (400, 400)
+    assert laspy.read(str(tmp_path / 'classified.las')).classification[middle] == HIGH_NOISE_CLASS
+    # the outlier step sees all points first, so the class filter (anywhere in the chain) removes the spike
+    chain = [{"filter" : "classes", "exclude_cls" : f"7,{HIGH_NOISE_CLASS}"}, classify]
+    assert apply_filter_chain(path, str(tmp_path / 'excluded.las'), chain, chunk_size=64) == (400, 400 - 1 - 20)
+
+def test_store_filtered_as_las(tile, tmp_path):
+    import laspy
+    from src.point_filters import apply_filter_chain
+    from src.point_store import write_point_store
+
+    path, _ = tile
+    store_path = write_point_store(path, str(tmp_path / 'stores'))
+    filter_chain = [{"filter" : "outliers", "radius" : 1., "elev_diff" : 40.}, {"filter" : "classes", "exclude_cls" : "7"}]
+    from_las = apply_filter_chain(path, str(tmp_path / 'from_las.las'), filter_chain, chunk_size=64)
+    from_store = apply_filter_chain(store_path, str(tmp_path / 'from_store.las'), filter_chain, chunk_size=64)
+    assert from_las == from_store == (400, 379)
+    np.testing.assert_array_equal(laspy.read(str(tmp_path / 'from_las.las')).xyz,
+                                  laspy.read(str(tmp_path / 'from_store.las')).xyz)
+
+def test_tile_without_points(tmp_path):
+    pytest.importorskip("laspy")
+    import laspy
+    from src.point_filters import apply_filter_chain
+    from src.point_store import write_point_store
+
+    empty = np.zeros(0)
+    path = write_las(tmp_path / 'empty.las', empty, empty, empty, empty.astype(np.uint8))
+    filter_chain = [{"filter" : "outliers", "radius" : 1., "elev_diff" : 40.}, {"filter" : "z_range", "maxz" : 40.}]
+    for input_path in (path, write_point_store(path, str(tmp_path / 'stores'))):
+        output_path = str(tmp_path / 'filtered.laz')
+        assert apply_filter_chain(input_path, output_path, filter_chain) == (0, 0)
+        assert len(laspy.read(output_path)) == 0
+
+def test_suffix_by_steps_not_by_their_order():
+    from src.point_filters import filter_chain_from_params, filter_chain_suffix
+
+    implicit = filter_chain_from_params(filter_outliers_params={"radius" : 4, "elev_diff" : 15}, exclude_cls="7,18")
+    explicit = [{"filter" : "classes", "exclude_cls" : "7,18"}, {"filter" : "outliers", "radius" : 4, "elev_diff" : 15}]
+    assert filter_chain_suffix(implicit) == filter_chain_suffix(explicit) == '_rmv_out_rmv_cls'
+    assert filter_chain_suffix([{"filter" : "z_range", "maxz" : 80}]) == '_rmv_z'
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip("rasterio")
+
+from src.raster_filters import filter_raster
+
+NODATA = -32768.
+
+@pytest.fixture
+def raster(tmp_path):
+    """A 270x300 px surface with noise, spikes and nodata holes (also along raster edges)"""
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:270, 0:300]
+    values = (20. + 10. * np.sin(cols / 17.) * np.cos(rows / 23.) + rng.normal(0., 0.5, rows.shape)).astype(np.float32)
+    values[rng.random(rows.shape) < 0.01] += 30. # spikes
+    values[rng.random(rows.shape) < 0.05] = NODATA
+    values[100:140, 250:300] = NODATA # a hole on the east edge, crossed by block halos
+    values[0:3, :] = NODATA
+    path = str(tmp_path / 'mosaic.tif')
+    profile = {"driver" : "GTiff", "width" : 300, "height" : 270, "count" : 1, "dtype" : "float32", "nodata" : NODATA,
+               "crs" : "EPSG:3059", "transform" : from_origin(500000., 310000., 1., 1.)}
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(values, 1)
+    return path
+
+@pytest.mark.parametrize("method, filter_params", [
+    ("median", {"filterx" : 11, "filtery" : 9, "sig_digits" : 2}),
+    ("conservative_smoothing", {"filterx" : 3, "filtery" : 5}),
+    ("bilateral", {"sigma_dist" : 0.75, "sigma_int" : 1.}),
+])
+def test_blocks_bit_identical_to_single_block(raster, tmp_path, method, filter_params):
+    outputs = {}
+    # one block of the whole raster vs 2x2 blocks of 256 px (partial blocks along the east and south edges)
+    for run, block_size, n_workers in (('single', 512, 1), ('blocks', 256, 2)):
+        output_path = str(tmp_path / f'{method}_{run}.tif')
+        filter_raster(raster, output_path, method, filter_params, block_size=block_size, n_workers=n_workers)
+        with rasterio.open(output_path) as src:
+            outputs[run] = src.read(1)
+
+    with rasterio.open(raster) as src:
+        values = src.read(1)
+    np.testing.assert_array_equal(outputs["single"], outputs["blocks"])
+    assert ((outputs["blocks"] == NODATA) == (values == NODATA)).all()
+    assert not np.array_equal(outputs["blocks"], values) # the filter did something
@@ -0,0 +1,42 @@
+import os
+
+import numpy as np
+import pytest
+
+rasterio = pytest.importorskip("rasterio")
+pv = pytest.importorskip("pyvista")
+
+from src.raster_mesh import heights_to_mesh, read_height_array
+
+def write_raster(path, values, nodata):
+    from rasterio.transform import from_origin
+
+    with rasterio.open(path, "w", driver="GTiff", width=values.shape[1], height=values.shape[0], count=1,
+                       dtype=values.dtype, nodata=nodata, transform=from_origin(500000., 310000., 0.5, 0.5)) as dst:
+        dst.write(values, 1)
+    return path
+
+def test_integer_raster_and_missing_memmap(tmp_path):
+    values = np.arange(12, dtype=np.int16).reshape(3, 4)
+    values[0, 0] = -9999
+    raster_path = write_raster(str(tmp_path / 'dsm.tif'), values, nodata=-9999)
+    memmap_path = str(tmp_path / 'heights.npy')
+
+    heights, origin, spacing = read_height_array(raster_path, memmap_path=memmap_path)
+    assert heights.dtype == np.float32 and np.isnan(heights[-1, 0]) # north-west cell, last row in VTK order
+    np.testing.assert_array_equal(heights[:, 1:], values[::-1, 1:])
+    assert origin == (500000.25, 309998.75) and spacing == (0.5, 0.5)
+
+    del heights
+    os.remove(memmap_path) # meta is left, the heights are read again
+    heights, _, _ = read_height_array(raster_path, memmap_path=memmap_path)
+    np.testing.assert_array_equal(heights[:, 1:], values[::-1, 1:])
+
+def test_surface_points_as_warp_by_scalar():
+    heights = np.random.default_rng(0).uniform(10., 20., (5, 7)).astype(np.float32)
+    mesh = heights_to_mesh(heights, origin=(100.5, 200.5), spacing=(1., 2.), scalars_name="heights")
+    flat = heights_to_mesh(heights, origin=(100.5, 200.5), spacing=(1., 2.), scalars_name="heights", warp=False)
+
+    assert isinstance(mesh, pv.StructuredGrid) and mesh.points.dtype == np.float32
+    np.testing.assert_allclose(mesh.points, flat.warp_by_scalar("heights").points, rtol=1e-6)
+    assert np.shares_memory(mesh.point_data["heights"], heights) # scalars are the height buffer
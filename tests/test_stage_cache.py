@@ -0,0 +1,78 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from src.stage_cache import StageCache
+
+@pytest.fixture
+def tile(tmp_path):
+    path = tmp_path / 'tile.las'
+    path.write_bytes(b'points' * 100)
+    return str(path)
+
+def write_output(folder, name, size):
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as file:
+        file.write(b'x' * size)
+    return path
+
+def test_store_restore_and_index_written_on_flush(tmp_path, tile):
+    cache_dir = str(tmp_path / 'cache')
+    cache = StageCache(cache_dir=cache_dir)
+    output = write_output(str(tmp_path), 'tile.tif', 1000)
+    params = {"resolution" : 1.}
+
+    assert cache.restore('rasterize', [tile], params, output_folder=str(tmp_path)) == (False, None)
+    cache.store('rasterize', [tile], params, [output])
+    assert not os.path.exists(os.path.join(cache_dir, 'index.json')) # batched, nothing written per tile
+    cache.flush()
+
+    restored_folder = tmp_path / 'restored'
+    restored_folder.mkdir()
+    cache = StageCache(cache_dir=cache_dir) # a re-run reads the flushed index
+    hit, paths = cache.restore('rasterize', [tile], params, output_folder=str(restored_folder))
+    assert hit and paths == [str(restored_folder / 'tile.tif')]
+    assert (restored_folder / 'tile.tif').read_bytes() == b'x' * 1000
+    assert cache.restore('rasterize', [tile], {"resolution" : 2.}, output_folder=str(restored_folder)) == (False, None)
+    cache.flush()
+
+    with open(os.path.join(cache_dir, 'index.json')) as file:
+        index = json.load(file)
+    assert (index["hits"], index["misses"]) == (1, 2)
+
+def test_missing_objects_are_a_miss(tmp_path, tile):
+    cache_dir = str(tmp_path / 'cache')
+    cache = StageCache(cache_dir=cache_dir)
+    cache.store('mosaic', [tile], {}, [write_output(str(tmp_path), 'mosaic.tif', 10)])
+    cache.flush()
+
+    shutil.rmtree(os.path.join(cache_dir, 'objects'))
+    cache = StageCache(cache_dir=cache_dir)
+    assert cache.restore('mosaic', [tile], {}, output_paths=[str(tmp_path / 'restored.tif')]) == (False, None)
+    assert cache.stats()["entries"] == 0 and cache.stats()["misses"] == 1
+
+def test_evict_least_recently_used_never_the_stored_entry(tmp_path, tile):
+    cache = StageCache(cache_dir=str(tmp_path / 'cache'), max_size_gb=2500 / 1024 ** 3)
+    keys = [cache.store('filter', [tile], {"step" : step}, [write_output(str(tmp_path), f'{step}.las', 1000)])
+            for step in range(2)]
+    assert cache.restore('filter', [tile], {"step" : 0}, output_folder=str(tmp_path))[0] # step 1 is now the oldest
+
+    key = cache.store('filter', [tile], {"step" : 2}, [write_output(str(tmp_path), '2.las', 1000)])
+    assert set(cache._index["entries"]) == {keys[0], key}
+    assert not os.path.exists(os.path.join(cache.cache_dir, 'objects', keys[1]))
+
+    # an output bigger than the whole cache is kept until the next store
+    big = cache.store('filter', [tile], {"step" : 3}, [write_output(str(tmp_path), '3.las', 5000)])
+    assert set(cache._index["entries"]) == {big}
+    assert cache.restore('filter', [tile], {"step" : 3}, output_folder=str(tmp_path))[0]
+
+def test_file_hash_by_content(tmp_path, tile):
+    cache = StageCache(cache_dir=str(tmp_path / 'cache'))
+    copy = str(tmp_path / 'copy.las')
+    shutil.copy(tile, copy)
+    assert cache.key('clip', [tile], {}) == cache.key('clip', [copy], {})
+    with open(copy, 'ab') as file:
+        file.write(b'more')
+    assert cache.key('clip', [tile], {}) != cache.key('clip', [copy], {})
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+laspy = pytest.importorskip("laspy")
+pytest.importorskip("shapely")
+pytest.importorskip("pyproj")
+
+from src.tile_index import TileIndex
+
+def write_tile(path, minx, miny, crs=None):
+    header = laspy.LasHeader(point_format=6, version="1.4")
+    header.scales, header.offsets = np.array([0.01] * 3), np.array([0., 0., 0.])
+    if crs is not None:
+        from pyproj import CRS
+
+        header.add_crs(CRS.from_user_input(crs))
+    points = laspy.ScaleAwarePointRecord.zeros(2, header=header)
+    points.x, points.y, points.z = [minx, minx + 1000.], [miny, miny + 1000.], [10., 20.]
+    with laspy.open(str(path), mode="w", header=header) as writer:
+        writer.write_points(points)
+    return str(path)
+
+# a square around (24.1, 56.95) in Riga, inside the first LKS-92 (EPSG:3059) tile
+POLYGON = [(24.09, 56.94), (24.11, 56.94), (24.11, 56.96), (24.09, 56.96)]
+
+def test_query_reprojects_polygon_to_crs_of_tiles(tmp_path):
+    files = [write_tile(tmp_path / 'riga.las', 505000., 312000., crs='EPSG:3059'),
+             write_tile(tmp_path / 'far.las', 600000., 312000., crs='EPSG:3059')]
+    index = TileIndex(str(tmp_path / 'index.json'))
+    assert index.query(files, polygon=POLYGON, polygon_crs='EPSG:4326') == [files[0]]
+
+def test_query_raises_if_crs_of_tiles_unknown_or_mixed(tmp_path):
+    index = TileIndex(str(tmp_path / 'index.json'))
+    no_crs = [write_tile(tmp_path / 'no_crs.las', 505000., 312000.)]
+    with pytest.raises(ValueError, match="no CRS"):
+        index.query(no_crs, polygon=POLYGON, polygon_crs='EPSG:4326')
+    # without `polygon_crs` the polygon is taken in tile coordinates
+    assert index.query(no_crs, polygon=[(505100., 312100.), (505200., 312100.), (505200., 312200.)]) == no_crs
+
+    mixed = no_crs + [write_tile(tmp_path / 'lks.las', 505000., 312000., crs='EPSG:3059'),
+                      write_tile(tmp_path / 'utm.las', 340000., 6315000., crs='EPSG:32635')]
+    with pytest.raises(ValueError, match="2 different CRS"):
+        index.query(mixed, polygon=POLYGON, polygon_crs='EPSG:4326')
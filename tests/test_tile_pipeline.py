@@ -0,0 +1,132 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.tile_pipeline import schedule_tiles, tiles_window
+
+def grid_neighbours(n_rows, n_columns):
+    """Halo neighbours of a grid of tiles in mosaic order (row by row), the tile itself included"""
+    return [[(row + row_step) * n_columns + column + column_step
+             for row_step in (-1, 0, 1) for column_step in (-1, 0, 1)
+             if 0 <= row + row_step < n_rows and 0 <= column + column_step < n_columns]
+            for row in range(n_rows) for column in range(n_columns)]
+
+class Tasks:
+    """Sleeping tasks on a thread pool, recording events and concurrency"""
+    def __init__(self, pool, duration=0.01):
+        self.pool, self.duration = pool, duration
+        self.lock = threading.Lock()
+        self.running = {"filter" : 0, "rasterize" : 0}
+        self.max_running, self.max_filters_running = 0, {}
+        self.events = []
+
+    def _run(self, kind, position):
+        with self.lock:
+            self.running[kind] += 1
+            self.max_running = max(self.max_running, sum(self.running.values()))
+            if kind == 'filter':
+                self.max_filters_running[position] = self.running["filter"]
+            self.events.append(('start', kind, position))
+        time.sleep(self.duration)
+        with self.lock:
+            self.running[kind] -= 1
+            self.events.append(('done', kind, position))
+        return position
+
+    def submit(self, kind, position):
+        return self.pool.submit(self._run, kind, position)
+
+    def release(self, position):
+        with self.lock:
+            self.events.append(('release', 'filter', position))
+
+def run_grid(n_rows=6, n_columns=8, n_workers=4, max_tiles_in_flight=None, empty=()):
+    neighbours = grid_neighbours(n_rows, n_columns)
+    blocks = [[row * n_columns + column for row in rows for column in range(n_columns)]
+              for rows in (range(start, min(start + 2, n_rows)) for start in range(0, n_rows, 2))]
+    written, released = [], []
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        tasks = Tasks(pool)
+        schedule = schedule_tiles(neighbours, blocks,
+                                  submit_filter=lambda position: tasks.submit('filter', position),
+                                  submit_rasterize=lambda position, filtered: (None if position in empty else
+                                                                               tasks.submit('rasterize', position)),
+                                  write_block=lambda index, rasters: written.append(index),
+                                  release=lambda position, result: (released.append(position), tasks.release(position)),
+                                  n_workers=n_workers, max_tiles_in_flight=max_tiles_in_flight)
+    return neighbours, schedule, tasks, written, released
+
+def test_window_of_grid():
+    neighbours = grid_neighbours(6, 8)
+    assert tiles_window(neighbours, n_workers=4) == 2 * (8 + 1) + 4
+    assert tiles_window(neighbours, n_workers=4, max_tiles_in_flight=100) == 100
+    assert tiles_window([[0]], n_workers=4) == 8
+
+def test_schedule_grid_window_and_concurrency():
+    n_rows, n_columns, n_workers = 6, 8, 4
+    neighbours, schedule, tasks, written, released = run_grid(n_rows, n_columns, n_workers)
+
+    assert sorted(written) == [0, 1, 2] and schedule["blocks_left"] == 0
+    assert sorted(released) == list(range(n_rows * n_columns))
+    assert sorted(schedule["filtered"]) == sorted(schedule["rasters"]) == list(range(n_rows * n_columns))
+    assert schedule["max_in_flight"] <= schedule["window"] == 2 * (n_columns + 1) + n_workers
+    assert tasks.max_running == n_workers
+    # the window doesn't starve filtering: tiles admitted after the first releases still filter in parallel
+    assert max(count for position, count in tasks.max_filters_running.items() if position >= schedule["window"]) > 1
+
+def test_schedule_rasterizes_after_neighbours_and_releases_after_consumers():
+    neighbours, schedule, tasks, written, released = run_grid(4, 5, n_workers=3)
+    done = {}
+    for order, (event, kind, position) in enumerate(tasks.events):
+        if event == 'done':
+            done[kind, position] = order
+        elif event == 'start' and kind == 'rasterize':
+            assert all(done[('filter', neighbour)] < order for neighbour in neighbours[position])
+        elif event == 'release':
+            consumers = [consumer for consumer, positions in enumerate(neighbours) if position in positions]
+            assert all(done[('rasterize', consumer)] < order for consumer in consumers)
+
+def test_schedule_empty_tiles():
+    neighbours, schedule, tasks, written, released = run_grid(4, 4, n_workers=2, empty={0, 5, 15})
+    assert schedule["rasters"][0] is None and schedule["rasters"][5] is None and schedule["rasters"][15] is None
+    assert ('start', 'rasterize', 5) not in tasks.events
+    assert sorted(written) == [0, 1] and sorted(released) == list(range(16))
+
+def test_schedule_failed_tasks_become_records():
+    from concurrent.futures.process import BrokenProcessPool
+
+    def fail(position):
+        raise RuntimeError(f"tile {position}")
+
+    neighbours = grid_neighbours(4, 4)
+    written = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        tasks = Tasks(pool)
+
+        def submit_filter(position):
+            if position == 9: # f.e. the pool broke before this tile
+                raise BrokenProcessPool("a worker died")
+            return pool.submit(fail, position) if position == 3 else tasks.submit('filter', position)
+
+        schedule = schedule_tiles(neighbours, [list(range(8)), list(range(8, 16))], submit_filter=submit_filter,
+                                  submit_rasterize=lambda position, filtered: tasks.submit('rasterize', position),
+                                  write_block=lambda index, rasters: written.append(index),
+                                  failed_result=lambda kind, position, error: {"kind" : kind, "success" : False,
+                                                                               "error" : f"{type(error).__name__}: {error}"},
+                                  n_workers=2)
+
+    assert schedule["filtered"][3] == {"kind" : "filter", "success" : False, "error" : "RuntimeError: tile 3"}
+    assert schedule["filtered"][9]["error"] == "BrokenProcessPool: a worker died"
+    assert all(schedule["filtered"][position] == position for position in range(16) if position not in (3, 9))
+    assert sorted(schedule["rasters"]) == list(range(16)) and sorted(written) == [0, 1]
+
+def test_pipeline_without_tiles(tmp_path):
+    pytest.importorskip("rasterio")
+    from src.tile_pipeline import run_tile_pipeline
+
+    pipeline = run_tile_pipeline([], str(tmp_path / 'filtered'), str(tmp_path / 'tif'), str(tmp_path / 'mosaic.tif'),
+                                 gridding_params={"resolution" : 1.})
+    assert pipeline["filter"] == pipeline["rasterize"] == [] and pipeline["mosaic"] is None
+    assert not (tmp_path / 'mosaic.tif').exists()
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+laspy = pytest.importorskip("laspy")
+rasterio = pytest.importorskip("rasterio")
+pytest.importorskip("scipy")
+
+from src.gridding import NODATA, grid_lidar_points
+from src.point_store import write_point_store
+from src.raster_mosaic import mosaic_windowed
+from src.tile_rasterizer import gather_tile_with_halo, rasterize_tiles, snap_bounds
+
+GRIDDING_PARAMS = {"resolution" : 1., "statistic" : "idw", "radius" : 1.5}
+
+def write_tile(path, minx, maxx, seed, point_format=1, scale=0.01):
+    """Writes a 20 m high tile of random points with x in [minx, maxx], a ridge crossing the tile edges"""
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(minx, maxx, 4000), rng.uniform(0.03, 19.98, 4000)
+    header = laspy.LasHeader(point_format=point_format, version="1.4" if point_format >= 6 else "1.2")
+    header.scales, header.offsets = np.array([scale] * 3), np.array([0., 0., 0.])
+    points = laspy.ScaleAwarePointRecord.zeros(len(x), header=header)
+    points.x, points.y, points.z = x, y, 10. + 5. * np.sin(x / 3.) + rng.normal(0., 0.2, len(x))
+    points.classification = np.full(len(x), 2)
+    with laspy.open(str(path), mode="w", header=header) as writer:
+        writer.write_points(points)
+    return str(path)
+
+@pytest.fixture
+def tiles(tmp_path):
+    # tiles meet at x = 20, extents of points stop short of the edge (or pass it) by a fraction of a cell,
+    # the east tile has another point format and scale
+    return [write_tile(tmp_path / 'west.laz', 0.02, 20.04, seed=0),
+            write_tile(tmp_path / 'east.laz', 20.07, 39.96, seed=1, point_format=6, scale=0.001)]
+
+def read_raster(path):
+    with rasterio.open(path) as src:
+        return src.read(1), src.transform, src.bounds
+
+def test_tile_rasters_and_mosaic_same_for_any_number_of_workers(tiles, tmp_path):
+    outputs = {}
+    for n_workers in (1, 2):
+        folder = tmp_path / f'tif_{n_workers}'
+        folder.mkdir()
+        results = rasterize_tiles(files=tiles, output_folder=str(folder), raster_method='numpy',
+                                  gridding_params=GRIDDING_PARAMS, halo=3., n_workers=n_workers)
+        assert all(result["success"] for result in results), [result["error"] for result in results]
+        rasters = sorted(result["output"] for result in results)
+        mosaic_windowed(rasters, str(tmp_path / f'mosaic_{n_workers}.tif'))
+        outputs[n_workers] = [read_raster(path) for path in rasters + [str(tmp_path / f'mosaic_{n_workers}.tif')]]
+
+    for (values_1, transform_1, _), (values_n, transform_n, _) in zip(outputs[1], outputs[2]):
+        assert transform_1 == transform_n
+        np.testing.assert_array_equal(values_1, values_n)
+
+    (_, _, east_bounds), (_, _, west_bounds), (mosaic, _, mosaic_bounds) = outputs[1] # east.tif, west.tif, mosaic
+    assert west_bounds.right == east_bounds.left == 20. # a shared grid line, no overlapping cell
+    assert tuple(mosaic_bounds) == (0., 0., 40., 20.) == snap_bounds((0.02, 0.03, 39.96, 19.98), 1.)
+    # with the halo, cells along the seam see points of both tiles, as gridding all points at once
+    expected = grid_lidar_points([(path, None) for path in tiles], (0., 0., 40., 20.), **GRIDDING_PARAMS)
+    assert (mosaic != NODATA).all()
+    np.testing.assert_allclose(mosaic, expected, rtol=1e-6)
+
+def test_gather_halo_from_point_stores_of_other_formats(tiles, tmp_path):
+    west_store = write_point_store(tiles[0], str(tmp_path / 'stores'))
+    tile = {"path" : west_store, "bounds" : (0.02, 0.03, 20.04, 19.98)}
+    neighbour = {"path" : tiles[1], "bounds" : (20.07, 0.03, 39.96, 19.98)}
+    output_path = str(tmp_path / 'west_with_halo.laz')
+    n_points = gather_tile_with_halo(tile, [tile, neighbour], halo=2., output_path=output_path,
+                                     grid_bounds=(-2., -2., 22., 22.))
+
+    points = laspy.read(output_path)
+    east = laspy.read(tiles[1])
+    n_halo = int((east.x <= 22.).sum()) # the halo (22.04) is cut by the grid
+    assert n_points == len(points) == 4000 + n_halo
+    assert points.header.point_format.id == 1 and np.allclose(points.header.scales, 0.01)
+    assert (points.x.max() <= 22.) and (points.classification == 2).all()
+    # the header extent is the grid, so whitebox lays its cells on the global grid
+    assert tuple(points.header.mins[:2]) == (-2., -2.) and tuple(points.header.maxs[:2]) == (22., 22.)